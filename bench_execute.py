@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# Benchmarks for execute, call with the names of the benchmarks to
+# run (default: all) and optionally -n <megabytes>.
+
+from __future__ import print_function
+import sys
+import errno
+from time import time
+from argparse import ArgumentParser
+from rsclib.execute import Exec_Process, Tee
+
+def timed (name, fun, * args) :
+    start  = time ()
+    result = fun (* args)
+    print ("%-40s %8.3fs" % (name, time () - start))
+    return result
+# end def timed
+
+class Text_Tee (Tee) :
+    """ The Tee before it used raw file descriptors: text mode reads
+        of bufsize and a write to each child.
+    """
+
+    def method (self) :
+        while 1 :
+            buf = sys.stdin.read (self.bufsize)
+            if not buf :
+                return
+            written = False
+            for stdout, child in list (self.stdouts.items ()) :
+                if not child :
+                    continue
+                try :
+                    stdout.write (buf)
+                    written = True
+                except IOError as cause :
+                    if cause.errno != errno.EPIPE :
+                        raise
+                    stdout.close ()
+                    del self.stdouts [stdout]
+            if not written :
+                return
+    # end def method
+
+# end class Text_Tee
+
+def tee_pipeline (tee_class, n, nchildren, ** kw) :
+    """ Pipe n MB of zeros through a tee into nchildren cat processes
+        writing to /dev/null.
+    """
+    src  = Exec_Process \
+        ( '/bin/sh'
+        , ('sh', '-c', 'head -c %dM /dev/zero' % n)
+        , name = 'source'
+        )
+    sinks = []
+    for i in range (nchildren) :
+        sinks.append \
+            ( Exec_Process
+                ( '/bin/sh'
+                , ('sh', '-c', 'cat > /dev/null')
+                , name = 'sink%d' % i
+                )
+            )
+    src.append (tee_class (sinks, ** kw))
+    src.run  ()
+    src.wait ()
+    for p in [src] + sinks :
+        assert not p.status, p.name
+# end def tee_pipeline
+
+def bench_tee (n) :
+    for k in (2, 4) :
+        timed \
+            ( 'Text_Tee (old) %s children (%sM)' % (k, n)
+            , tee_pipeline, Text_Tee, n, k
+            )
+        timed \
+            ( 'Tee %s children (%sM)' % (k, n)
+            , tee_pipeline, Tee, n, k
+            )
+# end def bench_tee
+
+benchmarks = dict \
+    ( tee = bench_tee
+    )
+
+if __name__ == '__main__' :
+    cmd = ArgumentParser ()
+    cmd.add_argument \
+        ( 'benchmark'
+        , nargs   = '*'
+        , help    = 'Benchmarks to run, one of %s' % ', '.join (benchmarks)
+        )
+    cmd.add_argument \
+        ( '-n', '--count'
+        , type    = int
+        , default = 1024
+        , help    = 'Megabytes to pipe through the tee, default: %(default)s'
+        )
+    args = cmd.parse_args ()
+    for b in args.benchmark or sorted (benchmarks) :
+        benchmarks [b] (args.count)
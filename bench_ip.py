@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+# Benchmarks for IP_Address, call with the names of the benchmarks to
+# run (default: all) and optionally -n <count>.
+
+from __future__ import print_function
+import sys
+import random
+from time import time
+from argparse import ArgumentParser
+from rsclib.IP_Address import IP4_Address, IP6_Address, Prefix_Table, IP_Set
+
+def timed (name, fun, * args) :
+    start  = time ()
+    result = fun (* args)
+    print ("%-40s %8.3fs" % (name, time () - start))
+    return result
+# end def timed
+
+def random_ip4 (n, masked = False) :
+    r = random.Random (23)
+    result = []
+    for i in range (n) :
+        a = '%d.%d.%d.%d' % tuple (r.randrange (256) for k in range (4))
+        if masked :
+            a = '%s/%d' % (a, r.randint (8, 32))
+        result.append (a)
+    return result
+# end def random_ip4
+
+def random_ip6 (n) :
+    r = random.Random (42)
+    return [str (IP6_Address (r.getrandbits (128))) for i in range (n)]
+# end def random_ip6
+
+def bench_parse (n) :
+    for cls, name, adrs in \
+        ( (IP4_Address, 'IP4',      random_ip4 (n))
+        , (IP4_Address, 'IP4/mask', random_ip4 (n, masked = True))
+        , (IP6_Address, 'IP6',      random_ip6 (n))
+        ) :
+        l1 = timed \
+            ( '%s constructor (%s)' % (name, n)
+            , lambda : [cls (a) for a in adrs]
+            )
+        l2 = timed \
+            ( '%s parse_many (%s)' % (name, n)
+            , lambda : list (cls.parse_many (adrs))
+            )
+        assert l1 == l2
+# end def bench_parse
+
+def bench_hash (n) :
+    for cls, name, adrs in \
+        ( (IP4_Address, 'IP4', random_ip4 (n, masked = True))
+        , (IP6_Address, 'IP6', random_ip6 (n))
+        ) :
+        adrs = list (cls.parse_many (adrs))
+        timed \
+            ( '%s hash, first call (%s)' % (name, n)
+            , lambda : [hash (a) for a in adrs]
+            )
+        timed \
+            ( '%s hash, cached (%s)' % (name, n)
+            , lambda : [hash (a) for a in adrs]
+            )
+        timed ('%s set (%s)'  % (name, n), set, adrs)
+        timed ('%s dict (%s)' % (name, n), dict.fromkeys, adrs)
+        s = set (adrs)
+        timed \
+            ( '%s set lookup (%s)' % (name, n)
+            , lambda : sum (1 for a in adrs if a in s)
+            )
+# end def bench_hash
+
+def random_prefixes (n) :
+    r = random.Random (4711)
+    return \
+        [ IP4_Address (r.getrandbits (32), r.randint (8, 28))
+          for i in range (n)
+        ]
+# end def random_prefixes
+
+def bench_prefix (n) :
+    prefixes = random_prefixes (n)
+    adrs     = list (IP4_Address.parse_many (random_ip4 (n)))
+    nlinear  = max (1, min (n, 1000000 // len (prefixes)))
+
+    def linear () :
+        result = []
+        for a in adrs [:nlinear] :
+            best = None
+            for p in prefixes :
+                if p.contains (a) and (best is None or p.mask > best.mask) :
+                    best = p
+            result.append (best)
+        return result
+    # end def linear
+
+    def lpm () :
+        result = []
+        for a in adrs [:nlinear] :
+            m = table.longest_match (a)
+            result.append (m and m [0])
+        return result
+    # end def lpm
+
+    table = timed \
+        ( 'Prefix_Table insert (%s)' % n
+        , Prefix_Table, ((p, None) for p in prefixes)
+        )
+    l1 = timed ('linear contains scan (%s)' % nlinear, linear)
+    l2 = timed ('Prefix_Table longest_match (%s)' % nlinear, lpm)
+    assert l1 == l2
+    timed \
+        ( 'Prefix_Table longest_match (%s)' % n
+        , lambda : [table.longest_match (a) for a in adrs]
+        )
+# end def bench_prefix
+
+def bench_set (n) :
+    r  = random.Random (815)
+    # Prefixes in 10.0.0.0/8 so that there is something to merge
+    p1 = [IP4_Address (0x0a000000 | r.getrandbits (24), r.randint (24, 32))
+          for i in range (n)
+         ]
+    p2 = [IP4_Address (0x0a000000 | r.getrandbits (24), r.randint (24, 32))
+          for i in range (n)
+         ]
+    s1 = timed ('IP_Set aggregate (%s)' % n, IP_Set, p1)
+    s2 = IP_Set (p2)
+    timed ('IP_Set cidrs (%s intervals)' % len (s1.intervals [32]), s1.cidrs)
+    timed ('IP_Set union', s1.union, s2)
+    timed ('IP_Set intersection', s1.intersection, s2)
+    timed ('IP_Set difference', s1.difference, s2)
+# end def bench_set
+
+def bench_view (n) :
+    net = IP4_Address ('10.0.0.0/8')
+    timed \
+        ( 'subnets, first %s' % n
+        , lambda : [a for a, i in zip (net.subnets (), range (n))]
+        )
+    view = net.subnet_view ()
+    timed ('subnet_view, first %s' % n, lambda : list (view [:n]))
+    r    = random.Random (42)
+    idx  = [r.randrange (len (view)) for i in range (n)]
+    timed \
+        ( 'subnet_view, %s random indexes' % n
+        , lambda : [view [i] for i in idx]
+        )
+    view = IP6_Address ('2001:db8::/32').subnet_view (64)
+    timed \
+        ( 'IPv6 subnet_view, every 2**20th of %s' % view.len ()
+        , lambda : list (view [::2 ** 20] [:n])
+        )
+# end def bench_view
+
+def bench_array (n) :
+    # Needs numpy, imported here so the other benchmarks run without it
+    from rsclib.IP_Array import IP4_Array
+    adrs = list (IP4_Address.parse_many (random_ip4 (n, masked = True)))
+    net  = IP4_Address ('10.0.0.0/8')
+    a    = timed ('IP4_Array from addresses (%s)' % n, IP4_Array, adrs)
+    l1   = timed \
+        ( 'IP4_Address contained in (%s)' % n
+        , lambda : [x for x in adrs if net.contains (x)]
+        )
+    l2   = timed \
+        ( 'IP4_Array contained_in (%s)' % n
+        , lambda : a [a.contained_in (net)].to_list ()
+        )
+    assert l1 == l2
+    l1   = timed \
+        ( 'IP4_Address mask to 16, unique (%s)' % n
+        , lambda : sorted (set (IP4_Address (x.ip, min (x.mask, 16)) for x in adrs))
+        )
+    l2   = timed \
+        ( 'IP4_Array mask_to 16, unique (%s)' % n
+        , lambda : a.mask_to (16).unique ().to_list ()
+        )
+    assert l1 == l2
+    timed ('IP4_Array group_by_prefix 8 (%s)' % n, a.group_by_prefix, 8)
+# end def bench_array
+
+def bench_str6 (n) :
+    r    = random.Random (42)
+    ips  = []
+    for i in range (n) :
+        v = r.getrandbits (128)
+        # Clear some groups so that zero compression is exercised
+        for k in range (8) :
+            if r.random () < 0.3 :
+                v &= ~(0xffff << (16 * k))
+        ips.append (v)
+    adrs = [IP6_Address (v) for v in ips]
+    l1   = timed \
+        ( 'IP6 format, uncached (old) (%s)' % n
+        , lambda : [a._format () for a in adrs]
+        )
+    l2   = timed ('IP6 str, first call (%s)' % n, lambda : [str (a) for a in adrs])
+    l3   = timed ('IP6 str, cached (%s)' % n, lambda : [str (a) for a in adrs])
+    assert l1 == l2 == l3
+    timed \
+        ( 'IP6 sort by str, uncached (old) (%s)' % n
+        , lambda : sorted (adrs, key = IP6_Address._format)
+        )
+    timed ('IP6 sort by str (%s)' % n, lambda : sorted (adrs, key = str))
+    timed \
+        ( 'IP6 print, uncached (old) (%s)' % n
+        , lambda : '\n'.join (a._format () for a in adrs)
+        )
+    timed ('IP6 print (%s)' % n, lambda : '\n'.join (str (a) for a in adrs))
+# end def bench_str6
+
+benchmarks = dict \
+    ( array  = bench_array
+    , hash   = bench_hash
+    , parse  = bench_parse
+    , prefix = bench_prefix
+    , set    = bench_set
+    , str6   = bench_str6
+    , view   = bench_view
+    )
+
+if __name__ == '__main__' :
+    cmd = ArgumentParser ()
+    cmd.add_argument \
+        ( 'benchmark'
+        , nargs   = '*'
+        , help    = 'Benchmarks to run, one of %s' % ', '.join (benchmarks)
+        )
+    cmd.add_argument \
+        ( '-n', '--count'
+        , type    = int
+        , default = 100000
+        , help    = 'Number of addresses, default: %(default)s'
+        )
+    args = cmd.parse_args ()
+    for b in args.benchmark or sorted (benchmarks) :
+        benchmarks [b] (args.count)
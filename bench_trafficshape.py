@@ -0,0 +1,396 @@
+#!/usr/bin/python3
+# Benchmarks for trafficshape, call with the names of the benchmarks to
+# run (default: all) and optionally -n <count>.
+
+from __future__ import print_function
+import os
+import random
+import subprocess
+from time import time
+from argparse import ArgumentParser
+from rsclib.IP_Address   import IP4_Address
+from rsclib.pycompat     import StringIO
+from rsclib.trafficshape import U32_Hash_Filter
+from rsclib.execute      import Exec_Error
+from rsclib.trafficshape import Traffic_Class, Shaper, Rule_Set, Multi_Shaper
+from rsclib.tc_sim       import TC_Simulator, Packet
+
+def timed (name, fun, * args) :
+    start  = time ()
+    result = fun (* args)
+    print ("%-40s %8.3fs" % (name, time () - start))
+    return result
+# end def timed
+
+def customer_prefixes (n) :
+    """ Customer networks in a few /16 provider blocks, each mapped
+        to one of 8 classes.
+    """
+    r = random.Random (23)
+    blocks = [IP4_Address (0x0a000000 | (i << 16), 16) for i in range (8)]
+    result = []
+    for i in range (n) :
+        b = r.choice (blocks)
+        m = r.randint (24, 32)
+        a = IP4_Address (b.ip | r.getrandbits (16), m)
+        result.append ((a, 'flowid 1:%x' % r.randint (2, 9)))
+    return result
+# end def customer_prefixes
+
+def bench_hash (n) :
+    prefixes = customer_prefixes (n)
+
+    def linear () :
+        result = []
+        for a, target in prefixes :
+            result.append \
+                ( '$TC filter add dev eth0 parent 1: protocol ip prio 1 '
+                  'u32 match ip src %s/%s %s' % (a.dotted (), a.mask, target)
+                )
+        return '\n'.join (result)
+    # end def linear
+
+    def hashed () :
+        f = U32_Hash_Filter ('eth0', '1:')
+        for a, target in prefixes :
+            f.add (a, target)
+        return f.generate ()
+    # end def hashed
+
+    l = timed ('linear u32 filters (%s)' % n, linear)
+    h = timed ('U32_Hash_Filter (%s)' % n, hashed)
+    # Rules per hash table, rules without ht are in the root table
+    ht   = {}
+    root = 0
+    for line in h.split ('\n') :
+        if ' ht ' in line :
+            t = line.split (' ht ') [1].split () [0]
+            ht [t] = ht.get (t, 0) + 1
+        elif 'divisor' not in line :
+            root += 1
+    print \
+        ( "Filters: linear %s hashed %s"
+        % (len (l.split ('\n')), len (h.split ('\n')))
+        )
+    print \
+        ( "Rules tested per packet, worst case: linear %s hashed %s"
+        % (len (l.split ('\n')), root + max (ht.values ()))
+        )
+# end def bench_hash
+
+def bench_layout (n) :
+    rules = []
+    for a, target in customer_prefixes (n) :
+        rules.append \
+            ( '-A PREROUTING -s %s/%s -j MARK --set-xmark 0x%s/0xf'
+            % (a.dotted (), a.mask, 1 + int (target [-1], 16) % 2)
+            )
+    rules = '\n'.join (rules)
+    root  = Traffic_Class (100)
+    Traffic_Class (50, parent = root, fwmark = '1/0xf')
+    Traffic_Class (50, parent = root, fwmark = '2/0xf', is_default = True)
+    for layout in 'linear', 'hash' :
+        shaper = Shaper ('/sbin/tc', root, filter_layout = layout)
+        out    = timed \
+            ( 'Shaper filter_layout %s (%s)' % (layout, n)
+            , shaper.generate, 10000, 'ifb0=eth0', StringIO (rules)
+            )
+        lines  = [l for l in out.split ('\n') if 'filter add dev eth0' in l]
+        prios  = set \
+            (l.split (' prio ') [1].split () [0] for l in lines if ' prio ' in l)
+        print \
+            ( "Filters on eth0: %s, filter priorities: %s"
+            % (len (lines), len (prios))
+            )
+# end def bench_layout
+
+def bench_batch (n) :
+    """ Apply time of a shell script (one tc process per command) and
+        of tc -batch. Since we don't want to modify the network config
+        the commands are for a non-existing device and fail, so this
+        measures the process overhead.
+    """
+    tc    = '/sbin/tc'
+    root  = Traffic_Class (100)
+    for i in range (n // 4) :
+        Traffic_Class (1, parent = root, fwmark = '%s/0xffff' % (i + 1))
+    shaper = Shaper (tc, root)
+    script = shaper.generate (10000, 'nodev0')
+    batch  = shaper.as_batch (script)
+    print ("Commands: %s" % len (batch.split ('\n')))
+
+    def run (args, input) :
+        p = subprocess.Popen \
+            ( args
+            , stdin  = subprocess.PIPE
+            , stdout = subprocess.PIPE
+            , stderr = subprocess.PIPE
+            )
+        p.communicate (input.encode ('ascii'))
+    # end def run
+
+    timed ('shell script', run, ['/bin/sh'], script)
+    timed ('tc -batch', run, [tc, '-force', '-batch', '-'], batch)
+# end def bench_batch
+
+def mangle_rules (n) :
+    """ Output of iptables -t mangle -S PREROUTING -v with a mix of
+        typical marking rules.
+    """
+    r      = random.Random (42)
+    result = ['-P PREROUTING ACCEPT -c 4711 815']
+    for i in range (n) :
+        a = IP4_Address (0x0a000000 | r.getrandbits (24), r.randint (16, 32))
+        x = r.randint (1, 15)
+        c = '-c %s %s' % (r.getrandbits (16), r.getrandbits (24))
+        k = i % 4
+        if k == 0 :
+            o = '-s %s/%s' % (a.dotted (), a.mask)
+        elif k == 1 :
+            o = '! -d %s/%s -i eth0' % (a.dotted (), a.mask)
+        elif k == 2 :
+            o = '-p tcp -m tcp --dport %s' % r.randint (1, 65535)
+        else :
+            o = '-s %s/%s -m mark --mark 0x0/0xf' % (a.dotted (), a.mask)
+        result.append \
+            ('-A PREROUTING %s %s -j MARK --set-xmark 0x%x/0xf' % (o, c, x))
+    return '\n'.join (result) + '\n'
+# end def mangle_rules
+
+def bench_parse (n) :
+    n     = max (n, 50000)
+    rules = mangle_rules (n)
+    rs    = Rule_Set ()
+    timed ('Rule_Set parse (%s)' % n, rs.parse, StringIO (rules))
+    for r, line in zip (rs, rules.split ('\n')) :
+        assert r.as_iptables () == line, (r.as_iptables (), line)
+    timed ('Rule_Set parse again (%s)' % n, rs.parse, StringIO (rules))
+    assert len (rs) == n + 1
+    try :
+        import tracemalloc
+    except ImportError :
+        return
+    rs.clear ()
+    tracemalloc.start ()
+    rs.parse (StringIO (rules))
+    size = tracemalloc.get_traced_memory () [0]
+    tracemalloc.stop ()
+    print ("Memory per rule: %d bytes" % (size // n))
+# end def bench_parse
+
+def bench_nft (n) :
+    """ Rules of an nftables ruleset with sets compared to the number
+        of iptables rules for n address rules in runs of the same mark.
+    """
+    r     = random.Random (47)
+    rules = []
+    mark  = 1
+    for i in range (n) :
+        if r.random () < 0.01 :
+            mark = r.randint (1, 15)
+        a = IP4_Address (0x0a000000 | r.getrandbits (24), r.randint (16, 32))
+        rules.append \
+            ( '-A PREROUTING -s %s/%s -j MARK --set-xmark 0x%x/0xf'
+            % (a.dotted (), a.mask, mark)
+            )
+    rs = Rule_Set ()
+    rs.parse (StringIO ('\n'.join (rules)))
+    out = timed ('Rule_Set as_nft (%s rules)' % n, rs.as_nft)
+    print \
+        ( "iptables rules: %s nft rules: %s sets: %s"
+        % ( n, len ([l for l in out.split ('\n') if 'counter' in l])
+          , out.count ('    set ')
+          )
+        )
+    timed ('Rule_Set as_nft (%s mixed rules)' % n, mangle_rules_nft, n)
+# end def bench_nft
+
+def mangle_rules_nft (n) :
+    rs = Rule_Set ()
+    rs.parse (StringIO (mangle_rules (n)))
+    return rs.as_nft ()
+# end def mangle_rules_nft
+
+def bench_hierarchy (n) :
+    """ Shaping for n mangle rules and a hierarchy with n / 20 leaf
+        classes in groups of 10.
+    """
+    r      = random.Random (815)
+    nleaf  = max (1, n // 20)
+    root   = Traffic_Class (100)
+    parent = None
+    for i in range (nleaf) :
+        if i % 10 == 0 :
+            parent = Traffic_Class (10, parent = root)
+        Traffic_Class \
+            (r.randint (1, 10), parent = parent, fwmark = '%s/0xffff' % (i + 1))
+    rules = []
+    for i in range (n) :
+        a = IP4_Address (0x0a000000 | r.getrandbits (24), r.randint (16, 32))
+        rules.append \
+            ( '-A PREROUTING -s %s/%s -j MARK --set-xmark 0x%x/0xffff'
+            % (a.dotted (), a.mask, r.randint (1, nleaf))
+            )
+    shaper = Shaper ('/sbin/tc', root)
+    rs     = Rule_Set ()
+    rs.parse (StringIO ('\n'.join (rules)))
+    timed \
+        ( 'Shaper generate (%s leaves, %s rules)' % (nleaf, n)
+        , shaper.generate, 100000, 'ifb0=eth0', None, False, None, rs
+        )
+    leaves = list (shaper.leaf_classes ())
+
+    def scan () :
+        return sum \
+            ( 1 for c in leaves for x in rs
+              if x.xmark == c.fwmark and not x.interface
+            )
+    # end def scan
+
+    def index () :
+        return sum (len (rs.for_mark (c.fwmark, 'eth0')) for c in leaves)
+    # end def index
+
+    n1 = timed \
+        ('rule scan per leaf (old) (%s x %s)' % (len (leaves), n), scan)
+    n2 = timed ('Rule_Set.for_mark (%s x %s)' % (len (leaves), n), index)
+    assert n1 == n2 == n
+# end def bench_hierarchy
+
+def bench_stream (n) :
+    """ Shaping for a deep hierarchy: a chain of 16 classes with
+        n / 16 leaf classes in total, output as string and streamed.
+    """
+    depth  = 16
+    root   = parent = Traffic_Class (100)
+    m      = 1
+    for d in range (depth) :
+        for i in range (max (1, n // depth)) :
+            Traffic_Class (1, parent = parent, fwmark = '%s' % m)
+            m += 1
+        parent = Traffic_Class (10, parent = parent)
+        Traffic_Class (1, parent = parent, fwmark = '%s' % m, is_default = d == 0)
+        m += 1
+    shaper = Shaper ('/sbin/tc', root)
+    shaper.generate (100000, 'eth0')
+
+    def peak (fun, * args) :
+        try :
+            import tracemalloc
+        except ImportError :
+            return
+        tracemalloc.start ()
+        fun (* args)
+        print ("Peak memory: %d kB" % (tracemalloc.get_traced_memory () [1] // 1024))
+        tracemalloc.stop ()
+    # end def peak
+
+    s = timed \
+        ( 'generate string (%s classes)' % m
+        , shaper.generate, 100000, 'eth0'
+        )
+    peak (shaper.generate, 100000, 'eth0')
+    print ("Output: %s lines" % len (s.split ('\n')))
+    with open (os.devnull, 'w') as f :
+        timed \
+            ( 'generate_to stream (%s classes)' % m
+            , shaper.generate_to, f, 100000, 'eth0'
+            )
+        peak (shaper.generate_to, f, 100000, 'eth0')
+# end def bench_stream
+
+def bench_multi (n) :
+    """ Generate and apply for 40 devices with n / 40 classes each,
+        sequentially with Shaper.apply and in parallel with
+        Multi_Shaper. As in bench_batch the devices don't exist, so tc
+        fails for all commands.
+    """
+    root = Traffic_Class (100)
+    for i in range (max (1, n // 40)) :
+        Traffic_Class \
+            (1, parent = root, fwmark = '%s/0xffff' % (i + 1), is_default = not i)
+    shaper  = Shaper ('/sbin/tc', root)
+    devices = dict (('nodev%s' % i, 1000 * (i + 1)) for i in range (40))
+
+    def sequential () :
+        for dev, kbit in sorted (devices.items ()) :
+            try :
+                shaper.apply (kbit, dev)
+            except Exec_Error :
+                pass
+    # end def sequential
+
+    timed ('Shaper.apply sequential (40 devices)', sequential)
+    m = Multi_Shaper (devices, shaper)
+    timed ('Multi_Shaper.apply (40 devices)', m.apply)
+    r = max (m.results.values (), key = lambda r : r.gen_time + r.apply_time)
+    print ("Slowest device: %s" % r)
+# end def bench_multi
+
+def bench_classify (n) :
+    """ Classify n random packets with the simulator for the linear
+        and the hash filter layout of n customer prefixes, both must
+        yield the same classes.
+    """
+    rules = []
+    for a, target in customer_prefixes (n) :
+        rules.append \
+            ( '-A PREROUTING -s %s/%s -j MARK --set-xmark 0x%s/0xf'
+            % (a.dotted (), a.mask, 1 + int (target [-1], 16) % 2)
+            )
+    rules = '\n'.join (rules)
+    root  = Traffic_Class (100)
+    Traffic_Class (50, parent = root, fwmark = '1/0xf')
+    Traffic_Class (50, parent = root, fwmark = '2/0xf', is_default = True)
+    r       = random.Random (4711)
+    packets = \
+        [ Packet
+            ( IP4_Address (0x0a000000 | r.getrandbits (19)), '192.168.0.1'
+            , 'tcp', r.randint (1024, 65535), 80
+            )
+          for i in range (n)
+        ]
+    result  = []
+    for layout in 'linear', 'hash' :
+        shaper = Shaper ('/sbin/tc', root, filter_layout = layout)
+        script = shaper.generate (10000, 'ifb0=eth0', StringIO (rules))
+        sim    = timed \
+            ( 'TC_Simulator %s (%s prefixes)' % (layout, n)
+            , TC_Simulator.from_script, script
+            )
+        result.append (timed \
+            ( 'classify %s (%s packets)' % (layout, n)
+            , sim.histogram, packets, 'eth0', True
+            ))
+        print ("Filters tested per packet: %.1f" % (float (sim.evaluated) / n))
+    assert result [0] == result [1]
+# end def bench_classify
+
+benchmarks = dict \
+    ( batch     = bench_batch
+    , classify  = bench_classify
+    , hash      = bench_hash
+    , hierarchy = bench_hierarchy
+    , layout    = bench_layout
+    , multi     = bench_multi
+    , nft       = bench_nft
+    , parse     = bench_parse
+    , stream    = bench_stream
+    )
+
+if __name__ == '__main__' :
+    cmd = ArgumentParser ()
+    cmd.add_argument \
+        ( 'benchmark'
+        , nargs   = '*'
+        , help    = 'Benchmarks to run, one of %s' % ', '.join (benchmarks)
+        )
+    cmd.add_argument \
+        ( '-n', '--count'
+        , type    = int
+        , default = 10000
+        , help    = 'Number of prefixes, default: %(default)s'
+        )
+    args = cmd.parse_args ()
+    for b in args.benchmark or sorted (benchmarks) :
+        benchmarks [b] (args.count)
@@ -24,16 +24,46 @@
 # ****************************************************************************
 
 from __future__          import print_function
-from rsclib.autosuper    import _autosuper
+import socket
+from binascii            import hexlify
+from bisect              import bisect_right
+from rsclib.autosuper    import _autosuper, autosuper
 from rsclib.pycompat     import with_metaclass, string_types, long_type, longpr
 from rsclib.pycompat     import assert_raises
 from rsclib.iter_recipes import xxrange as xrange
 from functools           import total_ordering
 
+if hasattr (int, 'from_bytes') :
+    def _bytes_to_int (b) :
+        return int.from_bytes (b, 'big')
+    # end def _bytes_to_int
+else :
+    def _bytes_to_int (b) :
+        return long_type (hexlify (b), 16)
+    # end def _bytes_to_int
+
+def _inet_pton (family, address) :
+    """ Strict parser for canonical address forms using the C library,
+        raises ValueError if not available (e.g. python2 on Windows).
+    """
+    try :
+        pton = socket.inet_pton
+    except AttributeError :
+        raise ValueError ("inet_pton not available")
+    return _bytes_to_int (pton (family, address))
+# end def _inet_pton
 
 mask_bits = \
     { 0 : 0, 128 : 1, 192 : 2, 224 : 3, 240 : 4, 248 : 5, 252 : 6, 254 : 7 }
 
+def _dotted_mask (n) :
+    m = ((1 << n) - 1) << (32 - n)
+    return '.'.join (str ((m >> s) & 255) for s in (24, 16, 8, 0))
+# end def _dotted_mask
+
+# Canonical dotted netmask to number of mask bits, e.g. 255.255.255.0: 24
+netmask_lengths = dict ((_dotted_mask (n), n) for n in range (33))
+
 def netmask_from_string (s) :
     """ Convert a netmask in dotted form to number of mask bits
     >>> netmask_from_string ('255.255.255.224')
@@ -44,7 +74,17 @@ def netmask_from_string (s) :
     32
     >>> netmask_from_string ('255.255.254.0')
     23
+    >>> netmask_from_string ('255.255.0254.00')
+    23
+    >>> netmask_from_string ('255.0.255.0')
+    Traceback (most recent call last):
+     ...
+    ValueError: IP4_Address: Syntax: Invalid Octet: 255 in 255.0.255.0
     """
+    try :
+        return netmask_lengths [s]
+    except KeyError :
+        pass
     mask = 0
     zero = False
     for n, octet in enumerate (s.split ('.'), 3) :
@@ -73,6 +113,23 @@ class _IP_Meta_ (_autosuper) :
         the object itself.
     """
 
+    def __init__ (cls, name, bases, dict) :
+        """ Compute the bit masks and inverted masks for all possible
+            mask lengths once per class: Instances only store ip and
+            mask and look up their masks in these tables.
+        """
+        super (_IP_Meta_, cls).__init__ (name, bases, dict)
+        bitlen = dict.get ('_bitlen')
+        if bitlen :
+            # long_type: Keep the type addresses had before on python2
+            allbits = long_type ((1 << bitlen) - 1)
+            cls._bitmasks = tuple \
+                ( long_type (((1 << m) - 1) << (bitlen - m))
+                  for m in range (bitlen + 1)
+                )
+            cls._invmasks = tuple (allbits ^ m for m in cls._bitmasks)
+    # end def __init__
+
     def __call__ (self, arg, * args, ** kw) :
         if isinstance (arg, self) :
             return arg
@@ -87,21 +144,24 @@ class _IP_Meta_ (_autosuper) :
 # end class _IP_Meta_
 
 class IP_Meta (with_metaclass (_IP_Meta_)) :
-    pass
+    __slots__ = ()
 # end class IP_Meta
 
 @total_ordering
 class IP_Address (IP_Meta) :
 
-    _bitlen = None
+    _bitlen   = None
+    # We only store ip and mask, bitmask and invmask are looked up in
+    # the per-class tables computed by the metaclass.
+    __slots__ = ('_ip', '_mask', '_hash')
 
     def __init__ (self, address, mask = None, strict_mask = False) :
         if mask is None :
             mask  = self._bitlen
-        self._mask = long_type (mask)
-        if self._mask < 0 or self._mask > self._bitlen :
+        mask = long_type (mask)
+        if mask < 0 or mask > self._bitlen :
             raise ValueError \
-                (self._esyntax_ ("Invalid netmask: %s" % self._mask))
+                (self._esyntax_ ("Invalid netmask: %s" % mask))
         if isinstance (address, string_types) :
             xadr = address.split ('/', 1)
             if len (xadr) > 1 :
@@ -109,18 +169,18 @@ class IP_Address (IP_Meta) :
                 if m < 0 or m > self._bitlen :
                     raise ValueError \
                         (self._esyntax_ ("Invalid netmask: %s" % m))
-                self._mask = min (self._mask, m)
+                mask = min (mask, m)
             self._from_string (xadr [0])
         else :
             self._ip = long_type (address)
         if self._ip >= (1 << self._bitlen) :
             raise ValueError (self._esyntax_ ("Invalid ip: %s" % address))
-        self._bitmask = ((1 << self._mask) - 1) << (self._bitlen - self._mask)
-        self._invmask = (~long_type (self._bitmask)) & ((1 << self._bitlen) - 1)
-        if strict_mask and (self._ip & self._bitmask) != self._ip :
+        self._mask = mask
+        bitmask    = self._bitmasks [mask]
+        if strict_mask and (self._ip & bitmask) != self._ip :
             raise ValueError \
                 (self._esyntax_ ("Bits to right of netmask not zero"))
-        self._ip &= self._bitmask
+        self._ip &= bitmask
     # end def __init__
 
     @property
@@ -130,9 +190,11 @@ class IP_Address (IP_Meta) :
 
     @property
     def bitmask (self) :
-        return self._bitmask
+        return self._bitmasks [self._mask]
     # end def bitmask
 
+    _bitmask = bitmask
+
     @property
     def _broadcast (self) :
         return self._ip | self._invmask
@@ -140,16 +202,18 @@ class IP_Address (IP_Meta) :
 
     @property
     def broadcast_address (self) :
-        return self.__class__ (self._broadcast)
+        return self._new (self._broadcast, self._bitlen)
     # end def broadcast_address
 
     broadcast = broadcast_address
 
     @property
     def invmask (self) :
-        return self._invmask
+        return self._invmasks [self._mask]
     # end def invmask
 
+    _invmask = invmask
+
     @property
     def ip (self) :
         return self._ip
@@ -164,25 +228,27 @@ class IP_Address (IP_Meta) :
 
     @property
     def net (self) :
-        return self.__class__ (self._ip)
+        return self._new (self._ip, self._bitlen)
     # end def net
 
     network = net
 
     @property
     def netblk (self) :
-        return [self.__class__ (x) for x in (self._ip, self._broadcast)]
+        bitlen = self._bitlen
+        return [self._new (x, bitlen) for x in (self._ip, self._broadcast)]
     # end def netblk
 
     @property
     def parent (self) :
         if self._mask > 0 :
-            return self.__class__ (self._ip, self._mask - 1)
+            mask = self._mask - 1
+            return self._new (self._ip & self._bitmasks [mask], mask)
     # end def parent
 
     @property
     def subnet_mask (self) :
-        return self.__class__ (self._bitmask)
+        return self._new (self._bitmasks [self._mask], self._bitlen)
     # end def subnet_mask
 
     netmask = subnet_mask
@@ -198,16 +264,21 @@ class IP_Address (IP_Meta) :
         other = self._cast_ (other)
         if not self._clscheck_ (other) :
             return False
-        return other.mask >= self.mask and self.ip == (other.ip & self.bitmask)
+        return \
+            (   other._mask >= self._mask
+            and self._ip == (other._ip & self._bitmasks [self._mask])
+            )
     # end def contains
 
     def overlaps (self, other) :
         other = self._cast_ (other)
         if not self._clscheck_ (other) :
             return False
+        sbm = self._bitmasks [self._mask]
+        obm = self._bitmasks [other._mask]
         return \
-            (  self.ip &  self.bitmask == other.ip &  self.bitmask
-            or self.ip & other.bitmask == other.ip & other.bitmask
+            (  self._ip & sbm == other._ip & sbm
+            or self._ip & obm == other._ip & obm
             )
     # end def overlaps
 
@@ -227,40 +298,63 @@ class IP_Address (IP_Meta) :
         inc = 1 << (self._bitlen - mask)
         if mask < self._mask :
             return
+        new = self._new
         # xrange doesn't support long ints :-( see xxrange import above
-        for i in xrange (0, self._broadcast - self._ip + 1, inc) :
-            yield self.__class__ (i + self._ip, mask)
+        for i in xrange (self._ip, self._broadcast + 1, inc) :
+            yield new (i, mask)
     # end def subnets
 
-    def __eq__ (self, other) :
-        if not self._clscheck_ (other) :
-            return type (self) == type (other)
-        return self.ip == other.ip and self.mask == other.mask
-    # end def __eq__
-
-    def __ne__ (self, other) :
-        return not self == other
-    # end def __ne__
-
     def __lt__ (self, other) :
-        if not self._clscheck_ (other) :
-            return id (type (self)) < id (type (other))
-        if self.ip == other.ip :
-            return self.mask < other.mask
-        return self.ip < other.ip
+        if other.__class__ is not self.__class__ :
+            if not self._clscheck_ (other) :
+                return id (type (self)) < id (type (other))
+        if self._ip == other._ip :
+            return self._mask < other._mask
+        return self._ip < other._ip
     # end def __lt__
 
     __contains__ = contains
 
+    def subnet_view (self, mask = None) :
+        """ Like subnets but returns a lazy sequence (a Subnet_View)
+            supporting indexing and slicing without constructing the
+            intermediate subnets. With the default mask this is a view
+            of all addresses of the network.
+        """
+        if mask is None :
+            mask = self._bitlen
+        if mask > self._bitlen :
+            raise ValueError (self._esyntax_ ("Invalid netmask: %s" % mask))
+        inc   = 1 << (self._bitlen - mask)
+        count = 0
+        if mask >= self._mask :
+            count = 1 << (mask - self._mask)
+        return Subnet_View (self.__class__, self._ip, count, inc, mask)
+    # end def subnet_view
+
     def __eq__ (self, other) :
-        other = self._cast_ (other)
-        if not self._clscheck_ (other) :
-            return False
-        return self.ip == other.ip and self.mask == other.mask
+        if other.__class__ is not self.__class__ :
+            other = self._cast_ (other)
+            if not self._clscheck_ (other) :
+                return False
+        return self._ip == other._ip and self._mask == other._mask
     # end def __eq__
 
     def __hash__ (self) :
-        return str (self).__hash__ ()
+        """ An address compares equal to its string form, so it must
+            hash like the string. The hash is computed once.
+            >>> a = IP4_Address ('10.0.0.1')
+            >>> len (set ((a, '10.0.0.1'))), hash (a) == hash ('10.0.0.1')
+            (1, True)
+            >>> d = {'2001:db8::/64' : 1}
+            >>> d [IP6_Address ('2001:db8::/64')] = 2
+            >>> d
+            {'2001:db8::/64': 2}
+        """
+        h = getattr (self, '_hash', None)
+        if h is None :
+            h = self._hash = hash (str (self))
+        return h
     # end def __hash__
 
     __iter__ = subnets
@@ -289,6 +383,48 @@ class IP_Address (IP_Meta) :
 
     __str__  = __repr__
 
+    @classmethod
+    def _new (cls, ip, mask) :
+        """ Create a new object without parsing and validation, used
+            internally where ip and mask are known to be good: The ip
+            must already have all bits right of the netmask cleared.
+        """
+        self = object.__new__ (cls)
+        self._ip   = ip
+        self._mask = mask
+        return self
+    # end def _new
+
+    @classmethod
+    def parse_many (cls, iterable, strict_mask = False) :
+        """ Parse many addresses (with optional '/mask') from iterable,
+            this is a generator. Canonical forms are converted with
+            inet_pton, only other forms (e.g. abbreviated '10.100/22'
+            for IPv4) and invalid input go through the normal
+            constructor, so semantics and error messages are the same.
+        """
+        bitlen   = cls._bitlen
+        bitmasks = cls._bitmasks
+        new      = cls._new
+        pton     = cls._pton
+        for adr in iterable :
+            try :
+                a, slash, m = adr.partition ('/')
+                ip   = pton (a)
+                mask = int (m) if slash else bitlen
+            except (socket.error, ValueError, TypeError, AttributeError) :
+                yield cls (adr, strict_mask = strict_mask)
+                continue
+            if mask < 0 or mask > bitlen :
+                yield cls (adr, strict_mask = strict_mask)
+                continue
+            bitmask = bitmasks [mask]
+            if strict_mask and (ip & bitmask) != ip :
+                yield cls (adr, strict_mask = strict_mask)
+                continue
+            yield new (ip & bitmask, mask)
+    # end def parse_many
+
     def _cast_ (self, other) :
         if not isinstance (other, self.__class__) :
             try :
@@ -554,6 +690,9 @@ class IP4_Address (IP_Address) :
         >>> d = dict.fromkeys ((i1, i2))
         >>> d
         {10.23.5.0/24: None}
+        >>> d [zoppel ('10.23.5.0/24')]
+        >>> hash (i1) == hash (IP6_Address (i1.ip, i1.mask))
+        False
         >>> IP4_Address ('1.2.3.4/33')
         Traceback (most recent call last):
          ...
@@ -585,9 +724,21 @@ class IP4_Address (IP_Address) :
         True
         >>> sub = 'argument must be a string'
         >>> assert_raises (TypeError, sub, IP6_Address, x1)
+        >>> adrs = ['10.100.10.5', '10.100.10.5/24', '10.100/22', '010.1.2.3']
+        >>> list (IP4_Address.parse_many (adrs))
+        [10.100.10.5, 10.100.10.0/24, 10.100.0.0/22, 10.1.2.3]
+        >>> list (IP4_Address.parse_many (['10.1.2.3/33']))
+        Traceback (most recent call last):
+         ...
+        ValueError: IP4_Address: Syntax: Invalid netmask: 33
+        >>> list (IP4_Address.parse_many (['10.1.2.3/24'], strict_mask = 1))
+        Traceback (most recent call last):
+         ...
+        ValueError: IP4_Address: Syntax: Bits to right of netmask not zero
     """
 
-    _bitlen = 32
+    _bitlen   = 32
+    __slots__ = ()
 
     def __init__ (self, address, mask = _bitlen, **kw) :
         if isinstance (mask, string_types) and len (mask) > 3 :
@@ -606,6 +757,11 @@ class IP4_Address (IP_Address) :
             )
     # end def as_tc_basic_u32
 
+    @staticmethod
+    def _pton (address) :
+        return _inet_pton (socket.AF_INET, address)
+    # end def _pton
+
     def dotted (self) :
         ip = self._ip
         r = []
@@ -1015,11 +1171,45 @@ class IP6_Address (IP_Address) :
         >>> x1 is x2
         True
         >>> assert_raises (TypeError, 'must be a string', IP4_Address, x1)
+
+        The string form is computed once and cached:
+        >>> a = IP6_Address ('1:0:0:2:0:0:3:0')
+        >>> str (a), str (a), a._str
+        ('1:0:0:2::3:0', '1:0:0:2::3:0', '1:0:0:2::3:0')
+        >>> IP6_Address ('1:2:3:4:5:6:7:8'), IP6_Address ('1:0:2:3:4:5:6:7')
+        (1:2:3:4:5:6:7:8, 1::2:3:4:5:6:7)
+        >>> IP6_Address ('::ffff:c000:280'), IP6_Address ('1::')
+        (::ffff:c000:280, 1::)
+        >>> adrs = ['2001:DB8::1', '2001:db8::1/64', '::ffff:c000:280']
+        >>> list (IP6_Address.parse_many (adrs))
+        [2001:db8::1, 2001:db8::/64, ::ffff:c000:280]
+        >>> list (IP6_Address.parse_many (['::ffff:192.0.2.128']))
+        Traceback (most recent call last):
+         ...
+        ValueError: IP6_Address: Syntax: Hex value too long: 192.0.2.128
     """
 
-    _bitlen = 128
+    _bitlen   = 128
+    __slots__ = ('_str',)
+
+    @staticmethod
+    def _pton (address) :
+        # inet_pton accepts embedded IPv4 addresses, we don't
+        if '.' in address :
+            raise ValueError ("No IPv4 part allowed")
+        return _inet_pton (socket.AF_INET6, address)
+    # end def _pton
 
     def _to_str (self) :
+        """ Cached string form, computed once by _format.
+        """
+        s = getattr (self, '_str', None)
+        if s is None :
+            s = self._str = self._format ()
+        return s
+    # end def _to_str
+
+    def _format (self) :
         r    = []
         ip   = self._ip
         moff = 0
@@ -1050,7 +1240,7 @@ class IP6_Address (IP_Address) :
             r [moff : moff + mlen] = [repl]
         r = ':'.join (reversed (r))
         return r
-    # end def _to_str
+    # end def _format
 
     def _from_string (self, adr) :
         """ Compute numeric ipv6 address from adr without netmask.
@@ -1123,6 +1313,661 @@ class IP6_Address (IP_Address) :
 
 # end class IP6_Address
 
+class Subnet_View (autosuper) :
+    """ Lazy sequence of networks of class cls with the given mask,
+        starting at ip start with increment step (which may be
+        negative), count is the number of networks. Networks are only
+        constructed when accessed, slicing returns another view. Note
+        that len () fails for views with more than sys.maxsize items
+        (easily reached for IPv6), use the len method in that case.
+        >>> v = IP4_Address ('10.23.0.0/16').subnet_view (24)
+        >>> v
+        Subnet_View (10.23.0.0/24, 256, 256)
+        >>> v.len (), len (v)
+        (256, 256)
+        >>> v [0], v [5], v [-1]
+        (10.23.0.0/24, 10.23.5.0/24, 10.23.255.0/24)
+        >>> v [256]
+        Traceback (most recent call last):
+         ...
+        IndexError: Subnet_View index out of range
+        >>> v [1:6:2]
+        Subnet_View (10.23.1.0/24, 3, 512)
+        >>> list (v [1:6:2])
+        [10.23.1.0/24, 10.23.3.0/24, 10.23.5.0/24]
+        >>> list (v [:-4:-1])
+        [10.23.255.0/24, 10.23.254.0/24, 10.23.253.0/24]
+        >>> list (v [10:5])
+        []
+        >>> IP4_Address ('10.23.42.0/24') in v, IP4_Address ('10.23.42.1') in v
+        (True, False)
+        >>> w = v [1:6:2]
+        >>> IP4_Address ('10.23.5.0/24') in w, int (w.index ('10.23.5.0/24'))
+        (True, 2)
+        >>> list (IP4_Address ('10.23.5.0/30').subnet_view ())
+        [10.23.5.0, 10.23.5.1, 10.23.5.2, 10.23.5.3]
+        >>> v = IP6_Address ('2001:db8::/32').subnet_view ()
+        >>> v.len () == 2 ** 96
+        True
+        >>> v [-1], v [2 ** 95]
+        (2001:db8:ffff:ffff:ffff:ffff:ffff:ffff, 2001:db8:8000::)
+        >>> v [2 ** 64 : 2 ** 64 + 2]
+        Subnet_View (2001:db8:0:1::, 2, 1)
+        >>> list (IP6_Address ('2001:db8::/32').subnet_view (31))
+        []
+    """
+
+    def __init__ (self, cls, start, count, step, mask) :
+        self.cls   = cls
+        self.start = start
+        self.count = count
+        self.step  = step
+        self.mask  = mask
+    # end def __init__
+
+    def index (self, address) :
+        address = self.cls (address)
+        if address._mask == self.mask and self.count :
+            idx, rest = divmod (address._ip - self.start, self.step)
+            if not rest and 0 <= idx < self.count :
+                return idx
+        raise ValueError ("%s not in %s" % (address, self))
+    # end def index
+
+    def len (self) :
+        return self.count
+    # end def len
+
+    def __contains__ (self, address) :
+        try :
+            self.index (address)
+        except (ValueError, TypeError) :
+            return False
+        return True
+    # end def __contains__
+
+    def _indices (self, idx) :
+        """ Like idx.indices (self.count) which raises OverflowError
+            on python2 for counts larger than sys.maxsize.
+        """
+        n    = self.count
+        step = 1 if idx.step is None else idx.step
+        if step == 0 :
+            raise ValueError ("slice step cannot be zero")
+        lower, upper = (0, n) if step > 0 else (-1, n - 1)
+        def clamp (v, default) :
+            if v is None :
+                return default
+            if v < 0 :
+                return max (v + n, lower)
+            return min (v, upper)
+        # end def clamp
+        if step > 0 :
+            return clamp (idx.start, lower), clamp (idx.stop, upper), step
+        return clamp (idx.start, upper), clamp (idx.stop, lower), step
+    # end def _indices
+
+    def __getitem__ (self, idx) :
+        if isinstance (idx, slice) :
+            start, stop, step = self._indices (idx)
+            if step > 0 :
+                count = (stop - start + step - 1) // step
+            else :
+                count = (start - stop - step - 1) // -step
+            return self.__class__ \
+                ( self.cls
+                , self.start + start * self.step
+                , max (count, 0)
+                , self.step * step
+                , self.mask
+                )
+        if idx < 0 :
+            idx += self.count
+        if idx < 0 or idx >= self.count :
+            raise IndexError ("Subnet_View index out of range")
+        return self.cls._new (self.start + idx * self.step, self.mask)
+    # end def __getitem__
+
+    def __iter__ (self) :
+        new  = self.cls._new
+        mask = self.mask
+        step = self.step
+        ip   = self.start
+        for i in xrange (self.count) :
+            yield new (ip, mask)
+            ip += step
+    # end def __iter__
+
+    def __len__ (self) :
+        return self.count
+    # end def __len__
+
+    def __repr__ (self) :
+        return '%s (%s, %s, %s)' % \
+            ( self.__class__.__name__
+            , self.cls._new (self.start, self.mask)
+            , self.count
+            , self.step
+            )
+    # end def __repr__
+
+# end class Subnet_View
+
+def _to_address (address) :
+    """ Convert strings to IP4_Address or IP6_Address (if it contains
+        a ':'), IP_Address objects are returned unchanged.
+    """
+    if isinstance (address, IP_Address) :
+        return address
+    if isinstance (address, string_types) :
+        if ':' in address :
+            return IP6_Address (address)
+        return IP4_Address (address)
+    raise TypeError ("Invalid address: %r" % (address,))
+# end def _to_address
+
+class _Prefix_Node (object) :
+    """ Node in a Prefix_Table, nodes that are not used only exist for
+        branching (glue nodes).
+    """
+    __slots__ = ('ip', 'mask', 'key', 'value', 'used', 'child')
+
+    def __init__ (self, ip, mask, key = None, value = None, used = False) :
+        self.ip    = ip
+        self.mask  = mask
+        self.key   = key
+        self.value = value
+        self.used  = used
+        self.child = [None, None]
+    # end def __init__
+
+# end class _Prefix_Node
+
+class Prefix_Table (autosuper) :
+    """ Map IP4_Address and IP6_Address networks to values. This is a
+        path-compressed radix tree (Patricia trie), lookup of the
+        longest matching prefix for an address needs at most bitlen
+        steps, independent of the number of prefixes stored. Keys may
+        be given as strings, these are converted to IP6_Address if
+        they contain a ':' and to IP4_Address otherwise.
+        >>> t = Prefix_Table ()
+        >>> t ['10.0.0.0/8']     = 'ten'
+        >>> t ['10.100.0.0/16']  = 'hundred'
+        >>> t ['10.100.10.0/24'] = 'office'
+        >>> t ['10.200.0.0/16']  = 'lab'
+        >>> t [IP6_Address ('2001:db8::/32')] = 'v6'
+        >>> len (t)
+        5
+        >>> t.longest_match ('10.100.10.23')
+        (10.100.10.0/24, 'office')
+        >>> t.longest_match ('10.100.11.23')
+        (10.100.0.0/16, 'hundred')
+        >>> t.longest_match ('10.1.1.1')
+        (10.0.0.0/8, 'ten')
+        >>> print (t.longest_match ('11.1.1.1'))
+        None
+        >>> t.longest_match ('2001:db8::1')
+        (2001:db8::/32, 'v6')
+        >>> t.lookup ('10.200.1.1')
+        'lab'
+        >>> t.lookup ('192.168.1.1', 'none')
+        'none'
+        >>> list (t.covering ('10.100.10.0/25'))
+        [(10.0.0.0/8, 'ten'), (10.100.0.0/16, 'hundred'), (10.100.10.0/24, 'office')]
+        >>> t ['10.100.0.0/16']
+        'hundred'
+        >>> t ['10.100.0.0/17']
+        Traceback (most recent call last):
+         ...
+        KeyError: 10.100.0.0/17
+        >>> '10.100.10.0/24' in t, '10.100.10.0/23' in t
+        (True, False)
+        >>> list (t)
+        [10.0.0.0/8, 10.100.0.0/16, 10.100.10.0/24, 10.200.0.0/16, 2001:db8::/32]
+        >>> del t ['10.100.0.0/16']
+        >>> t.longest_match ('10.100.11.23')
+        (10.0.0.0/8, 'ten')
+        >>> del t ['10.100.0.0/16']
+        Traceback (most recent call last):
+         ...
+        KeyError: 10.100.0.0/16
+        >>> t.insert ('10.100.10.128/25')
+        >>> list (t.items ())
+        [(10.0.0.0/8, 'ten'), (10.100.10.0/24, 'office'), (10.100.10.128/25, None), (10.200.0.0/16, 'lab'), (2001:db8::/32, 'v6')]
+        >>> for k in list (t) :
+        ...     del t [k]
+        >>> len (t), list (t), t.roots
+        (0, [], {})
+    """
+
+    def __init__ (self, items = ()) :
+        self.roots = {}
+        self.count = 0
+        if isinstance (items, dict) :
+            items = items.items ()
+        for k, v in items :
+            self [k] = v
+    # end def __init__
+
+    def covering (self, address) :
+        """ All prefixes containing the given address (or network),
+            from the least to the most specific, as (prefix, value).
+        """
+        key    = self._key (address)
+        bitlen = key._bitlen
+        masks  = key._bitmasks
+        ip     = key._ip
+        mask   = key._mask
+        node   = self.roots.get (bitlen)
+        while \
+            (   node is not None
+            and node.mask <= mask
+            and ip & masks [node.mask] == node.ip
+            ) :
+            if node.used :
+                yield node.key, node.value
+            if node.mask == mask :
+                break
+            node = node.child [(ip >> (bitlen - 1 - node.mask)) & 1]
+    # end def covering
+
+    def get (self, key, default = None) :
+        node, path = self._find (key)
+        if node is None :
+            return default
+        return node.value
+    # end def get
+
+    def insert (self, key, value = None) :
+        self [key] = value
+    # end def insert
+
+    def items (self) :
+        for node in self._nodes () :
+            yield node.key, node.value
+    # end def items
+
+    def keys (self) :
+        for node in self._nodes () :
+            yield node.key
+    # end def keys
+
+    def longest_match (self, address) :
+        """ Return the most specific prefix containing address as a
+            tuple (prefix, value) or None if there is no such prefix.
+        """
+        result = None
+        for result in self.covering (address) :
+            pass
+        return result
+    # end def longest_match
+
+    def lookup (self, address, default = None) :
+        """ Value of the longest matching prefix or default
+        """
+        match = self.longest_match (address)
+        if match is None :
+            return default
+        return match [1]
+    # end def lookup
+
+    def values (self) :
+        for node in self._nodes () :
+            yield node.value
+    # end def values
+
+    def _find (self, key) :
+        """ Find node with exactly the given key, return the node (None
+            if not found) and the path to it as a list of (node, bit).
+        """
+        key    = self._key (key)
+        bitlen = key._bitlen
+        masks  = key._bitmasks
+        ip     = key._ip
+        mask   = key._mask
+        path   = []
+        node   = self.roots.get (bitlen)
+        while \
+            (   node is not None
+            and node.mask <= mask
+            and ip & masks [node.mask] == node.ip
+            ) :
+            if node.mask == mask :
+                if node.used :
+                    return node, path
+                break
+            bit = (ip >> (bitlen - 1 - node.mask)) & 1
+            path.append ((node, bit))
+            node = node.child [bit]
+        return None, path
+    # end def _find
+
+    def _key (self, key) :
+        return _to_address (key)
+    # end def _key
+
+    def _nodes (self) :
+        """ Iterate over used nodes in sort order of their keys
+        """
+        for bitlen in sorted (self.roots) :
+            stack = [self.roots [bitlen]]
+            while stack :
+                node = stack.pop ()
+                if node.used :
+                    yield node
+                for c in reversed (node.child) :
+                    if c is not None :
+                        stack.append (c)
+    # end def _nodes
+
+    def __contains__ (self, key) :
+        return self._find (key) [0] is not None
+    # end def __contains__
+
+    def __delitem__ (self, key) :
+        node, path = self._find (key)
+        if node is None :
+            raise KeyError (self._key (key))
+        bitlen     = node.key._bitlen
+        node.used  = False
+        node.key   = node.value = None
+        self.count -= 1
+        # Remove nodes no longer needed for branching
+        while not node.used :
+            children = [c for c in node.child if c is not None]
+            if len (children) > 1 :
+                break
+            repl = children [0] if children else None
+            if path :
+                parent, bit = path.pop ()
+                parent.child [bit] = repl
+            else :
+                parent = None
+                if repl is None :
+                    del self.roots [bitlen]
+                else :
+                    self.roots [bitlen] = repl
+            # Stop if the parent didn't lose a child
+            if repl is not None or parent is None :
+                break
+            node = parent
+    # end def __delitem__
+
+    def __getitem__ (self, key) :
+        node, path = self._find (key)
+        if node is None :
+            raise KeyError (self._key (key))
+        return node.value
+    # end def __getitem__
+
+    def __iter__ (self) :
+        return self.keys ()
+    # end def __iter__
+
+    def __len__ (self) :
+        return self.count
+    # end def __len__
+
+    def __setitem__ (self, key, value) :
+        key    = self._key (key)
+        bitlen = key._bitlen
+        masks  = key._bitmasks
+        ip     = key._ip
+        mask   = key._mask
+        parent = None
+        bit    = 0
+        node   = self.roots.get (bitlen)
+        while \
+            (   node is not None
+            and node.mask <= mask
+            and ip & masks [node.mask] == node.ip
+            ) :
+            if node.mask == mask :
+                if not node.used :
+                    node.used   = True
+                    self.count += 1
+                node.key   = key
+                node.value = value
+                return
+            parent = node
+            bit    = (ip >> (bitlen - 1 - node.mask)) & 1
+            node   = node.child [bit]
+        new = _Prefix_Node (ip, mask, key, value, True)
+        self.count += 1
+        if node is not None :
+            # node is not a prefix of key: either key is a prefix of
+            # node or we need a branching node for both
+            common = bitlen - (ip ^ node.ip).bit_length ()
+            common = min (common, mask, node.mask)
+            if common == mask :
+                new.child [(node.ip >> (bitlen - 1 - mask)) & 1] = node
+            else :
+                glue = _Prefix_Node (ip & masks [common], common)
+                b    = (ip >> (bitlen - 1 - common)) & 1
+                glue.child [b]     = new
+                glue.child [1 - b] = node
+                new = glue
+        if parent is None :
+            self.roots [bitlen] = new
+        else :
+            parent.child [bit] = new
+    # end def __setitem__
+
+# end class Prefix_Table
+
+def _range_to_cidrs (first, last, bitlen) :
+    """ Minimal list of (ip, mask) networks covering first to last
+    >>> list (_range_to_cidrs (0, 255, 32))
+    [(0, 24)]
+    >>> list (_range_to_cidrs (1, 6, 32))
+    [(1, 32), (2, 31), (4, 31), (6, 32)]
+    >>> list (_range_to_cidrs (0, 2 ** 128 - 1, 128))
+    [(0, 0)]
+    """
+    while first <= last :
+        span  = (last - first + 1).bit_length () - 1
+        if first :
+            span = min (span, (first & -first).bit_length () - 1)
+        yield first, bitlen - span
+        first += 1 << span
+# end def _range_to_cidrs
+
+class IP_Set (autosuper) :
+    """ A set of IP addresses, IPv4 and IPv6 can be mixed. Internally
+        this is a sorted list of disjoint, non-adjacent intervals of
+        addresses for each address bit length, so creation from a list
+        of networks is O(n log n) and the set operations are linear in
+        the number of intervals. Iteration yields the minimal list of
+        networks (CIDR blocks) covering the set. Networks can be given
+        as strings like for Prefix_Table.
+        >>> s = IP_Set (('10.0.0.0/25', '10.0.0.128/25', '10.0.1.0/24'))
+        >>> list (s)
+        [10.0.0.0/23]
+        >>> nets = ('10.0.0.0/24', '10.0.0.5', '10.0.1.1', '2001:db8::/33')
+        >>> s = IP_Set (nets)
+        >>> s.cidrs ()
+        [10.0.0.0/24, 10.0.1.1, 2001:db8::/33]
+        >>> s.num_addresses == 257 + 2 ** 95
+        True
+        >>> '10.0.0.23' in s, '10.0.0.0/23' in s, '10.0.2.0' in s
+        (True, False, False)
+        >>> (s | IP_Set (['10.0.1.0/24', '2001:db8:8000::/33'])).cidrs ()
+        [10.0.0.0/23, 2001:db8::/32]
+        >>> (s & IP_Set (['10.0.0.128/26', '10.0.1.0/30'])).cidrs ()
+        [10.0.0.128/26, 10.0.1.1]
+        >>> (s - IP_Set (['10.0.0.0/26', '10.0.0.128/25'])).cidrs ()
+        [10.0.0.64/26, 10.0.1.1, 2001:db8::/33]
+        >>> (IP_Set (['10.0.0.0/30']) - IP_Set (['10.0.0.1'])).cidrs ()
+        [10.0.0.0, 10.0.0.2/31]
+        >>> (IP_Set (['10.0.0.0/30']) ^ IP_Set (['10.0.0.2/31'])).cidrs ()
+        [10.0.0.0/31]
+        >>> IP_Set (['10.0.0.0/31']) == IP_Set (['10.0.0.0', '10.0.0.1'])
+        True
+        >>> IP_Set (['10.0.0.1']) <= s, s <= IP_Set (['10.0.0.1'])
+        (True, False)
+        >>> bool (IP_Set ()), bool (s)
+        (False, True)
+        >>> IP_Set (['10.0.0.0/24', '10.0.2.0/23'])
+        IP_Set ([10.0.0.0/24, 10.0.2.0/23])
+    """
+
+    classes = {32 : IP4_Address, 128 : IP6_Address}
+
+    def __init__ (self, networks = ()) :
+        self.intervals = {}
+        by_bitlen = {}
+        for n in networks :
+            n = _to_address (n)
+            if n._bitlen not in by_bitlen :
+                by_bitlen [n._bitlen] = []
+            by_bitlen [n._bitlen].append ((n._ip, n._ip | n.invmask))
+        for bitlen, iv in by_bitlen.items () :
+            iv.sort ()
+            self.intervals [bitlen] = self._merge (iv)
+    # end def __init__
+
+    @property
+    def num_addresses (self) :
+        return sum \
+            ( last - first + 1
+              for iv in self.intervals.values ()
+              for first, last in iv
+            )
+    # end def num_addresses
+
+    def cidrs (self) :
+        return list (self)
+    # end def cidrs
+
+    def difference (self, other) :
+        result = self._new ()
+        for bitlen, iv in self.intervals.items () :
+            oiv = other.intervals.get (bitlen)
+            if not oiv :
+                result.intervals [bitlen] = list (iv)
+                continue
+            r = []
+            n = len (oiv)
+            j = 0
+            for first, last in iv :
+                while j < n and oiv [j][1] < first :
+                    j += 1
+                k = j
+                while first <= last and k < n and oiv [k][0] <= last :
+                    ofirst, olast = oiv [k]
+                    if ofirst > first :
+                        r.append ((first, ofirst - 1))
+                    first = max (first, olast + 1)
+                    k += 1
+                if first <= last :
+                    r.append ((first, last))
+            if r :
+                result.intervals [bitlen] = r
+        return result
+    # end def difference
+
+    def intersection (self, other) :
+        result = self._new ()
+        for bitlen, iv in self.intervals.items () :
+            oiv = other.intervals.get (bitlen)
+            if not oiv :
+                continue
+            r = []
+            i = j = 0
+            while i < len (iv) and j < len (oiv) :
+                first = max (iv [i][0], oiv [j][0])
+                last  = min (iv [i][1], oiv [j][1])
+                if first <= last :
+                    r.append ((first, last))
+                if iv [i][1] < oiv [j][1] :
+                    i += 1
+                else :
+                    j += 1
+            if r :
+                result.intervals [bitlen] = r
+        return result
+    # end def intersection
+
+    def issubset (self, other) :
+        return not self.difference (other)
+    # end def issubset
+
+    def symmetric_difference (self, other) :
+        return self.union (other).difference (self.intersection (other))
+    # end def symmetric_difference
+
+    def union (self, other) :
+        result = self._new ()
+        for bitlen in set (self.intervals) | set (other.intervals) :
+            iv = self.intervals.get (bitlen, []) \
+               + other.intervals.get (bitlen, [])
+            iv.sort ()
+            result.intervals [bitlen] = self._merge (iv)
+        return result
+    # end def union
+
+    def _merge (self, intervals) :
+        """ Merge sorted intervals that overlap or are adjacent
+        """
+        result = []
+        for first, last in intervals :
+            if result and first <= result [-1][1] + 1 :
+                if last > result [-1][1] :
+                    result [-1] = (result [-1][0], last)
+            else :
+                result.append ((first, last))
+        return result
+    # end def _merge
+
+    def _new (self) :
+        return self.__class__ ()
+    # end def _new
+
+    def __contains__ (self, address) :
+        address = _to_address (address)
+        iv      = self.intervals.get (address._bitlen, ())
+        first   = address._ip
+        last    = first | address.invmask
+        idx     = bisect_right (iv, (first, 1 << address._bitlen)) - 1
+        return idx >= 0 and iv [idx][0] <= first and last <= iv [idx][1]
+    # end def __contains__
+
+    def __eq__ (self, other) :
+        if not isinstance (other, IP_Set) :
+            return False
+        return self.intervals == other.intervals
+    # end def __eq__
+
+    def __iter__ (self) :
+        for bitlen in sorted (self.intervals) :
+            new = self.classes [bitlen]._new
+            for first, last in self.intervals [bitlen] :
+                for ip, mask in _range_to_cidrs (first, last, bitlen) :
+                    yield new (ip, mask)
+    # end def __iter__
+
+    def __ne__ (self, other) :
+        return not self == other
+    # end def __ne__
+
+    def __nonzero__ (self) :
+        return bool (self.intervals)
+    # end def __nonzero__
+    __bool__ = __nonzero__
+
+    def __repr__ (self) :
+        return '%s (%s)' % (self.__class__.__name__, self.cidrs ())
+    # end def __repr__
+
+    __and__ = intersection
+    __le__  = issubset
+    __or__  = union
+    __sub__ = difference
+    __xor__ = symmetric_difference
+
+# end class IP_Set
+
+
 
 if __name__ == "__main__" :
 
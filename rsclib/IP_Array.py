@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# Copyright (C) 2026 Dr. Ralf Schlatterbeck Open Source Consulting.
+# Reichergasse 131, A-3411 Weidling.
+# Web: http://www.runtux.com Email: office@runtux.com
+# All rights reserved
+# ****************************************************************************
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ****************************************************************************
+
+
+# Vectorised IPv4 address arrays, this needs numpy.
+
+from __future__          import print_function
+import numpy
+from rsclib.autosuper    import autosuper
+from rsclib.IP_Address   import IP4_Address
+
+class IP4_Array (autosuper) :
+    """ Array of IPv4 addresses with netmasks. Addresses are stored in
+        a numpy uint32 array, masks in an uint8 array. Like for
+        IP4_Address all bits to the right of the netmask are zero.
+        The array can be created from an iterable of IP4_Address
+        objects or strings or directly from numpy arrays.
+        >>> a = IP4_Array (['10.1.2.3', '10.1.3.4/24', '192.168.1.1', '10/8'])
+        >>> a
+        IP4_Array ([10.1.2.3, 10.1.3.0/24, 192.168.1.1, 10.0.0.0/8])
+        >>> len (a), a [1], a [-1]
+        (4, 10.1.3.0/24, 10.0.0.0/8)
+        >>> a [1:3]
+        IP4_Array ([10.1.3.0/24, 192.168.1.1])
+        >>> a.contained_in ('10.1.0.0/16').tolist ()
+        [True, True, False, False]
+        >>> a [a.contained_in (IP4_Address ('10.0.0.0/8'))].to_list ()
+        [10.1.2.3, 10.1.3.0/24, 10.0.0.0/8]
+        >>> a.contains ('10.1.3.77').tolist ()
+        [False, True, False, True]
+        >>> a.mask_to (16)
+        IP4_Array ([10.1.0.0/16, 10.1.0.0/16, 192.168.0.0/16, 10.0.0.0/8])
+        >>> a.mask_to (16).unique ()
+        IP4_Array ([10.0.0.0/8, 10.1.0.0/16, 192.168.0.0/16])
+        >>> a.sorted ()
+        IP4_Array ([10.0.0.0/8, 10.1.2.3, 10.1.3.0/24, 192.168.1.1])
+        >>> for net, members in a.group_by_prefix (16) :
+        ...     print (net, members)
+        10.0.0.0/16 IP4_Array ([10.0.0.0/8])
+        10.1.0.0/16 IP4_Array ([10.1.2.3, 10.1.3.0/24])
+        192.168.0.0/16 IP4_Array ([192.168.1.1])
+        >>> b = IP4_Array (ip = [0x0a000001, 0x0a000102], mask = 24)
+        >>> b.to_list (), b.bitmask.tolist () == [0xffffff00] * 2
+        ([10.0.0.0/24, 10.0.1.0/24], True)
+        >>> IP4_Array (['10.0.0.1/33'])
+        Traceback (most recent call last):
+         ...
+        ValueError: IP4_Address: Syntax: Invalid netmask: 33
+        >>> IP4_Array (ip = [1], mask = [33])
+        Traceback (most recent call last):
+         ...
+        ValueError: IP4_Array: Invalid netmask
+    """
+
+    bitmasks = numpy.array (IP4_Address._bitmasks, dtype = numpy.uint32)
+
+    def __init__ (self, addresses = (), ip = None, mask = None) :
+        if ip is None :
+            addresses = list (IP4_Address.parse_many (addresses))
+            n    = len (addresses)
+            ip   = numpy.fromiter \
+                ((a._ip   for a in addresses), dtype = numpy.uint32, count = n)
+            mask = numpy.fromiter \
+                ((a._mask for a in addresses), dtype = numpy.uint8,  count = n)
+        else :
+            ip = numpy.asarray (ip, dtype = numpy.uint32)
+            if mask is None :
+                mask = 32
+            mask = numpy.asarray (mask)
+            if mask.size and (mask.min () < 0 or mask.max () > 32) :
+                raise ValueError ("IP4_Array: Invalid netmask")
+            mask = numpy.broadcast_to (mask.astype (numpy.uint8), ip.shape)
+            ip   = ip & self.bitmasks [mask]
+        self.ip   = ip
+        self.mask = mask
+    # end def __init__
+
+    @property
+    def bitmask (self) :
+        return self.bitmasks [self.mask]
+    # end def bitmask
+
+    def contained_in (self, network) :
+        """ Boolean array: Which entries are contained in network
+        """
+        network = IP4_Address (network)
+        return \
+            ( (self.mask >= network.mask)
+            & ((self.ip & numpy.uint32 (network.bitmask)) == network.ip)
+            )
+    # end def contained_in
+
+    def contains (self, other) :
+        """ Boolean array: Which entries contain the other address (or
+            network), this is IP4_Address.contains for each entry.
+        """
+        other = IP4_Address (other)
+        return \
+            ( (self.mask <= other.mask)
+            & ((numpy.uint32 (other.ip) & self.bitmask) == self.ip)
+            )
+    # end def contains
+
+    def group_by_prefix (self, prefix) :
+        """ Group entries by the network with the given prefix length
+            they belong to. Returns a sorted list of (network, array)
+            pairs. Entries with a shorter mask are grouped by the
+            network with the given prefix length containing their
+            network address.
+        """
+        nets   = self.ip & self.bitmasks [prefix]
+        order  = numpy.argsort (nets, kind = 'stable')
+        nets   = nets [order]
+        uniq, starts = numpy.unique (nets, return_index = True)
+        result = []
+        for net, idx in zip (uniq.tolist (), numpy.split (order, starts [1:])) :
+            result.append ((IP4_Address._new (net, prefix), self [idx]))
+        return result
+    # end def group_by_prefix
+
+    def mask_to (self, prefix) :
+        """ New array with all masks reduced to at most prefix, the
+            addresses are masked accordingly.
+        """
+        return self.__class__ \
+            (ip = self.ip, mask = numpy.minimum (self.mask, prefix))
+    # end def mask_to
+
+    def sorted (self) :
+        """ New array sorted like a list of IP4_Address
+        """
+        return self [numpy.argsort (self._key (), kind = 'stable')]
+    # end def sorted
+
+    def to_list (self) :
+        return list (self)
+    # end def to_list
+
+    def unique (self) :
+        """ Sorted array of unique addresses (networks)
+        """
+        key = numpy.unique (self._key ())
+        return self.__class__ \
+            ( ip   = (key >> 8).astype (numpy.uint32)
+            , mask = (key & 0xff).astype (numpy.uint8)
+            )
+    # end def unique
+
+    def _key (self) :
+        """ Combine ip and mask into one sort key
+        """
+        return (self.ip.astype (numpy.uint64) << 8) | self.mask
+    # end def _key
+
+    def __getitem__ (self, idx) :
+        if isinstance (idx, slice) or not numpy.isscalar (idx) :
+            return self.__class__ (ip = self.ip [idx], mask = self.mask [idx])
+        return IP4_Address._new (int (self.ip [idx]), int (self.mask [idx]))
+    # end def __getitem__
+
+    def __iter__ (self) :
+        new = IP4_Address._new
+        for ip, mask in zip (self.ip.tolist (), self.mask.tolist ()) :
+            yield new (ip, mask)
+    # end def __iter__
+
+    def __len__ (self) :
+        return len (self.ip)
+    # end def __len__
+
+    def __repr__ (self) :
+        return '%s (%s)' % (self.__class__.__name__, self.to_list ())
+    # end def __repr__
+
+# end class IP4_Array
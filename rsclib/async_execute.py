@@ -0,0 +1,578 @@
+#!/usr/bin/python3
+# Copyright (C) 2026 Dr. Ralf Schlatterbeck Open Source Consulting.
+# Reichergasse 131, A-3411 Weidling.
+# Web: http://www.runtux.com Email: office@runtux.com
+# All rights reserved
+# ****************************************************************************
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ****************************************************************************
+
+# The pipeline model of execute (children, fork-points via Tee,
+# stderr processes, Exec_Process and Echo_Process) on top of asyncio.
+# External commands are started with asyncio.create_subprocess_exec,
+# in-process methods run as coroutines in the event loop instead of a
+# forked copy of the interpreter, data is moved by stream pumps. Many
+# pipelines can run concurrently in one event loop with timeouts and
+# cancellation. Needs python3.
+
+import os
+import sys
+import signal
+import asyncio
+import locale
+from   time           import time
+from   rsclib.execute import Log
+
+class Pipe (object):
+    """ Bounded in-memory pipe feeding an in-process method. The
+        writer blocks when maxsize chunks are queued, so a slow
+        method exerts back-pressure on its input. A method that
+        terminates early discards the rest of its input.
+
+        >>> async def test ():
+        ...     p = Pipe (maxsize = 3)
+        ...     await p.write (b'a')
+        ...     await p.write (b'')
+        ...     await p.write (b'b')
+        ...     await p.close ()
+        ...     return [await p.read () for i in range (4)]
+        >>> asyncio.run (test ())
+        [b'a', b'b', b'', b'']
+    """
+
+    def __init__ (self, maxsize = 16):
+        self.queue     = asyncio.Queue (maxsize)
+        self.eof       = False
+        self.discarded = False
+    # end def __init__
+
+    async def write (self, data):
+        if data and not self.discarded:
+            await self.queue.put (data)
+    # end def write
+
+    async def close (self):
+        if not self.discarded:
+            await self.queue.put (b'')
+    # end def close
+
+    async def read (self):
+        """ Return next chunk, an empty bytes object on EOF """
+        if self.eof:
+            return b''
+        data = await self.queue.get ()
+        if not data:
+            self.eof = True
+        return data
+    # end def read
+
+    def discard (self):
+        self.discarded = True
+        self.eof       = True
+        while not self.queue.empty ():
+            self.queue.get_nowait ()
+    # end def discard
+
+# end class Pipe
+
+class _Stream_Sink (object):
+    """ Write to stdin of a subprocess, a dead reader is ignored """
+
+    def __init__ (self, writer):
+        self.writer = writer
+    # end def __init__
+
+    async def write (self, data):
+        if self.writer is None:
+            return
+        try:
+            self.writer.write (data)
+            await self.writer.drain ()
+        except (BrokenPipeError, ConnectionResetError):
+            self.writer = None
+    # end def write
+
+    async def close (self):
+        if self.writer is not None:
+            self.writer.close ()
+            self.writer = None
+    # end def close
+
+# end class _Stream_Sink
+
+class _Buffer_Sink (object):
+    """ Collect a PIPE output in memory """
+
+    def __init__ (self):
+        self.chunks = []
+    # end def __init__
+
+    async def write (self, data):
+        self.chunks.append (data)
+    # end def write
+
+    async def close (self):
+        pass
+    # end def close
+
+    @property
+    def value (self):
+        return b''.join (self.chunks)
+    # end def value
+
+# end class _Buffer_Sink
+
+class _File_Sink (object):
+    """ Output of an in-process method to a file (or our stdout) """
+
+    def __init__ (self, file):
+        self.file = file
+    # end def __init__
+
+    async def write (self, data):
+        # The file may be a full pipe, don't block the event loop
+        loop = asyncio.get_event_loop ()
+        await loop.run_in_executor (None, self._write, data)
+    # end def write
+
+    def _write (self, data):
+        self.file.flush ()
+        fd  = self.file.fileno ()
+        buf = memoryview (data)
+        while len (buf):
+            buf = buf [os.write (fd, buf):]
+    # end def _write
+
+    async def close (self):
+        pass
+    # end def close
+
+# end class _File_Sink
+
+class _Tee_Sink (object):
+    """ Fan-out to several sinks, a slow sink slows down all """
+
+    def __init__ (self, sinks):
+        self.sinks = sinks
+    # end def __init__
+
+    async def write (self, data):
+        await asyncio.gather (* (s.write (data) for s in self.sinks))
+    # end def write
+
+    async def close (self):
+        await asyncio.gather (* (s.close () for s in self.sinks))
+    # end def close
+
+# end class _Tee_Sink
+
+class Process (Log):
+    """ A node in an asynchronous pipeline. The file descriptors can
+        take the same values as in execute.Process: None inherits (or
+        for in-process methods: uses) our own, 'PIPE' collects the
+        output for communicate (or for stdin: input is fed by
+        communicate or via the sink returned by run), otherwise it
+        must be a file object.
+        After wait the status is set, it is encoded like the status
+        from os.wait so that execute.exitstatus can be used.
+    """
+
+    def __init__ \
+        (self
+        , name    = None
+        , stdin   = None
+        , stdout  = None
+        , stderr  = None
+        , bufsize = 65536
+        , **kw
+        ):
+        self.stdin        = stdin
+        self.stdout       = stdout
+        self.stderr       = stderr
+        self.bufsize      = bufsize
+        self.name         = name or self.clsname
+        self.children     = []
+        self.stderr_child = None
+        self.tee          = None
+        self.status       = None
+        self.start_time   = None
+        self.end_time     = None
+        self.tasks        = []
+        self.outputs      = {}
+        self.__super.__init__ (log_prefix = self.name, **kw)
+    # end def __init__
+
+    def append (self, child):
+        assert self.stdout is None
+        assert child.stdin is None
+        if self.children:
+            assert len (self.children) == 1
+            if not self.tee:
+                self.tee = Tee (self.children, bufsize = self.bufsize)
+                self.children = [self.tee]
+            self.tee.children.append (child)
+        else:
+            self.children.append (child)
+    # end def append
+
+    def set_stderr_process (self, child):
+        assert self.stderr is None
+        assert self.stderr_child is None
+        assert child.stdin is None
+        self.stderr_child = child
+    # end def set_stderr_process
+
+    @property
+    def elapsed (self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+    # end def elapsed
+
+    def processes (self):
+        """ All processes of the pipeline in tree order """
+        yield self
+        if self.stderr_child:
+            for p in self.stderr_child.processes ():
+                yield p
+        for c in self.children:
+            for p in c.processes ():
+                yield p
+    # end def processes
+
+    async def run (self):
+        """ Start the pipeline. If our stdin is a PIPE the sink for
+            writing to it is returned, it must be closed when done.
+        """
+        return await self._start (self.stdin == 'PIPE')
+    # end def run
+
+    async def wait (self):
+        # Not gather: Cancelling it would also cancel the tasks
+        tasks = [t for p in self.processes () for t in p.tasks]
+        if tasks:
+            await asyncio.wait (tasks)
+        for t in tasks:
+            t.result ()
+    # end def wait
+
+    def kill (self):
+        """ Kill all subprocesses and cancel in-process methods """
+        for p in self.processes ():
+            p._kill ()
+    # end def kill
+
+    async def communicate (self, input = None, timeout = None):
+        """ Run the pipeline, feed input (if any) to our stdin and
+            return all stdout and stderr PIPE outputs in tree order
+            like execute.Method_Process.communicate. When the timeout
+            (in seconds) expires or we are cancelled, the pipeline is
+            killed and the exception is re-raised.
+        """
+        assert input is None or self.stdin == 'PIPE'
+        try:
+            return await asyncio.wait_for (self._communicate (input), timeout)
+        except BaseException:
+            self.kill ()
+            tasks = [t for p in self.processes () for t in p.tasks]
+            if tasks:
+                await asyncio.wait (tasks)
+            raise
+    # end def communicate
+
+    async def _communicate (self, input):
+        enc  = locale.getpreferredencoding (False)
+        sink = await self.run ()
+        if sink:
+            if input:
+                if not isinstance (input, bytes):
+                    input = input.encode (enc)
+                await sink.write (input)
+            await sink.close ()
+        await self.wait ()
+        out = []
+        err = []
+        for p in self.processes ():
+            if 'stdout' in p.outputs:
+                out.append (p.outputs ['stdout'].value)
+            if 'stderr' in p.outputs:
+                err.append (p.outputs ['stderr'].value)
+        return b''.join (out).decode (enc), b''.join (err).decode (enc)
+    # end def _communicate
+
+    async def _outputs (self):
+        """ Start children, return sinks for our stdout and stderr.
+            The sink is None if the output goes to a file or is
+            inherited.
+        """
+        out = err = None
+        if self.children:
+            out = await self.children [0]._start (True)
+        elif self.stdout == 'PIPE':
+            out = self.outputs ['stdout'] = _Buffer_Sink ()
+        if self.stderr_child:
+            err = await self.stderr_child._start (True)
+        elif self.stderr == 'PIPE':
+            err = self.outputs ['stderr'] = _Buffer_Sink ()
+        return out, err
+    # end def _outputs
+
+    async def _pump (self, reader, sink):
+        while True:
+            data = await reader.read (self.bufsize)
+            if not data:
+                break
+            await sink.write (data)
+        await sink.close ()
+    # end def _pump
+
+    def _done (self, status):
+        self.status   = status
+        self.end_time = time ()
+        if status:
+            self.log.info ("%s: status %s" % (self.name, status))
+    # end def _done
+
+    async def _start (self, piped):
+        """ Start this process and its children, return the sink for
+            our stdin if piped is set (a parent or communicate feeds
+            us), None otherwise.
+        """
+        raise NotImplementedError
+    # end def _start
+
+    def _kill (self):
+        for t in self.tasks:
+            t.cancel ()
+    # end def _kill
+
+# end class Process
+
+class Tee (Process):
+    """ A fork-point in the pipeline, copies its input to all children.
+        There is no process for this, the data is written to all
+        children by the pump feeding the Tee.
+    """
+
+    def __init__ (self, children, **kw):
+        self.__super.__init__ (**kw)
+        self.children = children
+    # end def __init__
+
+    async def _start (self, piped):
+        assert piped
+        self.start_time = time ()
+        sinks = [await c._start (True) for c in self.children]
+        self._done (0)
+        return _Tee_Sink (sinks)
+    # end def _start
+
+# end class Tee
+
+class Method_Process (Process):
+    """ Runs a coroutine method in our event loop, it is called with
+        a Pipe for reading its input (None if no input is piped to
+        it) and a sink for its output: the sink has coroutine methods
+        write (for bytes) and close. The sink for stderr is available
+        as stderr_sink. The method either is passed as the keyword
+        argument method or overridden in a derived class.
+
+        >>> async def upper (stdin, stdout):
+        ...     while True:
+        ...         data = await stdin.read ()
+        ...         if not data:
+        ...             break
+        ...         await stdout.write (data.upper ())
+        >>> p = Method_Process (method = upper, stdin = 'PIPE')
+        >>> p.append (Exec_Process ('/bin/cat', stdout = 'PIPE'))
+        >>> asyncio.run (p.communicate ('hello\\n'))
+        ('HELLO\\n', '')
+    """
+
+    def __init__ (self, name = None, **kw):
+        if 'method' in kw:
+            self.method = kw.pop ('method')
+        if not name:
+            name = self.method.__name__
+        self.__super.__init__ (name = name, **kw)
+    # end def __init__
+
+    async def method (self, stdin, stdout):
+        raise NotImplementedError
+    # end def method
+
+    async def _start (self, piped):
+        self.start_time  = time ()
+        out, err         = await self._outputs ()
+        self.stderr_sink = err or _File_Sink (self.stderr or sys.stderr)
+        out   = out or _File_Sink (self.stdout or sys.stdout)
+        stdin = None
+        if piped:
+            stdin = Pipe ()
+        else:
+            assert self.stdin is None
+        self.tasks.append \
+            (asyncio.ensure_future (self._run_method (stdin, out)))
+        return stdin
+    # end def _start
+
+    async def _run_method (self, stdin, stdout):
+        status = 0
+        try:
+            await self.method (stdin, stdout)
+        except asyncio.CancelledError:
+            # Killed: Report like a process killed by SIGKILL
+            status = int (signal.SIGKILL)
+            raise
+        except Exception as cause:
+            self.log.error ("%s: %s" % (self.name, cause))
+            status = 1 << 8
+        finally:
+            if stdin:
+                stdin.discard ()
+            await stdout.close ()
+            await self.stderr_sink.close ()
+            self._done (status)
+    # end def _run_method
+
+# end class Method_Process
+
+class Echo_Process (Method_Process):
+    """ Simply echo a message given in constructor to stdout.
+        Useful for specifying a constant input to a pipeline.
+
+        >>> p = Echo_Process ('one\\ntwo\\n')
+        >>> p.append (Exec_Process ('/bin/cat', stdout = 'PIPE'))
+        >>> p.append (Exec_Process \\
+        ...     ( '/usr/bin/tail', ('tail', '-n', '1')
+        ...     , stdout = 'PIPE', stderr = 'PIPE'
+        ...     ))
+        >>> asyncio.run (p.communicate ())
+        ('one\\ntwo\\ntwo\\n', '')
+    """
+
+    def __init__ (self, message, **kw):
+        self.message = message
+        self.__super.__init__ (method = self.echo, **kw)
+    # end def __init__
+
+    async def echo (self, stdin, stdout):
+        message = self.message
+        if not isinstance (message, bytes):
+            message = message.encode (locale.getpreferredencoding (False))
+        await stdout.write (message)
+    # end def echo
+
+# end class Echo_Process
+
+class Exec_Process (Process):
+    """ Process that execs a subcommand, args includes the command name
+        (argv [0]) like in execute.Exec_Process.
+
+        >>> p = Exec_Process \\
+        ...     ( '/bin/sh', ('sh', '-c', 'echo out; echo err >&2; exit 3')
+        ...     , stdout = 'PIPE'
+        ...     )
+        >>> p.set_stderr_process \\
+        ...     (Exec_Process ('/usr/bin/tr', ('tr', 'e', 'E'), stdout = 'PIPE'))
+        >>> asyncio.run (p.communicate ())
+        ('out\\nErr\\n', '')
+        >>> p.status, p.stderr_child.status
+        (768, 0)
+
+        Several pipelines run concurrently in one event loop, a
+        pipeline running into its timeout is killed:
+
+        >>> async def both ():
+        ...     event = asyncio.Event ()
+        ...     async def waiter (stdin, stdout):
+        ...         await event.wait ()
+        ...         await stdout.write (b'done\\n')
+        ...     async def setter (stdin, stdout):
+        ...         event.set ()
+        ...     p1 = Method_Process (method = waiter, stdout = 'PIPE')
+        ...     p2 = Method_Process (method = setter)
+        ...     return await asyncio.gather \\
+        ...         (p1.communicate (timeout = 10), p2.communicate ())
+        >>> asyncio.run (both ())
+        [('done\\n', ''), ('', '')]
+        >>> p = Exec_Process ('/bin/sleep', ('sleep', '10'), stdout = 'PIPE')
+        >>> async def timeout ():
+        ...     try:
+        ...         await p.communicate (timeout = 0.1)
+        ...     except asyncio.TimeoutError:
+        ...         print ("timeout")
+        >>> asyncio.run (timeout ())
+        timeout
+        >>> p.status
+        9
+        >>> async def forever (stdin, stdout):
+        ...     await asyncio.sleep (10)
+        >>> p = Method_Process (method = forever, stdout = 'PIPE')
+        >>> asyncio.run (timeout ())
+        timeout
+        >>> p.status
+        9
+    """
+
+    def __init__ (self, cmd, args = None, name = None, **kw):
+        self.cmd  = cmd
+        self.args = args
+        self.proc = None
+        if not args:
+            self.args = [cmd]
+        self.__super.__init__ (name = name or cmd, **kw)
+    # end def __init__
+
+    async def _start (self, piped):
+        self.start_time = time ()
+        out, err  = await self._outputs ()
+        pipe      = asyncio.subprocess.PIPE
+        self.proc = await asyncio.create_subprocess_exec \
+            ( * self.args
+            , executable = self.cmd
+            , stdin      = pipe if piped else self.stdin
+            , stdout     = pipe if out   else self.stdout
+            , stderr     = pipe if err   else self.stderr
+            )
+        if out:
+            self.tasks.append \
+                (asyncio.ensure_future (self._pump (self.proc.stdout, out)))
+        if err:
+            self.tasks.append \
+                (asyncio.ensure_future (self._pump (self.proc.stderr, err)))
+        self.tasks.append (asyncio.ensure_future (self._wait ()))
+        if piped:
+            return _Stream_Sink (self.proc.stdin)
+    # end def _start
+
+    async def _wait (self):
+        rc = await self.proc.wait ()
+        # Encode like os.wait
+        self._done (rc << 8 if rc >= 0 else -rc)
+    # end def _wait
+
+    def _kill (self):
+        for t in self.tasks [:-1]:
+            t.cancel ()
+        if self.proc and self.proc.returncode is None:
+            self.proc.kill ()
+    # end def _kill
+
+# end class Exec_Process
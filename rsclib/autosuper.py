@@ -12,7 +12,34 @@ class _autosuper (type) :
     # end def __init__
 # end class _autosuper
 
-class autosuper (with_metaclass (_autosuper)) :
+class slotted_autosuper (with_metaclass (_autosuper)) :
+    """ Base for autosuper classes that use __slots__, instances of
+        autosuper itself have a __dict__.
+    >>> from autosuper import slotted_autosuper
+    >>> class Z (slotted_autosuper) :
+    ...     __slots__ = ('a',)
+    >>> z = Z ()
+    >>> z.b = 1
+    Traceback (most recent call last):
+     ...
+    AttributeError: 'Z' object has no attribute 'b'
+    """
+
+    __slots__ = ()
+
+    def __init__ (self, *args, **kw) :
+        try :
+            oc =  self.__super.__init__.__objclass__
+        except AttributeError :
+            oc = None
+        if oc is object :
+            self.__super.__init__ ()
+        else :
+            self.__super.__init__ (*args, **kw)
+    # end def __init__
+# end class slotted_autosuper
+
+class autosuper (slotted_autosuper) :
     """ Test new autsuper magic
     >>> from autosuper import autosuper
     >>> class X (autosuper, dict) :
@@ -28,15 +55,4 @@ class autosuper (with_metaclass (_autosuper)) :
     >>> Y((x,1) for x in range(23))
     class Y
     """
-
-    def __init__ (self, *args, **kw) :
-        try :
-            oc =  self.__super.__init__.__objclass__
-        except AttributeError :
-            oc = None
-        if oc is object :
-            self.__super.__init__ ()
-        else :
-            self.__super.__init__ (*args, **kw)
-    # end def __init__
 # end class autosuper
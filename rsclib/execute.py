@@ -30,11 +30,19 @@ import logging
 import errno
 import signal
 import atexit
+import fcntl
+import locale
 from   copy             import copy
+from   time             import time, sleep
 from   logging.handlers import SysLogHandler
 from   traceback        import format_exc
 from   subprocess       import Popen, PIPE
 from   rsclib.autosuper import autosuper
+from   rsclib.pycompat  import text_type
+try:
+    import selectors
+except ImportError:
+    selectors = None
 
 class Exec_Error (RuntimeError): pass
 
@@ -239,6 +247,8 @@ class Process (Log):
           stderr) this file descriptor
         - A non-zero value must be a normal file object where the fileno()
           can be extracted and used in dup2
+        After wait the start_time and end_time of the process are set,
+        elapsed is the time it was running.
     """
 
     by_pid      = {}
@@ -271,6 +281,8 @@ class Process (Log):
         self.stderr_child  = None
         self.tee           = None
         self.pid           = None
+        self.start_time    = None
+        self.end_time      = None
         self.stdin_w       = None
         self.stdout_r      = None
         self.stderr_r      = None
@@ -309,6 +321,7 @@ class Process (Log):
             self.stderr_r = os.fdopen (pipe [0], 'r')
             rclose.append (self.stderr_r)
             self.close_stderr = True
+        self.start_time = time ()
         pid = os.fork ()
         if pid: # parent
             self.pid = pid
@@ -428,18 +441,58 @@ class Process (Log):
     @classmethod
     def wait (cls):
         while cls.by_pid:
-            pid, status = os.wait ()
-            if pid > 0:
-                process = cls.by_pid [pid]
-                if status:
-                    process.log.info \
-                        ( "pid: %s: %s"
-                        % (pid, exitstatus (process.name, status))
-                        )
-                process.status = status
-                del cls.by_pid [pid]
+            cls.wait_one ()
     # end def wait
 
+    @classmethod
+    def wait_one (cls, processes = None):
+        """ Wait for one of the processes (default: all our processes)
+            to terminate, return it. Only the pids of these processes
+            are waited for, the exit status of other children (e.g.
+            started via Popen) is left alone. A single process is
+            waited for with a blocking os.waitpid, several processes
+            are polled with os.waitpid with a sleep between rounds that
+            starts at 1ms and backs off to at most 50ms, so a process
+            may be reaped up to 50ms after it terminated.
+        """
+        if processes is None:
+            processes = cls.by_pid.values ()
+        processes = list (processes)
+        if not processes:
+            raise ValueError ("No process to wait for")
+        if len (processes) == 1:
+            pid, status = os.waitpid (processes [0].pid, 0)
+        else:
+            delay = 0.001
+            while 1:
+                for p in processes:
+                    pid, status = os.waitpid (p.pid, os.WNOHANG)
+                    if pid:
+                        break
+                else:
+                    sleep (delay)
+                    delay = min (delay * 2, 0.05)
+                    continue
+                break
+        process = cls.by_pid [pid]
+        if status:
+            process.log.info \
+                ( "pid: %s: %s"
+                % (pid, exitstatus (process.name, status))
+                )
+        process.status   = status
+        process.end_time = time ()
+        del cls.by_pid [pid]
+        return process
+    # end def wait_one
+
+    @property
+    def elapsed (self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+    # end def elapsed
+
     def _add_buffer_process (self, found = False):
         if self.stderr == 'PIPE':
             self.log.debug ("found stderr PIPE: %s", self.name)
@@ -477,6 +530,73 @@ class Process (Log):
         return ''.join (sout_l), ''.join (serr_l)
     # end def _read_outputs
 
+    def _output_files (self, stdouts, stderrs):
+        """ Collect read ends of stdout/stderr PIPEs in tree order """
+        if self.stderr_r:
+            stderrs.append (self.stderr_r)
+        if self.stdout_r:
+            stdouts.append (self.stdout_r)
+        for c in self.children:
+            c._output_files (stdouts, stderrs)
+    # end def _output_files
+
+    def _drain_outputs (self, input = None):
+        """ Read all stdout/stderr PIPEs of the process tree
+            concurrently (and write input to our stdin PIPE if given)
+            with a selector in the parent. No stream can fill up and
+            block the pipeline while we wait for another one. Outputs
+            are returned joined in tree order like in _read_outputs.
+        """
+        stdouts = []
+        stderrs = []
+        self._output_files (stdouts, stderrs)
+        files   = dict ((f.fileno (), f) for f in stdouts + stderrs)
+        chunks  = dict ((fd, []) for fd in files)
+        stdouts = [f.fileno () for f in stdouts]
+        stderrs = [f.fileno () for f in stderrs]
+        sel     = selectors.DefaultSelector ()
+        for fd in files:
+            sel.register (fd, selectors.EVENT_READ)
+        if self.stdin_w:
+            if input:
+                inbuf = memoryview (input)
+                os.set_blocking (self.stdin_w.fileno (), False)
+                sel.register (self.stdin_w.fileno (), selectors.EVENT_WRITE)
+            else:
+                self.stdin_w.close ()
+        while sel.get_map ():
+            for key, events in sel.select ():
+                fd = key.fd
+                if events & selectors.EVENT_WRITE:
+                    try:
+                        n = os.write (fd, inbuf [:self.bufsize * 16])
+                    except BlockingIOError:
+                        continue
+                    except OSError as cause:
+                        # Reader died, discard rest of input
+                        if cause.errno != errno.EPIPE:
+                            raise
+                        self.log.debug ("%s: stdin closed" % self.name)
+                        n = len (inbuf)
+                    inbuf = inbuf [n:]
+                    if not len (inbuf):
+                        sel.unregister (fd)
+                        self.stdin_w.close ()
+                    continue
+                buf = os.read (fd, self.bufsize * 16)
+                if buf:
+                    chunks [fd].append (buf)
+                else:
+                    self.log.debug ("EOF on fd %s" % fd)
+                    sel.unregister (fd)
+                    files [fd].close ()
+        sel.close ()
+        enc = locale.getpreferredencoding (False)
+        stdout = b''.join (b for fd in stdouts for b in chunks [fd])
+        stderr = b''.join (b for fd in stderrs for b in chunks [fd])
+        return stdout.decode (enc), stderr.decode (enc)
+    # end def _drain_outputs
+
     def __repr__ (self):
         r = []
         r.append ('%s:' % self.name)
@@ -497,6 +617,13 @@ class Process (Log):
 class Tee (Process):
     """ A tee in a pipe (like the unix command "tee" but copies to several
         sub-processes)
+        Data is copied in binary on the raw file descriptors, the
+        buffer is at least as large as the capacity of the input pipe
+        (if it can be determined) so that a full pipe is moved in one
+        go. The Linux tee(2) system call is not available from python,
+        so fan-out needs one read and a write per child. When only one
+        child is left (the others died) the data is moved with
+        os.splice without copying to user space if available.
     """
     def __init__ (self, children, **kw):
         self.stdouts  = {}
@@ -504,35 +631,69 @@ class Tee (Process):
         self.children = children
     # end def __init__
 
+    @staticmethod
+    def pipe_size (fd):
+        """ Capacity of pipe fd or None if unknown (or not a pipe) """
+        try:
+            return fcntl.fcntl (fd, fcntl.F_GETPIPE_SZ)
+        except (AttributeError, IOError, OSError):
+            return None
+    # end def pipe_size
+
     def method (self):
-        while 1:
-            buf = sys.stdin.read (self.bufsize)
+        # We handle dead children ourselves, don't get killed
+        signal.signal (signal.SIGPIPE, signal.SIG_IGN)
+        infd    = sys.stdin.fileno ()
+        bufsize = max (self.bufsize, self.pipe_size (infd) or 0)
+        splice  = hasattr (os, 'splice')
+        stdouts = dict \
+            ((f.fileno (), (f, c)) for f, c in self.stdouts.items () if c)
+        self.log.debug ("Tee: bufsize %s" % bufsize)
+        while stdouts:
+            if splice and len (stdouts) == 1:
+                outfd = list (stdouts) [0]
+                try:
+                    n = os.splice (infd, outfd, bufsize)
+                except OSError as cause:
+                    if cause.errno == errno.EINVAL:
+                        # Neither side is a pipe, use read/write
+                        splice = False
+                    else:
+                        self._dead (stdouts, outfd, cause)
+                    continue
+                if not n:
+                    self.log.debug ("Tee: empty splice, terminating")
+                    return
+                continue
+            buf = os.read (infd, bufsize)
             if not buf:
                 self.log.debug ("Tee: empty read, terminating")
                 return
-            # use items () here, we want to modify dict
-            written = False
-            for stdout, child in self.stdouts.items ():
-                if not child:
-                    continue
+            for outfd in list (stdouts):
                 try:
-                    stdout.write (buf)
-                    written = True
-                    #self.log.debug ("written: %s" % len (buf))
-                except IOError as cause:
-                    # this client died, no longer try to send to it
-                    if cause.errno != errno.EPIPE:
-                        raise
-                    self.log.debug ("%s: dead" % child.name)
-                    stdout.close ()
-                    del self.stdouts [stdout]
-            # still clients existing?
-            if not written:
-                if len (self.stdouts):
-                    self.log.err ("All children had sigpipe ?!?")
-                return
+                    self._write (outfd, buf)
+                except OSError as cause:
+                    self._dead (stdouts, outfd, cause)
+        self.log.error ("All children had sigpipe ?!?")
     # end def method
 
+    def _dead (self, stdouts, outfd, cause):
+        """ This client died, no longer try to send to it """
+        if cause.errno != errno.EPIPE:
+            raise cause
+        f, child = stdouts.pop (outfd)
+        self.log.debug ("%s: dead" % child.name)
+        f.close ()
+        del self.stdouts [f]
+    # end def _dead
+
+    @staticmethod
+    def _write (fd, buf):
+        buf = memoryview (buf)
+        while len (buf):
+            buf = buf [os.write (fd, buf):]
+    # end def _write
+
 # end class Tee
 
 class Method_Process (Process):
@@ -563,11 +724,32 @@ class Method_Process (Process):
     # end def append
 
     def communicate (self, input = None):
+        """ Run the process tree, feed input (if any) to our stdin and
+            return all stdout and stderr PIPE outputs in tree order.
+            All pipe ends are drained concurrently in the parent, so
+            large outputs on several streams do not deadlock.
+
+            Without the selectors module (python2) we fall back to
+            decoupling additional streams with a Buffer_Process each.
+        """
         assert input is None or self.stdin == 'PIPE'
+        if selectors is None:
+            return self._communicate_buffered (input)
+        if self.stdin == 'PIPE' and input is None:
+            self.stdin = None
+        if isinstance (input, text_type):
+            input = input.encode (locale.getpreferredencoding (False))
+        self.run ()
+        stdout, stderr = self._drain_outputs (input)
+        self.wait ()
+        return stdout, stderr
+    # end def communicate
+
+    def _communicate_buffered (self, input = None):
         p = self
         if self.stdin == 'PIPE':
             self.stdin = None
-            if self.input is not None:
+            if input is not None:
                 p = Echo_Process (message = str (input))
                 p.append (self)
         # Add a Buffer_Process for each PIPE output in tree order.
@@ -578,7 +760,7 @@ class Method_Process (Process):
         stdout, stderr = self._read_outputs ()
         p.wait ()
         return stdout, stderr
-    # end def communicate
+    # end def _communicate_buffered
 
     def set_stderr_process (self, child):
         assert self.stderr is None
@@ -0,0 +1,775 @@
+#!/usr/bin/python3
+# Copyright (C) 2026 Dr. Ralf Schlatterbeck Open Source Consulting.
+# Reichergasse 131, A-3411 Weidling.
+# Web: http://www.runtux.com Email: office@runtux.com
+# All rights reserved
+# ****************************************************************************
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ****************************************************************************
+
+
+# Simulate the packet classification of a tc configuration generated
+# by trafficshape, no root privileges (or even a Linux kernel) needed.
+
+from __future__          import print_function
+import re
+import shlex
+import struct
+from rsclib.autosuper    import autosuper, slotted_autosuper
+from rsclib.IP_Address   import IP4_Address
+from rsclib.pycompat     import StringIO
+from rsclib.trafficshape import Batch_Writer
+
+HEADER_LEN = 64
+protocols  = dict (icmp = 1, tcp = 6, udp = 17)
+u32_word   = struct.Struct ('>I').unpack_from
+readers    = \
+    { 'u8'  : struct.Struct ('>B').unpack_from
+    , 'u16' : struct.Struct ('>H').unpack_from
+    , 'u32' : u32_word
+    }
+sizes      = dict (u8 = 1, u16 = 2, u32 = 4)
+
+def handle (s) :
+    """ Major and minor number of a tc handle or classid, numbers are
+        hex like in tc.
+        >>> handle ('1:a'), handle ('ffff:'), handle ('1:2:')
+        ((1, 10), (65535, 0), (1, 2))
+    """
+    l = s.split (':')
+    return int (l [0] or '0', 16), int (l [1] or '0', 16)
+# end def handle
+
+def classid (s) :
+    """ Canonical form of a classid
+        >>> classid ('0001:0A')
+        '1:a'
+    """
+    return '%x:%x' % handle (s)
+# end def classid
+
+def u32_key (size, value, mask, offset) :
+    """ Match on size bytes at offset as an aligned 32-bit word like the
+        kernel does, returns offset, mask and value.
+        >>> ['0x%x' % k for k in u32_key ('u8', 6, 0xff, 9)]
+        ['0x8', '0xff0000', '0x60000']
+        >>> ['0x%x' % k for k in u32_key ('u16', 0x16, 0xffff, 0x16)]
+        ['0x14', '0xffff', '0x16']
+        >>> u32_key ('u16', 1, 0xffff, 3)
+        Traceback (most recent call last):
+         ...
+        ValueError: u16 at 3 crosses a 32-bit boundary
+    """
+    n = sizes [size]
+    if offset % 4 + n > 4 :
+        raise ValueError \
+            ("%s at %s crosses a 32-bit boundary" % (size, offset))
+    if offset + 4 > HEADER_LEN :
+        raise ValueError ("Offset %s not in packet header" % offset)
+    shift = 8 * (4 - n - offset % 4)
+    mask  = (mask & ((1 << (8 * n)) - 1)) << shift
+    return offset & ~3, mask, (value << shift) & mask
+# end def u32_key
+
+class Packet (slotted_autosuper) :
+    """ Synthetic IPv4 packet, only the headers needed for
+        classification are built (IPv4 header without options
+        followed by the start of the TCP, UDP or ICMP header). The
+        length is the IP total length (the pkt_len seen by tc on an
+        ethernet device), frag is the fragment offset field.
+        >>> p = Packet ('10.1.2.3', '10.2.0.1', 'tcp', 1024, 22, flags = 0x10)
+        >>> p
+        Packet (10.1.2.3, 10.2.0.1, tcp, 1024, 22, length=100)
+        >>> ['%02x' % p.header [i] for i in (0, 3, 9, 12, 19, 21, 23, 33)]
+        ['45', '64', '06', '0a', '01', '00', '16', '10']
+        >>> p = Packet ('10.1.2.3', '10.2.0.1', 'icmp', icmp_type = 8)
+        >>> p.header [9], p.header [20]
+        (1, 8)
+    """
+    __slots__ = \
+        ( 'src', 'dst', 'proto', 'sport', 'dport', 'length', 'mark'
+        , 'header'
+        )
+
+    def __init__ \
+        ( self, src, dst
+        , proto     = 'tcp'
+        , sport     = 0
+        , dport     = 0
+        , length    = 100
+        , mark      = 0
+        , flags     = 0
+        , icmp_type = 0
+        , icmp_code = 0
+        , frag      = 0
+        ) :
+        self.src    = IP4_Address (src)
+        self.dst    = IP4_Address (dst)
+        self.proto  = protocols.get (proto, proto)
+        self.sport  = sport
+        self.dport  = dport
+        self.length = length
+        self.mark   = mark
+        h = self.header = bytearray (HEADER_LEN)
+        struct.pack_into \
+            ( '>BBHHHBBHII', h, 0
+            , 0x45, 0, length, 0, frag, 64, self.proto, 0
+            , self.src.ip, self.dst.ip
+            )
+        if self.proto == 1 :
+            struct.pack_into ('>BB', h, 20, icmp_type, icmp_code)
+        else :
+            struct.pack_into ('>HH', h, 20, sport, dport)
+        if self.proto == 6 :
+            struct.pack_into ('>BB', h, 32, 0x50, flags)
+    # end def __init__
+
+    def __repr__ (self) :
+        names = dict ((v, k) for k, v in protocols.items ())
+        return 'Packet (%s, %s, %s, %s, %s, length=%s)' % \
+            ( self.src, self.dst, names.get (self.proto, self.proto)
+            , self.sport, self.dport, self.length
+            )
+    # end def __repr__
+    __str__ = __repr__
+
+# end class Packet
+
+class Filter_Result (slotted_autosuper) :
+    """ What happens when a filter matches: The classid and the
+        actions, marks is a list of (value, mask, xor) from action
+        xt/ipt -j MARK, redirect is the device of action mirred.
+    """
+    __slots__ = ('classid', 'marks', 'redirect')
+
+    def __init__ (self, classid = None, marks = (), redirect = None) :
+        self.classid  = classid
+        self.marks    = tuple (marks)
+        self.redirect = redirect
+    # end def __init__
+
+    def apply (self, mark) :
+        for value, mask, xor in self.marks :
+            if xor :
+                mark = (mark & ~mask) ^ value
+            else :
+                mark = (mark & ~mask) | value
+        return mark & 0xffffffff
+    # end def apply
+
+# end class Filter_Result
+
+class Basic_Filter (autosuper) :
+    """ Filters of kind basic with the same prio, the ematch expression
+        is compiled to a function of the packet header, mark and
+        length. Like in the kernel the relations are evaluated from
+        left to right and evaluation stops at the first 'and' after a
+        false result or the first 'or' after a true result, so 'a and
+        b or c' is 'a and (b or c)'.
+        >>> f = Basic_Filter ()
+        >>> m = f.compile ('meta(pkt_len gt 100) and not u32 (u8 6 0xff at 9)')
+        >>> tcp = Packet ('1.1.1.1', '2.2.2.2', 'tcp', length = 500).header
+        >>> udp = Packet ('1.1.1.1', '2.2.2.2', 'udp', length = 500).header
+        >>> m (tcp, 0, 500), m (udp, 0, 500), m (udp, 0, 50)
+        (False, True, False)
+        >>> m = f.compile ('meta(fwmark eq 1) and meta(pkt_len lt 9) or (cmp(u16 at 2 gt 7))')
+        >>> m (tcp, 1, 0), m (tcp, 1, 500), m (tcp, 0, 0)
+        (True, True, False)
+        >>> f.compile ('meta(vlan eq 1)')
+        Traceback (most recent call last):
+         ...
+        ValueError: Unsupported ematch: meta(vlan eq 1)
+    """
+
+    kind     = 'basic'
+    tokenize = re.compile (r'\s*(?:(\w+)\s*\(([^()]*)\)|(\(|\)|and|or|not))')
+    ops      = \
+        { 'eq' : lambda a, b : a == b
+        , 'gt' : lambda a, b : a >  b
+        , 'lt' : lambda a, b : a <  b
+        }
+
+    def __init__ (self) :
+        self.filters = []
+    # end def __init__
+
+    def add (self, expr, result) :
+        self.filters.append ((self.compile (expr), result))
+    # end def add
+
+    def classify (self, hdr, mark, length) :
+        n = 0
+        for match, result in self.filters :
+            n += 1
+            if match (hdr, mark, length) :
+                return result, n
+        return None, n
+    # end def classify
+
+    def compile (self, expr) :
+        tokens = []
+        pos    = 0
+        expr   = expr.strip ()
+        while pos < len (expr) :
+            m = self.tokenize.match (expr, pos)
+            if not m :
+                raise ValueError ("Invalid ematch: %s" % expr)
+            tokens.append (m.group (3) or (m.group (1), m.group (2)))
+            pos = m.end ()
+        tokens.reverse ()
+        match = self.sequence (tokens, expr)
+        if tokens :
+            raise ValueError ("Invalid ematch: %s" % expr)
+        return match
+    # end def compile
+
+    def sequence (self, tokens, expr) :
+        """ Parse terms joined by 'and' or 'or' from the reversed list
+            of tokens up to a closing parenthesis.
+        """
+        terms = []
+        while True :
+            invert = False
+            if tokens and tokens [-1] == 'not' :
+                tokens.pop ()
+                invert = True
+            if not tokens :
+                raise ValueError ("Invalid ematch: %s" % expr)
+            t = tokens.pop ()
+            if t == '(' :
+                term = self.sequence (tokens, expr)
+                if not tokens or tokens.pop () != ')' :
+                    raise ValueError ("Invalid ematch: %s" % expr)
+            elif isinstance (t, tuple) :
+                term = self.ematch (t [0], t [1].split ())
+            else :
+                raise ValueError ("Invalid ematch: %s" % expr)
+            if invert :
+                term = self.negate (term)
+            rel = None
+            if tokens and tokens [-1] in ('and', 'or') :
+                rel = tokens.pop ()
+            terms.append ((term, rel))
+            if rel is None :
+                break
+        if len (terms) == 1 :
+            return terms [0][0]
+        def match (hdr, mark, length) :
+            for term, rel in terms :
+                r = term (hdr, mark, length)
+                if rel is None or (r if rel == 'or' else not r) :
+                    return r
+        # end def match
+        return match
+    # end def sequence
+
+    @staticmethod
+    def negate (term) :
+        return lambda hdr, mark, length : not term (hdr, mark, length)
+    # end def negate
+
+    def ematch (self, kind, args) :
+        """ Compile a single ematch, args are the words inside the
+            parentheses.
+        """
+        text = '%s(%s)' % (kind, ' '.join (args))
+        try :
+            if kind == 'u32' and len (args) == 5 and args [3] == 'at' :
+                off, mask, val = u32_key \
+                    ( args [0], int (args [1], 0), int (args [2], 0)
+                    , int (args [4], 0)
+                    )
+                return lambda hdr, mark, length : \
+                    u32_word (hdr, off) [0] & mask == val
+            if kind == 'cmp' and args [1] == 'at' and args [-2] in self.ops :
+                read = readers [args [0]]
+                off  = int (args [2], 0)
+                mask = (1 << (8 * sizes [args [0]])) - 1
+                if args [3] == 'mask' :
+                    mask &= int (args [4], 0)
+                elif len (args) != 5 :
+                    raise ValueError (text)
+                op   = self.ops [args [-2]]
+                val  = int (args [-1], 0)
+                if off + sizes [args [0]] > HEADER_LEN :
+                    raise ValueError ("Offset %s not in packet header" % off)
+                return lambda hdr, mark, length : \
+                    op (read (hdr, off) [0] & mask, val)
+            if kind == 'meta' and args [-2] in self.ops :
+                op  = self.ops [args [-2]]
+                val = int (args [-1], 0)
+                if args [0] == 'fwmark' :
+                    mask = 0xffffffff
+                    if args [1] == 'mask' :
+                        mask = int (args [2], 0)
+                    elif len (args) != 3 :
+                        raise ValueError (text)
+                    return lambda hdr, mark, length : op (mark & mask, val)
+                if args [0] == 'pkt_len' and len (args) == 3 :
+                    return lambda hdr, mark, length : op (length, val)
+        except (IndexError, KeyError) :
+            pass
+        raise ValueError ("Unsupported ematch: %s" % text)
+    # end def ematch
+
+# end class Basic_Filter
+
+class FW_Filter (autosuper) :
+    """ Filters of kind fw with the same prio: A hash lookup of the
+        mark (masked with the mask of the first filter).
+    """
+
+    kind = 'fw'
+
+    def __init__ (self) :
+        self.mask    = None
+        self.results = {}
+    # end def __init__
+
+    def add (self, fwhandle, result) :
+        v, s, m = fwhandle.partition ('/')
+        mask = int (m, 0) if m else 0xffffffff
+        if self.mask is None :
+            self.mask = mask
+        elif self.mask != mask :
+            raise ValueError ("Mask of fw filter %s differs" % fwhandle)
+        self.results [int (v, 0)] = result
+    # end def add
+
+    def classify (self, hdr, mark, length) :
+        return self.results.get (mark & self.mask), 1
+    # end def classify
+
+# end class FW_Filter
+
+class U32_Filter (autosuper) :
+    """ Filters of kind u32 with the same prio. The root hash table of
+        the prio has one bucket, other hash tables are shared by all
+        prios of a qdisc. A node is a tuple of the keys (see u32_key),
+        the linked buckets with the hash key and the result. When no
+        node of a linked bucket matches, classification continues with
+        the next node of the table that has the link, like in the
+        kernel.
+    """
+
+    kind = 'u32'
+
+    def __init__ (self) :
+        self.root = []
+    # end def __init__
+
+    def add (self, keys, link, hashkey, result, bucket = None) :
+        if bucket is None :
+            bucket = self.root
+        bucket.append ((tuple (keys), link, hashkey, result))
+    # end def add
+
+    def classify (self, hdr, mark, length) :
+        return self.walk (self.root, hdr)
+    # end def classify
+
+    def walk (self, bucket, hdr) :
+        n = 0
+        for keys, link, hashkey, result in bucket :
+            n += 1
+            for off, mask, val in keys :
+                if u32_word (hdr, off) [0] & mask != val :
+                    break
+            else :
+                if link is None :
+                    return result, n
+                off, mask, shift = hashkey
+                b    = (u32_word (hdr, off) [0] & mask) >> shift
+                r, k = self.walk (link [b & (len (link) - 1)], hdr)
+                n   += k
+                if r is not None :
+                    return r, n
+        return None, n
+    # end def walk
+
+# end class U32_Filter
+
+class TC_Simulator (autosuper) :
+    """ Classify packets like the kernel would with a configuration in
+        tc -batch format (see Shaper.as_batch, a script from
+        Shaper.generate can be used with from_script). Supported are
+        hfsc root qdiscs with their default class, the ingress qdisc
+        and filters of kind fw, u32 (including hash tables) and basic
+        with u32, cmp and meta ematches, with the actions xt (or ipt)
+        MARK and mirred redirect. Leaf qdiscs are ignored, only
+        commands adding (or deleting a root or ingress qdisc) are
+        supported. The number of filters tested is counted in
+        `evaluated`, so this can be used to compare the
+        classification cost of different configurations.
+        >>> from rsclib.pycompat import StringIO
+        >>> from rsclib.trafficshape import Traffic_Class, Shaper
+        >>> rules = '\\n'.join ((
+        ...   '-A PREROUTING -s 10.1.2.0/24 -j MARK --set-xmark 0x1/0xf'
+        ... , '-A PREROUTING -s 10.1.0.0/16 -j MARK --set-xmark 0x2/0xf'
+        ... , '-A PREROUTING -s 10.1.3.0/24 -j MARK --set-xmark 0x1/0xf'
+        ... , '-A PREROUTING -p tcp --sport 22 -j MARK --set-xmark 0x1/0xf'
+        ... , '-A PREROUTING -d 10.2.0.1/32 -j MARK --set-xmark 0x2/0xf'
+        ... , '-A PREROUTING -d 10.2.0.2/32 -j MARK --set-xmark 0x1/0xf'
+        ... ))
+        >>> root = Traffic_Class (100)
+        >>> one  = Traffic_Class (50, parent = root, fwmark = '1/0xf')
+        >>> two  = Traffic_Class (40, parent = root, fwmark = '2/0xf')
+        >>> oth  = Traffic_Class \\
+        ...     (10, parent = root, fwmark = '3/0xf', is_default = True)
+        >>> packets = \\
+        ...     [ Packet ('10.1.2.7', '10.2.0.2', 'udp', 53, 53)
+        ...     , Packet ('10.1.3.7', '10.3.0.1', 'tcp', 1025, 80)
+        ...     , Packet ('10.1.3.7', '10.3.0.1', 'tcp', 22, 1025)
+        ...     , Packet ('10.9.3.7', '10.2.0.1', 'tcp', 22, 1025)
+        ...     , Packet ('10.9.3.7', '10.2.0.3', 'icmp')
+        ...     ]
+        >>> for layout in 'linear', 'hash' :
+        ...     sh    = Shaper ('/sbin/tc', root, filter_layout = layout)
+        ...     sim   = TC_Simulator.from_script \\
+        ...         (sh.generate (1000, 'ifb0=eth0', StringIO (rules)))
+        ...     names = {one.name : 'one', two.name : 'two', oth.name : 'oth'}
+        ...     r     = [sim.classify (p, 'eth0', True) for p in packets]
+        ...     print (layout, [(d, names [c]) for d, c in r])
+        linear [('ifb0', 'one'), ('ifb0', 'one'), ('ifb0', 'one'), ('ifb0', 'two'), ('ifb0', 'oth')]
+        hash [('ifb0', 'one'), ('ifb0', 'one'), ('ifb0', 'one'), ('ifb0', 'two'), ('ifb0', 'oth')]
+        >>> sim.check ()
+        []
+        >>> h = sim.histogram (packets, 'eth0', ingress = True)
+        >>> sorted ((names [c], n) for (d, c), n in h.items ())
+        [('one', 3), ('oth', 1), ('two', 1)]
+
+        Without ingress the packet is sent on the device. Filters
+        pointing to a class that doesn't exist or isn't a leaf are
+        reported by check, these packets go to the default class:
+        >>> sim = TC_Simulator ('\\n'.join ((
+        ...   'qdisc add dev eth0 root handle 1: hfsc default 3'
+        ... , 'class add dev eth0 parent 1: classid 1:1 hfsc sc rate 100kbit'
+        ... , 'class add dev eth0 parent 1:1 classid 1:2 hfsc sc rate 60kbit'
+        ... , 'class add dev eth0 parent 1:1 classid 1:3 hfsc sc rate 40kbit'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 1 handle 0x1/0xf fw flowid 1:2'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 1 handle 0x2/0xf fw flowid 1:1'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 2 u32 match ip dport 80 0xffff flowid 1:9'
+        ... )))
+        >>> sim.check ()
+        ['eth0: prio 1 flowid 1:1 is not a leaf class', 'eth0: prio 2 flowid 1:9 is not a class']
+        >>> p = Packet ('10.0.0.1', '10.0.0.2', 'tcp', 1025, 80)
+        >>> sim.classify (p, 'eth0'), sim.classify (p, 'eth1')
+        (('eth0', '1:3'), ('eth1', None))
+        >>> p.mark = 0x11
+        >>> sim.classify (p, 'eth0')
+        ('eth0', '1:2')
+        >>> sim.evaluated
+        3
+        >>> TC_Simulator ('filter add dev eth0 parent 1: prio 1 route')
+        Traceback (most recent call last):
+         ...
+        ValueError: Unsupported filter: filter add dev eth0 parent 1: prio 1 route
+    """
+
+    kinds = dict (basic = Basic_Filter, fw = FW_Filter, u32 = U32_Filter)
+
+    def __init__ (self, batch = None) :
+        self.roots     = {}
+        self.ingress   = set ()
+        self.classes   = {}
+        self.inner     = set ()
+        self.filters   = {}
+        self.tables    = {}
+        self.targets   = []
+        self.evaluated = 0
+        self._chains   = {}
+        if batch :
+            self.parse (batch)
+    # end def __init__
+
+    @classmethod
+    def from_script (cls, script) :
+        """ Simulate a script from Shaper.generate
+        """
+        s = StringIO ()
+        b = Batch_Writer (s)
+        b.write (script)
+        b.flush ()
+        return cls (s.getvalue ())
+    # end def from_script
+
+    def check (self) :
+        """ Filter targets that are not leaf classes
+        """
+        result = []
+        for dev, prio, cls in self.targets :
+            if (dev, cls) in self.inner :
+                result.append \
+                    ('%s: prio %s flowid %s is not a leaf class' % (dev, prio, cls))
+            elif (dev, cls) not in self.classes :
+                result.append \
+                    ('%s: prio %s flowid %s is not a class' % (dev, prio, cls))
+        return result
+    # end def check
+
+    def chain (self, dev, major) :
+        """ Filters of a qdisc sorted by prio
+        """
+        key = (dev, major)
+        if key not in self._chains :
+            f = self.filters.get (key, {})
+            self._chains [key] = [f [p].classify for p in sorted (f)]
+        return self._chains [key]
+    # end def chain
+
+    def classify (self, packet, dev, ingress = False) :
+        """ Device and classid for packet sent (or with ingress
+            received) on dev, the classid is None if the packet isn't
+            shaped (or dropped by hfsc because the default class is
+            missing).
+        """
+        hdr  = packet.header
+        mark = packet.mark
+        if ingress :
+            if dev not in self.ingress :
+                return dev, None
+            for classify in self.chain (dev, 0xffff) :
+                result, n = classify (hdr, mark, packet.length)
+                self.evaluated += n
+                if result is not None :
+                    break
+            else :
+                return dev, None
+            mark = result.apply (mark)
+            if result.redirect is None :
+                return dev, None
+            dev = result.redirect
+        if dev not in self.roots :
+            return dev, None
+        major, default = self.roots [dev]
+        for classify in self.chain (dev, major) :
+            result, n = classify (hdr, mark, packet.length)
+            self.evaluated += n
+            if result is not None :
+                key = (dev, result.classid)
+                if key in self.classes and key not in self.inner :
+                    return key
+                break
+        key = (dev, default)
+        if key in self.classes and key not in self.inner :
+            return key
+        return dev, None
+    # end def classify
+
+    def histogram (self, packets, dev, ingress = False) :
+        """ Number of packets per (device, classid)
+        """
+        result = {}
+        for p in packets :
+            k = self.classify (p, dev, ingress)
+            result [k] = result.get (k, 0) + 1
+        return result
+    # end def histogram
+
+    def parse (self, batch) :
+        for line in batch.split ('\n') :
+            self.parse_command (line)
+    # end def parse
+
+    def parse_command (self, line) :
+        """ Parse one command in tc -batch format
+        """
+        if "'" in line or '"' in line :
+            t = shlex.split (line)
+        else :
+            t = line.split ()
+        if len (t) < 4 or t [2] != 'dev' :
+            return
+        cmd, dev = t [:2], t [3]
+        if t [0] == 'qdisc' and t [1] == 'del' :
+            if t [4:5] == ['root'] :
+                self.roots.pop (dev, None)
+                self.drop (dev, False)
+            elif t [4:5] == ['ingress'] :
+                self.ingress.discard (dev)
+                self.drop (dev, True)
+        elif cmd == ['qdisc', 'add'] :
+            if t [4] == 'ingress' :
+                self.ingress.add (dev)
+            elif t [4] == 'root' and t [5] == 'handle' :
+                major   = handle (t [6]) [0]
+                default = 0
+                if 'default' in t :
+                    default = int (t [t.index ('default') + 1], 16)
+                self.roots [dev] = (major, '%x:%x' % (major, default))
+        elif cmd == ['class', 'add'] :
+            parent = classid (t [t.index ('parent') + 1])
+            cls    = classid (t [t.index ('classid') + 1])
+            self.classes [(dev, cls)] = parent
+            self.inner.add ((dev, parent))
+        elif cmd == ['filter', 'add'] :
+            self.parse_filter (dev, t, line)
+    # end def parse_command
+
+    def drop (self, dev, ingress) :
+        """ Remove the root (or ingress) qdisc of dev with its classes
+            and filters
+        """
+        for d in self.filters, self.tables :
+            for k in list (d) :
+                if k [0] == dev and (k [1] == 0xffff) == ingress :
+                    del d [k]
+        if not ingress :
+            for k in list (self.classes) :
+                if k [0] == dev :
+                    del self.classes [k]
+            self.inner   = set (k for k in self.inner if k [0] != dev)
+            self.targets = [x for x in self.targets if x [0] != dev]
+        self._chains = {}
+    # end def drop
+
+    def parse_filter (self, dev, t, line) :
+        opt = {}
+        pos = 4
+        while pos < len (t) and t [pos] not in self.kinds :
+            opt [t [pos]] = t [pos + 1] if pos + 1 < len (t) else None
+            pos += 2
+        if pos >= len (t) or 'parent' not in opt :
+            raise ValueError ("Unsupported filter: %s" % line)
+        prio = opt.get ('prio', opt.get ('pref'))
+        if prio is None :
+            raise ValueError ("Filter without prio: %s" % line)
+        prio   = int (prio)
+        major  = handle (opt ['parent']) [0]
+        kind   = t [pos]
+        args   = t [pos + 1:]
+        result = self.parse_result (args, line)
+        if result.classid is not None and major != 0xffff :
+            self.targets.append ((dev, prio, result.classid))
+        f = self.filters.setdefault ((dev, major), {})
+        if prio not in f :
+            f [prio] = self.kinds [kind] ()
+            self._chains.pop ((dev, major), None)
+        if f [prio].kind != kind :
+            raise ValueError ("Filters of different kind in prio: %s" % line)
+        if kind == 'fw' :
+            f [prio].add (opt.get ('handle', '0'), result)
+        elif kind == 'basic' :
+            if not args or args [0] != 'match' :
+                raise ValueError ("Unsupported filter: %s" % line)
+            end = len (args)
+            for k in 'flowid', 'classid', 'action' :
+                if k in args :
+                    end = min (end, args.index (k))
+            f [prio].add (' '.join (args [1:end]), result)
+        else :
+            self.parse_u32 (dev, major, f [prio], opt, args, result, line)
+    # end def parse_filter
+
+    def parse_result (self, args, line) :
+        """ Parse flowid (or classid) and actions at the end of a filter
+        """
+        cls      = None
+        marks    = []
+        redirect = None
+        for k in 'flowid', 'classid' :
+            if k in args :
+                cls = classid (args [args.index (k) + 1])
+        actions = ' '.join (args).split (' action ') [1:]
+        for a in actions :
+            a = a.split ()
+            if a [0] in ('xt', 'ipt') and a [1:3] == ['-j', 'MARK'] :
+                v, s, m = a [4].partition ('/')
+                if a [3] == '--set-xmark' :
+                    marks.append ((int (v, 0), int (m or '0xffffffff', 0), 1))
+                elif a [3] == '--set-mark' :
+                    marks.append ((int (v, 0), int (m or '0xffffffff', 0), 0))
+                else :
+                    raise ValueError ("Unsupported action: %s" % line)
+            elif a [:4] == ['mirred', 'egress', 'redirect', 'dev'] :
+                redirect = a [4]
+            else :
+                raise ValueError ("Unsupported action: %s" % line)
+        return Filter_Result (cls, marks, redirect)
+    # end def parse_result
+
+    def parse_u32 (self, dev, major, f, opt, args, result, line) :
+        tables = self.tables.setdefault ((dev, major), {})
+        if 'divisor' in args :
+            n = int (args [args.index ('divisor') + 1])
+            if n & (n - 1) or not 0 < n <= 256 :
+                raise ValueError ("Invalid divisor: %s" % line)
+            tables [handle (opt ['handle']) [0]] = [[] for i in range (n)]
+            return
+        keys    = []
+        link    = None
+        hashkey = None
+        bucket  = None
+        pos     = 0
+        try :
+            while pos < len (args) :
+                a = args [pos]
+                if a == 'match' and args [pos + 1] == 'ip' :
+                    keys.append (self.ip_key (args [pos + 2:pos + 5]))
+                    pos += 4 if args [pos + 2] in ('src', 'dst') else 5
+                elif a == 'match' and args [pos + 1] in sizes :
+                    off = 0
+                    if args [pos + 4:pos + 5] == ['at'] :
+                        off = int (args [pos + 5], 0)
+                        pos += 2
+                    keys.append (u32_key \
+                        ( args [pos + 1], int (args [pos + 2], 0)
+                        , int (args [pos + 3], 0), off
+                        ))
+                    pos += 4
+                elif a == 'ht' :
+                    h, b    = handle (args [pos + 1])
+                    bucket  = tables [h][b]
+                    pos    += 2
+                elif a == 'link' :
+                    link    = tables [handle (args [pos + 1]) [0]]
+                    pos    += 2
+                elif a == 'hashkey' and args [pos + 1] == 'mask' :
+                    mask    = int (args [pos + 2], 16)
+                    shift   = (mask & -mask).bit_length () - 1 if mask else 0
+                    hashkey = (int (args [pos + 4], 0) & ~3, mask, shift)
+                    pos    += 5
+                elif a in ('flowid', 'classid', 'action') :
+                    break
+                else :
+                    raise ValueError ("Unsupported u32 option: %s" % line)
+        except (IndexError, KeyError) :
+            raise ValueError ("Invalid u32 filter: %s" % line)
+        if link is not None and hashkey is None :
+            hashkey = (0, 0, 0)
+        f.add (keys, link, hashkey, result, bucket)
+    # end def parse_u32
+
+    def ip_key (self, args) :
+        """ Key for u32 match ip src|dst prefix or match ip field
+            value mask
+        """
+        if args [0] in ('src', 'dst') :
+            a = IP4_Address (args [1])
+            m = (0xffffffff << (32 - a.mask)) & 0xffffffff
+            return (12 if args [0] == 'src' else 16), m, a.ip & m
+        fields = dict \
+            ( tos = ('u8', 1), protocol = ('u8', 9)
+            , sport = ('u16', 20), dport = ('u16', 22)
+            )
+        size, off = fields [args [0]]
+        return u32_key (size, int (args [1], 0), int (args [2], 0), off)
+    # end def ip_key
+
+# end class TC_Simulator
@@ -24,11 +24,36 @@
 # ****************************************************************************
 
 from __future__ import print_function
+import re
+import sys
+import json
+import tempfile
+import threading
+from collections       import deque, namedtuple
 from operator          import or_
 from functools         import reduce
-from rsclib.autosuper  import autosuper
-from rsclib.execute    import Exec
-from rsclib.IP_Address import IP4_Address
+from rsclib.autosuper  import autosuper, slotted_autosuper
+from rsclib.execute    import Exec, Exec_Error, Exec_Process, Method_Process
+from rsclib.execute    import Process
+from rsclib.IP_Address import IP4_Address, IP_Set, Prefix_Table
+from rsclib.pycompat   import StringIO
+from time              import sleep, time
+
+def normalize_mark (mark) :
+    """ Canonical form of a firewall mark with optional mask, a mask
+        of all ones is the same as no mask.
+        >>> normalize_mark ('1/0xf'), normalize_mark ('0x01/0x0F')
+        ('0x1/0xf', '0x1/0xf')
+        >>> normalize_mark ('0x10/0xffffffff'), normalize_mark ('16')
+        ('0x10', '0x10')
+    """
+    if mark is None :
+        return None
+    m = ['0x%x' % int (f, 0) for f in mark.split ('/', 1)]
+    if m [1:] == ['0xffffffff'] :
+        del m [1]
+    return '/'.join (m)
+# end def normalize_mark
 
 class Major_Counter (autosuper) :
     def __init__ (self, value = 0) :
@@ -45,6 +70,58 @@ class Major_Counter (autosuper) :
     # end def get_next
 # end class Major_Counter
 
+class ID_Allocator (autosuper) :
+    """ Allocate the minor numbers of classes and the major numbers of
+        leaf qdiscs (the root qdisc has major number 1). Each Shaper
+        has its own allocator, so shapers built the same way get the
+        same names, even when several of them are generated in
+        threads: Generating holds the lock of the allocator. Numbers
+        are allocated once per object when the name is first used (for
+        a class of a Shaper this should be after creating the Shaper),
+        regenerating keeps the names.
+        >>> def shaper () :
+        ...     root = Traffic_Class (100)
+        ...     Traffic_Class (60, parent = root, fwmark = '1', is_default = True)
+        ...     Traffic_Class (40, parent = root, fwmark = '2')
+        ...     return Shaper ('/sbin/tc', root)
+        >>> a, b = shaper (), shaper ()
+        >>> a.generate (1000, 'eth0') == b.generate (1000, 'eth0')
+        True
+        >>> [c.name for c in b.leaf_classes ()]
+        ['1:2', '1:3']
+        >>> shapers = [shaper () for i in range (8)]
+        >>> out     = {}
+        >>> def generate (n) :
+        ...     out [n] = shapers [n].generate (1000, 'eth0')
+        >>> threads = \\
+        ...     [threading.Thread (target = generate, args = (n,)) for n in range (8)]
+        >>> for t in threads :
+        ...     t.start ()
+        >>> for t in threads :
+        ...     t.join ()
+        >>> set (out.values ()) == set ([a.generate (1000, 'eth0')])
+        True
+    """
+
+    def __init__ (self) :
+        self.lock          = threading.RLock ()
+        self.major_counter = Major_Counter (1)
+        self.counter       = 1
+    # end def __init__
+
+    def next_major (self) :
+        with self.lock :
+            return self.major_counter.get_next ()
+    # end def next_major
+
+    def next_minor (self) :
+        with self.lock :
+            self.counter += 1
+            return self.counter - 1
+    # end def next_minor
+
+# end class ID_Allocator
+
 class Weighted_Bandwidth (autosuper) :
 
     def __init__ (self, **kw) :
@@ -68,29 +145,62 @@ class Weighted_Bandwidth (autosuper) :
 
 class Traffic_Shaping_Object (autosuper) :
 
-    major_counter = Major_Counter ()
-    counter       = 1
+    # Used for objects not belonging to a Shaper
+    default_allocator = ID_Allocator ()
 
     def __init__ (self, parent = None, **kw) :
-        self.parent   = parent
-        self._depth   = None
-        self._number  = None
+        self.parent     = parent
+        self._allocator = None
+        self._depth     = None
+        self._number    = None
         self.__super.__init__ (**kw)
         if self.parent :
             self.parent.register (self)
     # end def __init__
 
-    def gen_filter (self, dev, realdev) :
-        pass
+    def generate (self, kbit_per_second, wsum, dev) :
+        """ The configuration as a string, see generate_to
+        """
+        s = StringIO ()
+        self.generate_to (s, kbit_per_second, wsum, dev)
+        return s.getvalue () [:-1]
+    # end def generate
+
+    @property
+    def allocator (self) :
+        """ The ID_Allocator of the Shaper this object belongs to
+        """
+        if self.parent :
+            return self.parent.allocator
+        return self._allocator or self.default_allocator
+    # end def allocator
+
+    def gen_filter (self, dev, realdev, skip = (), rule_set = None) :
+        """ The filter configuration as a string, see gen_filter_to
+        """
+        s = StringIO ()
+        self.gen_filter_to (s, dev, realdev, skip, rule_set)
+        return s.getvalue () [:-1]
     # end def gen_filter
 
+    def gen_filter_to \
+        (self, stream, dev, realdev, skip = (), rule_set = None) :
+        pass
+    # end def gen_filter_to
+
+    def prepare (self, kbit_per_second, wsum, dev) :
+        """ Allocate the name in the same order as generate_to does
+        """
+        x = self.name
+    # end def prepare
+
     def ind (self, indent = None) :
         indent = indent or self.depth
         return '    ' * (indent - 1)
     # end def ind
 
-    def outp (self, ostr, indent = None) :
-        self.result.append (''.join ((self.ind (indent), ostr % self)))
+    def outp (self, stream, ostr, indent = None) :
+        stream.write (''.join ((self.ind (indent), ostr % self, '\n')))
     # end def outp
 
     @property
@@ -111,10 +221,8 @@ class Traffic_Shaping_Object (autosuper) :
 
     @property
     def number (self) :
-        if self._number is not None :
-            return self._number
-        self._number = self.__class__.counter
-        self.__class__.counter += 1
+        if self._number is None :
+            self._number = self.allocator.next_minor ()
         return self._number
     # end def number
 
@@ -145,29 +253,31 @@ class Traffic_Leaf (Traffic_Shaping_Object) :
 
     @property
     def name (self) :
-        return ':'.join ((str (self.major_counter.get_next ()), ''))
+        # The major number of a leaf qdisc is allocated only once
+        if self._number is None :
+            self._number = self.allocator.next_major ()
+        return ':'.join ((str (self._number), ''))
     # end def name
 
-    def generate (self, kbit_per_second, wsum, dev) :
-        self.result = []
+    def generate_to (self, stream, kbit_per_second, wsum, dev) :
         self.outp \
-            ( '$TC qdisc add dev %(dev)s parent %%(parentname)s '
+            ( stream
+            , '$TC qdisc add dev %(dev)s parent %%(parentname)s '
               'handle %%(name)s \\'
             % locals ()
             )
-    # end def generate
+    # end def generate_to
 # end class Traffic_Leaf
 
 class SFQ_Leaf (Traffic_Leaf) :
-    def generate (self, kbit_per_second, wsum, dev) :
-        self.__super.generate (kbit_per_second, wsum, dev)
-        self.outp ('    sfq perturb 10')
-        return '\n'.join (self.result)
-    # end def generate
+    def generate_to (self, stream, kbit_per_second, wsum, dev) :
+        self.__super.generate_to (stream, kbit_per_second, wsum, dev)
+        self.outp (stream, '    sfq perturb 10')
+    # end def generate_to
 # end class SFQ_Leaf
 
 class RED_Leaf (Traffic_Leaf) :
-    def generate (self, kbit_per_second, wsum, dev) :
+    def generate_to (self, stream, kbit_per_second, wsum, dev) :
         """ For details on RED parameter selection, see
             M. Christiansen, K. Jeffay, D. Ott, and F.D. Smith
             "Tuning RED for Web Traffic"
@@ -182,7 +292,7 @@ class RED_Leaf (Traffic_Leaf) :
             response; 0.2: utilization) so I'm using 0.1 here.
             Other chosen settings stolen from OpenWRT qos script.
         """
-        self.__super.generate (kbit_per_second, wsum, dev)
+        self.__super.generate_to (stream, kbit_per_second, wsum, dev)
         av    = 1500 # pkt size
         rmin  = int (kbit_per_second * 1024 / 8 * 0.05) # 50 ms queue
         if rmin < 3000 : # at least 2 max-size pkts
@@ -193,10 +303,11 @@ class RED_Leaf (Traffic_Leaf) :
         if burst < 2 :
             burst = 2
         l     = locals ()
-        self.outp ('    red min %(rmin)s max %(rmax)s burst %(burst)s \\'  % l)
-        self.outp ('    avpkt %(av)s limit %(limit)s probability 0.1 ecn' % l)
-        return '\n'.join (self.result)
-    # end def generate
+        self.outp \
+            (stream, '    red min %(rmin)s max %(rmax)s burst %(burst)s \\' % l)
+        self.outp \
+            (stream, '    avpkt %(av)s limit %(limit)s probability 0.1 ecn' % l)
+    # end def generate_to
 # end class RED_Leaf
 
 class Traffic_Class (Traffic_Shaping_Object, Weighted_Bandwidth) :
@@ -225,7 +336,7 @@ class Traffic_Class (Traffic_Shaping_Object, Weighted_Bandwidth) :
         communication is possible (if you're on ethernet).
     """
 
-    major_no = Traffic_Shaping_Object.major_counter.get_next ()
+    major_no = 1 # handle of the root qdisc
 
     def __init__ \
         ( self
@@ -241,42 +352,69 @@ class Traffic_Class (Traffic_Shaping_Object, Weighted_Bandwidth) :
         self.size       = size
         self.delay_ms   = delay_ms
         if fwmark :
-            fwmark = '/'.join ("0x%x" % int (f, 0) for f in fwmark.split ('/'))
+            fwmark = normalize_mark (fwmark)
         self.fwmark     = fwmark
         self.is_bulk    = is_bulk
         self.is_default = is_default
         self.is_leaf    = False
+        self.rates      = {}
         self.__super.__init__ (**kw)
     # end def __init__
 
-    def generate (self, kbit_per_second, wsum, dev) :
-        rate   = float (self.weight) / wsum * kbit_per_second
-        nonlin = ''
-        if self.size and self.delay_ms and not self.children :
+    def generate_to (self, stream, kbit_per_second, wsum, dev) :
+        """ Write the configuration of this class and its children to
+            stream, each line is written once.
+        """
+        rate    = self._prepare (kbit_per_second, wsum, dev)
+        nonlin  = ''
+        if self.size and self.delay_ms and self.is_leaf :
             nonlin = 'umax %(size)sb dmax %(delay_ms)sms ' % self
         l = locals ()
-        self.result = []
         self.outp \
-            ( '$TC class add dev %(dev)s parent %%(parentname)s '
+            ( stream
+            , '$TC class add dev %(dev)s parent %%(parentname)s '
               'classid %%(name)s hfsc \\'
             % l
             )
-        self.outp ('    sc %(nonlin)srate %(rate)skbit \\' % l)
-        self.outp ('    ul rate %(kbit_per_second)skbit'  % l)
-        if not self.children :
-            self.is_leaf = True
-            if self.is_bulk :
-                RED_Leaf (parent = self)
-            else :
-                SFQ_Leaf (parent = self)
+        self.outp (stream, '    sc %(nonlin)srate %(rate)skbit \\' % l)
+        self.outp (stream, '    ul rate %(kbit_per_second)skbit'  % l)
         for c in self.children :
-            self.result.append \
-                (c.generate (kbit_per_second, self.weightsum, dev))
-        return '\n'.join (self.result)
-    # end def generate
+            c.generate_to (stream, kbit_per_second, self.weightsum, dev)
+    # end def generate_to
 
-    def gen_filter (self, dev, realdev) :
-        """ Generate tc filter configuration for given devices.
+    def prepare (self, kbit_per_second, wsum, dev) :
+        """ Allocate the names, compute the rates on dev and create the
+            leaf qdiscs of this class and its children like
+            generate_to does, but without output.
+        """
+        self._prepare (kbit_per_second, wsum, dev)
+        for c in self.children :
+            c.prepare (kbit_per_second, self.weightsum, dev)
+    # end def prepare
+
+    def _prepare (self, kbit_per_second, wsum, dev) :
+        """ Name, rate and leaf qdisc of this class, returns the rate.
+        """
+        x = self.name # allocate before the leaf and the children
+        rate    = float (self.weight) / wsum * kbit_per_second
+        classes = [c for c in self.children if isinstance (c, Traffic_Class)]
+        self.rates [dev] = rate
+        # On repeated generate keep the leaf qdisc (and its handle)
+        # unless the class got children or the leaf type changed.
+        leaf_cls = (SFQ_Leaf, RED_Leaf) [bool (self.is_bulk)]
+        leafs    = [c for c in self.children if isinstance (c, Traffic_Leaf)]
+        self.is_leaf = not classes
+        if leafs and (classes or not isinstance (leafs [0], leaf_cls)) :
+            self.children = [c for c in self.children if c not in leafs]
+            leafs = []
+        if self.is_leaf and not leafs :
+            leaf_cls (parent = self)
+        return rate
+    # end def _prepare
+
+    def gen_filter_to \
+        (self, stream, dev, realdev, skip = (), rule_set = None) :
+        """ Write tc filter configuration for given devices to stream.
             The realdev is given if we redirect traffic from a real
             device to an ifb device for inbound shaping. In that case
             we generate the redirection rules from the real device to
@@ -285,44 +423,44 @@ class Traffic_Class (Traffic_Shaping_Object, Weighted_Bandwidth) :
             and redirecting to the ifb dev) and the ifb dev (for rules
             that depend on previous marks and finally for redirecting to
             appropriate leaf qdiscs by fwmark).
+            Mangle rules in skip are not translated, these are handled
+            by hashing filters generated by the Shaper. The rules are
+            taken from rule_set, default is IPTables_Mangle_Rule.rules.
         """
-        self.result = []
+        if rule_set is None :
+            rule_set = IPTables_Mangle_Rule.rules
         for c in self.children :
-            r = c.gen_filter (dev, realdev)
-            if r :
-                self.result.append (r)
+            c.gen_filter_to (stream, dev, realdev, skip, rule_set)
         if self.is_leaf :
             prio = 1
             assert (self.fwmark)
             l = locals ()
             if realdev :
                 act = 'action mirred egress redirect dev %(dev)s' % l
-                for r in IPTables_Mangle_Rule.rules :
-                    if r.xmark != self.fwmark :
-                        continue
-                    if r.interface and r.interface != realdev :
+                for r in rule_set.for_mark (self.fwmark, realdev) :
+                    if r in skip :
                         continue
                     if r.mark :
                         flow = 'flowid %(name)s'
                         f = r.as_tc_filter (dev, self.rootname, replace = flow)
-                        self.outp (f)
+                        self.outp (stream, f)
                     else :
                         f = r.as_tc_filter (realdev, 'ffff:', action = act)
-                        self.outp (f)
-                prio = IPTables_Mangle_Rule.maxprio ()
+                        self.outp (stream, f)
+                prio = rule_set.maxprio ()
 
             f = '$TC filter add dev %(dev)s parent %%(rootname)s \\' % l
             l = locals ()
-            self.outp (f)
-            self.outp ('    protocol ip prio %(prio)s \\' % l)
-            self.outp ('    handle %(fwmark)s fw flowid %(name)s')
+            self.outp (stream, f)
+            self.outp (stream, '    protocol ip prio %(prio)s \\' % l)
+            self.outp (stream, '    handle %(fwmark)s fw flowid %(name)s')
             if self.is_default :
                 prio += 1
-                self.outp (f)
-                self.outp ('    protocol ip prio %(prio)s \\' % locals ())
-                self.outp ('    u32 match u8 0 0 flowid %(name)s')
-        return '\n'.join (self.result)
-    # end def gen_filter
+                self.outp (stream, f)
+                self.outp \
+                    (stream, '    protocol ip prio %(prio)s \\' % locals ())
+                self.outp (stream, '    u32 match u8 0 0 flowid %(name)s')
+    # end def gen_filter_to
 
     def get_default_name (self) :
         x = self.name # side effect: set numbers in depth first order
@@ -338,16 +476,318 @@ class Traffic_Class (Traffic_Shaping_Object, Weighted_Bandwidth) :
 
 # end class Traffic_Class
 
-class IPTables_Mangle_Rule (autosuper) :
+class Rule_Set (autosuper) :
+    """ The mangle rules used for generating tc filters, in the order
+        of iptables. Since the MARK target doesn't terminate, the last
+        matching rule wins: The tc filter prio of a rule is derived
+        from its position, later rules get a lower prio and are matched
+        first. The rules are indexed by the normalized mark they set
+        (see normalize_mark) and by chain, the index is built once
+        when parsing. Parsing again replaces the rules, so a process can
+        regenerate the shaping configuration with a Rule_Set (e.g. the
+        one of a Shaper) without accumulating rules.
+        >>> from rsclib.pycompat import StringIO
+        >>> rules = '\\n'.join ((
+        ...   '-P PREROUTING ACCEPT'
+        ... , '-A PREROUTING -s 10.1.0.0/16 -j MARK --set-xmark 0x1/0xf'
+        ... , '-A PREROUTING -s 10.2.0.0/16 -j MARK --set-xmark 0x2/0xf'
+        ... , '-A PREROUTING -s 10.1.2.0/24 -j MARK --set-xmark 0x2/0xf'
+        ... ))
+        >>> rs = Rule_Set ()
+        >>> rs.parse (StringIO (rules))
+        >>> rs.parse (StringIO (rules))
+        >>> len (rs), rs.maxprio (), len (rs.by_chain ['PREROUTING'])
+        (4, 6, 4)
+        >>> [(r.source, r.prio) for r in rs.by_xmark ['0x2/0xf']]
+        [('10.2.0.0/16', 2), ('10.1.2.0/24', 1)]
+        >>> rs.parse (StringIO ('\\n'.join ((
+        ...   '-A PREROUTING -s 10.1.0.0/16 -j MARK --set-xmark 0x1/0xf'
+        ... , '-A PREROUTING -i eth1 -s 10.2.0.0/16 -j MARK --set-xmark 0x01/0xf'
+        ... , '-A PREROUTING -i eth0 -s 10.3.0.0/16 -j MARK --set-xmark 1/15'
+        ... ))))
+        >>> [r.source for r in rs.for_mark ('0x1/0xf', 'eth0')]
+        ['10.1.0.0/16', '10.3.0.0/16']
+        >>> len (IPTables_Mangle_Rule.rules)
+        0
+
+        The rules are instances of rule_class, IPTables_Mangle_Rule
+        by default:
+        >>> class My_Rule (IPTables_Mangle_Rule) :
+        ...     __slots__ = ()
+        >>> class My_Rule_Set (Rule_Set) :
+        ...     rule_class = My_Rule
+        >>> rs = My_Rule_Set ()
+        >>> rs.parse (StringIO (rules))
+        >>> [r.__class__.__name__ for r in rs] [:2]
+        ['My_Rule', 'My_Rule']
+    """
+
+    # Set to IPTables_Mangle_Rule after its definition below
+    rule_class = None
+
+    def __init__ (self, use_ipt = False) :
+        self.use_ipt = use_ipt
+        self.clear ()
+    # end def __init__
+
+    def add (self, rule) :
+        self.rules.append (rule)
+        rule._prio    = len (self.rules)
+        rule.rule_set = self
+        mark = normalize_mark (rule.xmark)
+        self.by_xmark.setdefault (mark, []).append (rule)
+        self.by_chain.setdefault (rule.chain, []).append (rule)
+    # end def add
+
+    def clear (self) :
+        self.rules    = []
+        self.by_xmark = {}
+        self.by_chain = {}
+    # end def clear
+
+    def for_mark (self, mark, interface = None) :
+        """ Rules setting the normalized mark, with interface only
+            rules without an interface or for this interface
+        """
+        rules = self.by_xmark.get (mark, ())
+        if interface is None :
+            return rules
+        return [r for r in rules if not r.interface or r.interface == interface]
+    # end def for_mark
+
+    def maxprio (self) :
+        return len (self.rules) + 2
+    # end def maxprio
+
+    def apply_nft (self, nft_cmd = '/usr/sbin/nft', table = 'shaping') :
+        """ Replace the nftables table with the rules in one transaction
+        """
+        Exec ().exec_pipe ([nft_cmd, '-f', '-'], stdin = self.as_nft (table))
+    # end def apply_nft
+
+    def as_nft (self, table = 'shaping') :
+        """ The rules as a ruleset for nft -f, see nft_to
+        """
+        s = StringIO ()
+        self.nft_to (s, table)
+        return s.getvalue () [:-1]
+    # end def as_nft
+
+    # Base chains of the mangle table: hook and type
+    nft_hooks = dict \
+        ( PREROUTING  = ('prerouting',  'filter')
+        , INPUT       = ('input',       'filter')
+        , FORWARD     = ('forward',     'filter')
+        , OUTPUT      = ('output',      'route')
+        , POSTROUTING = ('postrouting', 'filter')
+        )
+
+    def nft_to (self, stream, table = 'shaping') :
+        """ Write the rules to stream as a ruleset for nft -f that
+            replaces the given table (of family ip) atomically. Runs of
+            consecutive rules with the same statements (see
+            IPTables_Mangle_Rule.nft_groupable) that differ only in one
+            address or port match are merged into one rule matching a
+            named set, so nftables does one lookup instead of testing
+            the rules one after the other.
+            >>> from rsclib.pycompat import StringIO
+            >>> rs = Rule_Set ()
+            >>> rs.parse (StringIO ('\\n'.join ((
+            ...   '-P PREROUTING ACCEPT -c 1 2'
+            ... , '-A PREROUTING -s 10.1.0.0/16 -c 1 2 -j MARK --set-xmark 0x1/0xf'
+            ... , '-A PREROUTING -s 10.2.0.0/16 -j MARK --set-xmark 0x1/0xf'
+            ... , '-A PREROUTING -s 10.2.3.0/24 -j MARK --set-xmark 0x1/0xf'
+            ... , '-A PREROUTING -s 10.1.2.0/24 -j MARK --set-xmark 0x2/0xf'
+            ... , '-A PREROUTING -p tcp -m tcp --dport 22 -j MARK --set-xmark 0x3/0xf'
+            ... , '-A PREROUTING -p tcp -m tcp --dport 80 -j MARK --set-xmark 0x3/0xf'
+            ... , '-A PREROUTING -p udp -m udp --dport 53 -j MARK --set-xmark 0x3/0xf'
+            ... ))))
+            >>> print (rs.as_nft ())
+            table ip shaping
+            delete table ip shaping
+            table ip shaping {
+                set prerouting_1 {
+                    type ipv4_addr
+                    flags interval
+                    auto-merge
+                    elements = {
+                        10.1.0.0/16,
+                        10.2.0.0/16,
+                        10.2.3.0/24
+                    }
+                }
+                set prerouting_2 {
+                    type inet_service
+                    flags interval
+                    auto-merge
+                    elements = {
+                        22,
+                        80
+                    }
+                }
+                chain PREROUTING {
+                    type filter hook prerouting priority -150; policy accept;
+                    ip saddr @prerouting_1 counter meta mark set meta mark & 0xfffffff0 ^ 0x1
+                    ip saddr 10.1.2.0/24 counter meta mark set meta mark & 0xfffffff0 ^ 0x2
+                    tcp dport @prerouting_2 counter meta mark set meta mark & 0xfffffff0 ^ 0x3
+                    udp dport 53 counter meta mark set meta mark & 0xfffffff0 ^ 0x3
+                }
+            }
+        """
+        chains   = []
+        policies = {}
+        rules    = {}
+        for r in self.rules :
+            if r.chain not in rules :
+                chains.append (r.chain)
+                rules [r.chain] = []
+            if r.policy :
+                policies [r.chain] = r.policy.lower ()
+            else :
+                rules [r.chain].append (r)
+        sets   = []
+        result = {}
+        for chain in chains :
+            # Runs of rules: matches, index of the set match or None,
+            # values of the set match and statements
+            runs = []
+            last = None
+            for r in rules [chain] :
+                matches, statements = r.nft_expr ()
+                idx = \
+                    [ i for i, (e, op, v) in enumerate (matches)
+                      if e in r.nft_set_types and not op
+                    ]
+                key = i = None
+                if r.nft_groupable () and len (idx) == 1 :
+                    i   = idx [0]
+                    key = \
+                        ( tuple (matches [:i]), matches [i][0]
+                        , tuple (matches [i + 1:]), tuple (statements)
+                        )
+                if key is not None and key == last :
+                    runs [-1][2].extend (matches [i][2])
+                else :
+                    values = list (matches [i][2]) if key else None
+                    runs.append ((matches, i, values, statements))
+                last = key
+            lines = []
+            for matches, i, values, statements in runs :
+                if values and len (values) > len (matches [i][2]) :
+                    name = '%s_%s' % (chain.lower (), len (sets) + 1)
+                    sets.append ((name, matches [i][0], values))
+                    matches = list (matches)
+                    matches [i] = (matches [i][0], '', ['@' + name])
+                lines.append \
+                    (' '.join
+                        ( [self.rule_class.nft_match (*m) for m in matches]
+                        + statements
+                        )
+                    )
+            result [chain] = lines
+        stream.write ('table ip %s\n' % table)
+        stream.write ('delete table ip %s\n' % table)
+        stream.write ('table ip %s {\n' % table)
+        for name, expr, values in sets :
+            stream.write ('    set %s {\n' % name)
+            stream.write \
+                ('        type %s\n' % self.rule_class.nft_set_types [expr])
+            # Values of consecutive rules may overlap (e.g. a port
+            # range and a port in it), nft rejects this without auto-merge
+            stream.write ('        flags interval\n')
+            stream.write ('        auto-merge\n')
+            stream.write ('        elements = {\n')
+            stream.write \
+                (',\n'.join ('            %s' % v for v in values) + '\n')
+            stream.write ('        }\n')
+            stream.write ('    }\n')
+        for chain in chains :
+            stream.write ('    chain %s {\n' % chain)
+            if chain in self.nft_hooks :
+                hook, type = self.nft_hooks [chain]
+                stream.write \
+                    ( '        type %s hook %s priority -150; policy %s;\n'
+                    % (type, hook, policies.get (chain, 'accept'))
+                    )
+            for line in result [chain] :
+                stream.write ('        %s\n' % line)
+            stream.write ('    }\n')
+        stream.write ('}\n')
+    # end def nft_to
+
+    def parse (self, file = None) :
+        """ Replace the rules with the ones parsed from file or the
+            running iptables, see parse_prerouting_rules.
+        """
+        self.clear ()
+        self.rule_class.parse_prerouting_rules \
+            (file, use_ipt = self.use_ipt, rule_set = self)
+    # end def parse
+
+    def prio (self, rule) :
+        return len (self.rules) - rule._prio + 1
+    # end def prio
+
+    def __delitem__ (self, key) :
+        rules = self.rules
+        del rules [key]
+        self.clear ()
+        for r in rules :
+            self.add (r)
+    # end def __delitem__
+
+    def __getitem__ (self, key) :
+        return self.rules [key]
+    # end def __getitem__
+
+    def __iter__ (self) :
+        return iter (self.rules)
+    # end def __iter__
+
+    def __len__ (self) :
+        return len (self.rules)
+    # end def __len__
+
+# end class Rule_Set
+
+class IPTables_Mangle_Rule (slotted_autosuper) :
     """ Represent an IPTables mangle rule.
         We parse the rule saved with the command ::
 
          iptables  -t mangle -S PREROUTING  -v
 
         this saves all prerouting rules used for traffic marking.
+        Each rule belongs to a Rule_Set, by default to the global
+        IPTables_Mangle_Rule.rules.
+        The options table is compiled once into a table for parsing
+        left to right, see compiled_options.
+        >>> del IPTables_Mangle_Rule.rules [:]
+        >>> r = IPTables_Mangle_Rule \\
+        ...     ( '-A PREROUTING ! -s 10.0.0.0/8 -p tcp -m tcp'
+        ...       ' --sport 1:1023 -c 5 1500 -j MARK --set-xmark 0x1/0xf'
+        ...     )
+        >>> r.source, r.negated, r.sports, r.pkgcount, r.bytecount, r.modules
+        ('10.0.0.0/8', {'source': True}, [[1, 1023]], 5, 1500, ['tcp'])
+        >>> r.as_iptables ()
+        '-A PREROUTING ! -s 10.0.0.0/8 -p tcp -m tcp --sport 1:1023 -c 5 1500 -j MARK --set-xmark 0x1/0xf'
+        >>> r.color = 'red'
+        Traceback (most recent call last):
+         ...
+        AttributeError: 'IPTables_Mangle_Rule' object has no attribute 'color'
+        >>> del IPTables_Mangle_Rule.rules [:]
     """
 
-    rules = []
+    # With tens of thousands of rules the size of instances matters
+    __slots__ = \
+        ( 'action', 'bytecount', 'chain', 'ctmask', 'destination'
+        , 'dports', 'icmp_type', 'interface', 'is_fragment', 'length'
+        , 'mark', 'modules', 'negate_option', 'negated', 'nfmask'
+        , 'pkgcount', 'policy', 'protocol', 'restore', 'save', 'source'
+        , 'sports', 'state', 'tcp_flags_comp', 'tcp_flags_mask'
+        , 'rule_set', 'use_ipt', 'xmark', '_addresses', '_prio'
+        )
+
+    rules = Rule_Set ()
 
     # for parsing saved iptables rules
     # Note: if there are multiple args, they are parsed right to left!
@@ -405,11 +845,13 @@ class IPTables_Mangle_Rule (autosuper) :
         , 'FIN' : 0x01
         }
 
-    def __init__ (self, line, use_ipt = False) :
+    def __init__ (self, line, use_ipt = False, rule_set = None) :
         self.pkgcount       = 0
         self.bytecount      = 0
         self.restore        = False
         self.save           = False
+        self.nfmask         = None
+        self.ctmask         = None
         self.negate_option  = False
         self.negated        = {}
         self.action         = None
@@ -431,11 +873,58 @@ class IPTables_Mangle_Rule (autosuper) :
         self.tcp_flags_comp = None
         self.tcp_flags_mask = None
         self.use_ipt        = use_ipt
+        self._addresses     = None
         self.parse (line)
-        self.rules.append (self)
-        self._prio          = len (self.rules) # for filter rules
+        if rule_set is None :
+            rule_set = self.rules
+        rule_set.add (self) # sets rule_set and _prio
     # end def __init__
 
+    def address (self, name) :
+        """ The IP4_Address for source or destination, parsed only once
+        """
+        value = getattr (self, name)
+        if self._addresses is None :
+            self._addresses = {}
+        try :
+            return self._addresses [value]
+        except KeyError :
+            a = self._addresses [value] = IP4_Address (value)
+            return a
+    # end def address
+
+    def address_only (self) :
+        """ Return 'source' or 'destination' if the rule matches only
+            on this (non-negated) address, otherwise None. Such rules
+            can be translated to u32 hashing filters.
+        """
+        if  (  self.negated
+            or self.mark
+            or self.is_fragment
+            or self.length
+            or self.protocol
+            or self.tcp_flags_comp
+            or self.icmp_type is not None
+            or self.sports
+            or self.dports
+            ) :
+            return None
+        if self.source and not self.destination :
+            return 'source'
+        if self.destination and not self.source :
+            return 'destination'
+        return None
+    # end def address_only
+
+    def tc_action (self) :
+        """ The tc action for setting the mark of this rule
+        """
+        act = 'xt'
+        if self.use_ipt :
+            act = 'ipt'
+        return "action %s -j MARK --set-xmark %s" % (act, self.xmark)
+    # end def tc_action
+
     def u32_nexthdr (self, width, value, mask, at, op = '') :
         """ Hack: work-around for non-working nexthdr.
             This should really expand to "at nexthdr+%s" % at
@@ -561,9 +1050,6 @@ class IPTables_Mangle_Rule (autosuper) :
             with replace. In addition an additional action may be
             specified with action.
         """
-        act = 'xt'
-        if self.use_ipt :
-            act = 'ipt'
         if prio is None :
             prio = self.prio
         if not self.xmark :
@@ -578,14 +1064,14 @@ class IPTables_Mangle_Rule (autosuper) :
             r.append \
                 ("%s%s"
                 % ( self.neg ("source")
-                  , IP4_Address (self.source).as_tc_basic_u32 ()
+                  , self.address ('source').as_tc_basic_u32 ()
                   )
                 )
         if self.destination :
             r.append \
                 ("%s%s"
                 % ( self.neg ("destination")
-                  , IP4_Address (self.destination).as_tc_basic_u32 (is_dst = 1)
+                  , self.address ('destination').as_tc_basic_u32 (is_dst = 1)
                   )
                 )
         if self.mark :
@@ -669,12 +1155,48 @@ class IPTables_Mangle_Rule (autosuper) :
         if replace :
             ret.append (replace)
         else :
-            ret.append ("action %s -j MARK --set-xmark %s" % (act, self.xmark))
+            ret.append (self.tc_action ())
         if action :
             ret.append (action)
         return ' '.join (ret)
     # end def as_tc_filter
 
+    def as_nft (self) :
+        """ Output as nftables rule, for the chain see Rule_Set.as_nft.
+            Counters are not copied, the rule gets a new counter.
+            >>> r = IPTables_Mangle_Rule \\
+            ...     ( '-A PREROUTING -i eth0 ! -s 10.0.0.0/8 -p tcp -m multiport'
+            ...       ' --dports 20:21,80 -j MARK --set-xmark 0x1/0xf'
+            ...     , rule_set = Rule_Set ()
+            ...     )
+            >>> r.as_nft ()
+            'iifname "eth0" ip saddr != 10.0.0.0/8 tcp dport { 20-21, 80 } counter meta mark set meta mark & 0xfffffff0 ^ 0x1'
+            >>> r = IPTables_Mangle_Rule \\
+            ...     ( '-A PREROUTING -p tcp -m tcp --tcp-flags SYN,RST,ACK SYN'
+            ...       ' -m mark ! --mark 0x2/0xf -m length --length 0:128'
+            ...       ' -j MARK --set-xmark 0x3/0xffffffff'
+            ...     , rule_set = Rule_Set ()
+            ...     )
+            >>> r.as_nft ()
+            'meta mark & 0xf != 0x2 ip length 0-128 tcp flags & (syn|rst|ack) == syn counter meta mark set 0x3'
+            >>> r = IPTables_Mangle_Rule \\
+            ...     ( '-A PREROUTING -f -p icmp -m icmp --icmp-type 8/0 -j ACCEPT'
+            ...     , rule_set = Rule_Set ()
+            ...     )
+            >>> r.as_nft ()
+            'ip frag-off & 0x1fff != 0 icmp type 8 icmp code 0 counter accept'
+            >>> r = IPTables_Mangle_Rule \\
+            ...     ( '-A PREROUTING -p tcp -m tcp --tcp-flags ALL NONE -j DROP'
+            ...     , rule_set = Rule_Set ()
+            ...     )
+            >>> r.as_nft ()
+            'tcp flags & (ack|cwr|ecn|fin|psh|rst|syn|urg) == 0x0 counter drop'
+        """
+        matches, statements = self.nft_expr ()
+        return ' '.join \
+            ([self.nft_match (*m) for m in matches] + statements)
+    # end def as_nft
+
     def neg (self, name, invert = False) :
         cond = name in self.negated
         if invert :
@@ -684,70 +1206,224 @@ class IPTables_Mangle_Rule (autosuper) :
         return ''
     # end def neg
 
-    def parse (self, line) :
-        nargs = 0
-        opt   = None
-        for arg in line.split () :
-            name = None
-            if not nargs :
-                opt = self.options [arg]
-                nargs = opt [0]
-                if nargs == 0 :
-                    assert (opt [1][0] == 'bool')
-                    name = opt [1][1]
-                    self.parse_bool (name)
-            else :
-                name = opt [nargs][1]
-                method = getattr (self, 'parse_' + opt [nargs][0])
-                method (name, arg)
-                nargs -= 1
-            if self.negate_option and name and name != 'negate_option' :
-                self.negated [name] = True
-                self.negate_option  = False
-    # end def parse
-
-    def parse_bool (self, name) :
-        setattr (self, name, True)
-    # end def parse_bool
-
-    def parse_int (self, name, arg) :
-        setattr (self, name, int (arg))
-    # end def parse_int
+    # Fields that can be matched with a set in nftables
+    nft_set_types = \
+        { 'ip saddr'  : 'ipv4_addr'
+        , 'ip daddr'  : 'ipv4_addr'
+        , 'tcp sport' : 'inet_service'
+        , 'tcp dport' : 'inet_service'
+        , 'udp sport' : 'inet_service'
+        , 'udp dport' : 'inet_service'
+        }
 
-    def parse_list (self, name, arg) :
-        l = getattr (self, name)
-        if l is None :
-            l = []
-            setattr (self, name, l)
-        l.append (arg)
-    # end def parse_list
+    _nft_flags = dict \
+        (CWR = 'cwr', ECE = 'ecn', URG = 'urg', ACK = 'ack'
+        , PSH = 'psh', RST = 'rst', SYN = 'syn', FIN = 'fin'
+        )
 
-    def parse_port (self, name, arg) :
-        val = [[int (x) for x in a.split (':')] for a in arg.split (',')]
-        setattr (self, name, val)
-    # end def parse_port
+    def nft_expr (self) :
+        """ The rule in nftables syntax: A list of matches, each a tuple
+            of expression, operator and a list of values, and a list of
+            statements.
+        """
+        m = []
+        def add (expr, name, values, op = '') :
+            if name in self.negated :
+                op = '!='
+            m.append ((expr, op, values))
+        # end def add
+        if self.interface :
+            add ('iifname', 'interface', ['"%s"' % self.interface])
+        if self.source :
+            add ('ip saddr', 'source', [self.source])
+        if self.destination :
+            add ('ip daddr', 'destination', [self.destination])
+        if self.state :
+            add ('ct state', 'state', [self.state.lower ()])
+        if self.mark :
+            v, s, mask = self.mark.partition ('/')
+            if mask :
+                add ('meta mark & %s' % mask, 'mark', [v], '==')
+            else :
+                add ('meta mark', 'mark', [v])
+        if self.is_fragment :
+            op = '!='
+            if 'is_fragment' in self.negated :
+                op = '=='
+            m.append (('ip frag-off & 0x1fff', op, ['0']))
+        if self.length :
+            add ('ip length', 'length', ['-'.join (str (i) for i in self.length)])
+        proto = (self.protocol or '').lower ()
+        if  (   proto
+            and not self.sports and not self.dports
+            and not self.tcp_flags_mask and self.icmp_type is None
+            ) :
+            add ('ip protocol', 'protocol', [proto])
+        if self.tcp_flags_mask :
+            flags = []
+            for f in self.tcp_flags_mask, self.tcp_flags_comp :
+                f = f.split (',')
+                if 'ALL' in f :
+                    f = sorted (self._nft_flags.values ())
+                else :
+                    f = [self._nft_flags [x] for x in f if x != 'NONE']
+                flags.append ('|'.join (f) or '0x0')
+            op = '=='
+            if 'tcp_flags_mask' in self.negated :
+                op = '!='
+            m.append (('tcp flags & (%s)' % flags [0], op, [flags [1]]))
+        if self.icmp_type is not None :
+            t, s, code = self.icmp_type.partition ('/')
+            add ('icmp type', 'icmp_type', [t])
+            if code :
+                add ('icmp code', 'icmp_type', [code])
+        for name, ports in ('sport', self.sports), ('dport', self.dports) :
+            if ports :
+                if proto not in ('tcp', 'udp') :
+                    raise ValueError ("Ports need protocol tcp or udp")
+                add \
+                    ( '%s %s' % (proto, name), name + 's'
+                    , ['-'.join (str (p) for p in x) for x in ports]
+                    )
+        st = ['counter']
+        if self.action == 'MARK' and self.xmark :
+            v, s, mask = self.xmark.partition ('/')
+            mask = int (mask or '0xffffffff', 0)
+            if mask == 0xffffffff :
+                st.append ('meta mark set 0x%x' % int (v, 0))
+            else :
+                st.append \
+                    ( 'meta mark set meta mark & 0x%x ^ 0x%x'
+                    % (~mask & 0xffffffff, int (v, 0))
+                    )
+        elif self.action == 'CONNMARK' and (self.save or self.restore) :
+            if  (  int (self.nfmask or '0xffffffff', 0) != 0xffffffff
+                or int (self.ctmask or '0xffffffff', 0) != 0xffffffff
+                ) :
+                raise ValueError ("CONNMARK with masks not supported")
+            if self.save :
+                st.append ('ct mark set meta mark')
+            else :
+                st.append ('meta mark set ct mark')
+        elif self.action in ('ACCEPT', 'DROP', 'RETURN') :
+            st.append (self.action.lower ())
+        elif self.action :
+            st.append ('jump %s' % self.action)
+        return m, st
+    # end def nft_expr
+
+    def nft_groupable (self) :
+        """ True if the statements of the rule give the same result when
+            executed twice: Consecutive rules with the same statements
+            can then be merged into one rule with a set.
+        """
+        if self.action == 'MARK' and self.xmark :
+            v, s, mask = self.xmark.partition ('/')
+            return not int (v, 0) & ~int (mask or '0xffffffff', 0)
+        return self.action in ('ACCEPT', 'DROP', 'RETURN', 'CONNMARK')
+    # end def nft_groupable
+
+    @staticmethod
+    def nft_match (expr, op, values) :
+        v = values [0]
+        if len (values) > 1 :
+            v = '{ %s }' % ', '.join (values)
+        return ' '.join (x for x in (expr, op, v) if x)
+    # end def nft_match
 
-    def parse_range (self, name, arg) :
-        setattr (self, name, [int (a) for a in arg.split (':', 1)])
-    # end def parse_str
+    def parse (self, line) :
+        """ Parse one line of iptables -S output, a '!' negates the
+            first argument of the following option.
+        """
+        compiled = self.compiled_options ()
+        tokens   = line.split ()
+        negate   = False
+        i        = 0
+        n        = len (tokens)
+        while i < n :
+            opt = tokens [i]
+            i  += 1
+            if opt == '!' :
+                negate = True
+                continue
+            for name, convert in compiled [opt] :
+                if convert is True :
+                    value = True
+                else :
+                    value = tokens [i]
+                    i    += 1
+                    if convert is list :
+                        l = getattr (self, name)
+                        if l is None :
+                            l = []
+                        l.append (value)
+                        value = l
+                    elif convert is not None :
+                        value = convert (value)
+                setattr (self, name, value)
+                if negate :
+                    self.negated [name] = True
+                    negate = False
+        self.negate_option = negate
+    # end def parse
 
-    def parse_str (self, name, arg) :
-        setattr (self, name, arg)
-    # end def parse_str
+    @classmethod
+    def compiled_options (cls) :
+        """ The options table compiled for parsing left to right:
+            For each option a tuple of (attribute name, conversion),
+            the conversion is True for flags, None for strings and list
+            for arguments that are appended. Ports and ranges are
+            converted with parse_ports and parse_ranges, a derived class
+            may override these.
+        """
+        try :
+            return cls.__dict__ ['_compiled']
+        except KeyError :
+            pass
+        convert = dict \
+            ( bool  = True
+            , int   = int
+            , list  = list
+            , port  = cls.parse_ports
+            , range = cls.parse_ranges
+            , str   = None
+            )
+        compiled = {}
+        for opt, spec in cls.options.items () :
+            if opt == '!' :
+                continue
+            compiled [opt] = tuple \
+                ((name, convert [t]) for t, name in reversed (spec [1:]))
+        cls._compiled = compiled
+        return compiled
+    # end def compiled_options
+
+    @staticmethod
+    def parse_ports (arg) :
+        return [[int (x) for x in a.split (':')] for a in arg.split (',')]
+    # end def parse_ports
+
+    @staticmethod
+    def parse_ranges (arg) :
+        return [int (a) for a in arg.split (':', 1)]
+    # end def parse_ranges
 
     @property
     def prio (self) :
-        return len (self.rules) - self._prio + 1
+        return self.rule_set.prio (self)
     # end def prio
 
     @classmethod
     def maxprio (cls) :
-        return len (cls.rules) + 2
+        return cls.rules.maxprio ()
     # end def maxprio
 
     @classmethod
-    def parse_prerouting_rules (cls, file = None, use_ipt = False) :
+    def parse_prerouting_rules \
+        (cls, file = None, use_ipt = False, rule_set = None) :
         """ Parse prerouting rules from file or iptables pipe.
+            The rules are appended to rule_set, default is the global
+            IPTables_Mangle_Rule.rules, see also Rule_Set.parse.
         """
         if file is None :
             x = Exec ()
@@ -755,7 +1431,7 @@ class IPTables_Mangle_Rule (autosuper) :
         else :
             lines = file.readlines ()
         for line in lines :
-            cls (line, use_ipt)
+            cls (line, use_ipt, rule_set)
     # end def parse_prerouting_rules
 
     def tcp_flags (self, flags) :
@@ -764,11 +1440,660 @@ class IPTables_Mangle_Rule (autosuper) :
 
 # end class IPTables_Mangle_Rule
 
+Rule_Set.rule_class = IPTables_Mangle_Rule
+
+class U32_Hash_Filter (autosuper) :
+    """ Classify packets by IPv4 source (or destination) address with
+        u32 hashing filters. Prefixes are added with a target, this is
+        the end of the tc filter command, e.g. 'flowid 1:3' or an
+        action. Like in a routing table the longest matching prefix
+        determines the target. The prefixes are flattened into
+        disjoint networks which are then aggregated per target.
+        Networks with a mask of at least `outer` bits are sorted into
+        hash tables with 256 buckets, one table for each network of
+        length `outer`, keyed on the 8 address bits following the outer
+        network. Networks shorter than a bucket are replicated into all
+        buckets they cover, networks not longer than `outer` are
+        matched linearly in the root table of the filter. When an outer
+        network is completely covered, the target with the most
+        addresses is matched linearly after the link to the hash table
+        and only the other targets go into the buckets. So the kernel
+        does two lookups and a short scan of one bucket instead of
+        testing thousands of filters in sequence. Hash table handles
+        are allocated starting with `handle`, after generate the number
+        of tables used is in `ntables`. Note that u32 hash table handles
+        are shared by all u32 filters of a qdisc.
+        >>> f = U32_Hash_Filter ('eth0', '1:', prio = 5)
+        >>> f.add ('10.1.2.0/23',    'flowid 1:3')
+        >>> f.add ('10.1.2.64/26',   'flowid 1:4')
+        >>> f.add ('10.1.2.128/26',  'flowid 1:4')
+        >>> f.add ('10.7.7.7',       'flowid 1:4')
+        >>> f.add ('10.7.7.6',       'flowid 1:4')
+        >>> f.add ('172.16.0.0/12',  'flowid 1:5')
+        >>> f.add ('172.17.0.0/16',  'flowid 1:5')
+        >>> print (f.generate ())
+        $TC filter add dev eth0 parent 1: protocol ip prio 5 handle 1: u32 divisor 256
+        $TC filter add dev eth0 parent 1: protocol ip prio 5 handle 2: u32 divisor 256
+        $TC filter add dev eth0 parent 1: protocol ip prio 5 u32 match ip src 10.1.0.0/16 hashkey mask 0x0000ff00 at 12 link 1:
+        $TC filter add dev eth0 parent 1: protocol ip prio 5 u32 match ip src 10.7.0.0/16 hashkey mask 0x0000ff00 at 12 link 2:
+        $TC filter add dev eth0 parent 1: protocol ip prio 5 u32 match ip src 172.16.0.0/12 flowid 1:5
+        $TC filter add dev eth0 parent 1: protocol ip prio 5 u32 ht 1:2: match ip src 10.1.2.0/26 flowid 1:3
+        $TC filter add dev eth0 parent 1: protocol ip prio 5 u32 ht 1:2: match ip src 10.1.2.64/26 flowid 1:4
+        $TC filter add dev eth0 parent 1: protocol ip prio 5 u32 ht 1:2: match ip src 10.1.2.128/26 flowid 1:4
+        $TC filter add dev eth0 parent 1: protocol ip prio 5 u32 ht 1:2: match ip src 10.1.2.192/26 flowid 1:3
+        $TC filter add dev eth0 parent 1: protocol ip prio 5 u32 ht 1:3: match ip src 10.1.3.0/24 flowid 1:3
+        $TC filter add dev eth0 parent 1: protocol ip prio 5 u32 ht 2:7: match ip src 10.7.7.6/31 flowid 1:4
+        >>> f = U32_Hash_Filter ('ifb0', '1:', is_dst = True, outer = 20)
+        >>> f.add ('10.1.0.0/20',    'flowid 1:3')
+        >>> f.add ('10.1.17.32/28',  'flowid 1:4')
+        >>> f.add ('10.1.17.48/28',  'flowid 1:3')
+        >>> print (f.generate ())
+        $TC filter add dev ifb0 parent 1: protocol ip prio 1 handle 1: u32 divisor 256
+        $TC filter add dev ifb0 parent 1: protocol ip prio 1 u32 match ip dst 10.1.16.0/20 hashkey mask 0x00000ff0 at 16 link 1:
+        $TC filter add dev ifb0 parent 1: protocol ip prio 1 u32 match ip dst 10.1.0.0/20 flowid 1:3
+        $TC filter add dev ifb0 parent 1: protocol ip prio 1 u32 ht 1:12: match ip dst 10.1.17.32/28 flowid 1:4
+        $TC filter add dev ifb0 parent 1: protocol ip prio 1 u32 ht 1:13: match ip dst 10.1.17.48/28 flowid 1:3
+        >>> U32_Hash_Filter ('eth0', '1:', outer = 25)
+        Traceback (most recent call last):
+         ...
+        ValueError: outer network must not be longer than 24 bits
+    """
+
+    def __init__ \
+        (self, dev, parent, prio = 1, is_dst = False, outer = 16, handle = 1) :
+        if not 0 <= outer <= 24 :
+            raise ValueError ("outer network must not be longer than 24 bits")
+        self.dev      = dev
+        self.parent   = parent
+        self.prio     = prio
+        self.is_dst   = is_dst
+        self.outer    = outer
+        self.handle   = handle
+        self.ntables  = 0
+        self.prefixes = {}
+        self._layout  = None
+    # end def __init__
+
+    def add (self, prefix, target) :
+        """ Add prefix with the given target, an existing entry for the
+            same prefix is replaced.
+        """
+        self.prefixes [IP4_Address (prefix)] = target
+        self._layout = None
+    # end def add
+
+    def flatten (self) :
+        """ Compute disjoint networks per target from the prefixes,
+            returns a dictionary of target -> IP_Set.
+            Sorted prefixes form a tree: each prefix owns its network
+            except for the networks of its direct descendants.
+        """
+        children = dict ((p, []) for p in self.prefixes)
+        stack    = []
+        for p in sorted (self.prefixes) :
+            while stack and not stack [-1].contains (p) :
+                stack.pop ()
+            if stack :
+                children [stack [-1]].append (p)
+            stack.append (p)
+        by_target = {}
+        for p, target in self.prefixes.items () :
+            own = IP_Set ([p])
+            if children [p] :
+                own = own - IP_Set (children [p])
+            if target not in by_target :
+                by_target [target] = []
+            by_target [target].extend (own)
+        return dict ((t, IP_Set (n)) for t, n in by_target.items ())
+    # end def flatten
+
+    def generate (self) :
+        """ The filter commands as a string, see generate_to
+        """
+        s = StringIO ()
+        self.generate_to (s)
+        return s.getvalue () [:-1]
+    # end def generate
+
+    def layout (self) :
+        """ Networks matched linearly and networks per hash table,
+            computed once after adding prefixes. Sets ntables, the
+            number of hash table handles used.
+        """
+        if self._layout is not None :
+            return self._layout
+        outer   = self.outer
+        linear  = []
+        tables  = {}
+        for target, ipset in self.flatten ().items () :
+            for net in ipset :
+                if net.mask <= outer :
+                    linear.append ((net, target))
+                    continue
+                tbl = IP4_Address (net.ip, outer)
+                if tbl not in tables :
+                    tables [tbl] = []
+                tables [tbl].append ((net, target))
+        # If an outer network is completely covered, the target with
+        # most addresses is matched after the link to the hash table:
+        # Packets not matching in the hash table continue there.
+        for tbl in list (tables) :
+            cover = {}
+            for net, target in tables [tbl] :
+                cover [target] = cover.get (target, 0) + len (net)
+            if sum (cover.values ()) == len (tbl) :
+                default = max (sorted (cover), key = cover.get)
+                linear.append ((tbl, default))
+                tables [tbl] = [e for e in tables [tbl] if e [1] != default]
+                if not tables [tbl] :
+                    del tables [tbl]
+        self.ntables = len (tables)
+        self._layout = (linear, tables)
+        return self._layout
+    # end def layout
+
+    def generate_to (self, stream) :
+        """ Write the filter commands to stream
+        """
+        linear, tables = self.layout ()
+        outer  = self.outer
+        inner  = outer + 8
+        shift  = 32 - inner
+        cmd    = '$TC filter add dev %s parent %s protocol ip prio %s' \
+               % (self.dev, self.parent, self.prio)
+        key    = ('src', 'dst') [bool (self.is_dst)]
+        at     = 12 + 4 * bool (self.is_dst)
+        hmask  = 0xff << shift
+        write  = stream.write
+        handle = {}
+        for n, tbl in enumerate (sorted (tables)) :
+            handle [tbl] = self.handle + n
+            write ('%s handle %x: u32 divisor 256\n' % (cmd, handle [tbl]))
+        for tbl in sorted (tables) :
+            write \
+                ( '%s u32 match ip %s %s/%s '
+                  'hashkey mask 0x%08x at %s link %x:\n'
+                % (cmd, key, tbl.dotted (), outer, hmask, at, handle [tbl])
+                )
+        for net, target in sorted (linear) :
+            write \
+                ( '%s u32 match ip %s %s/%s %s\n'
+                % (cmd, key, net.dotted (), net.mask, target)
+                )
+        for tbl in sorted (tables) :
+            buckets = []
+            for net, target in tables [tbl] :
+                if net.mask >= inner :
+                    buckets.append ((net, target))
+                else :
+                    buckets.extend ((b, target) for b in net.subnets (inner))
+            for net, target in sorted (buckets) :
+                write \
+                    ( '%s u32 ht %x:%x: match ip %s %s/%s %s\n'
+                    % ( cmd, handle [tbl], (net.ip >> shift) & 0xff
+                      , key, net.dotted (), net.mask, target
+                      )
+                    )
+    # end def generate_to
+
+# end class U32_Hash_Filter
+
+class TC_State (autosuper) :
+    """ The state of qdiscs, classes and filters of one or more devices,
+        either parsed from a configuration in tc -batch format (e.g.
+        from Shaper.generate) or from the output of tc for the running
+        configuration. The diff method computes the tc commands needed
+        to change one state into another without tearing down the
+        existing configuration. Parameters not known (when parsed from
+        tc output) are None, these are always changed.
+        >>> old = TC_State.from_batch ('\\n'.join ((
+        ...   'qdisc del dev eth0 root'
+        ... , 'qdisc add dev eth0 root handle 1: hfsc default 3'
+        ... , 'class add dev eth0 parent 1: classid 1:1 hfsc sc rate 100kbit'
+        ... , 'class add dev eth0 parent 1:1 classid 1:2 hfsc sc rate 60kbit'
+        ... , 'qdisc add dev eth0 parent 1:2 handle 2: sfq perturb 10'
+        ... , 'class add dev eth0 parent 1:1 classid 1:3 hfsc sc rate 40kbit'
+        ... , 'qdisc add dev eth0 parent 1:3 handle 3: sfq perturb 10'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 1 handle 0x1 fw flowid 1:2'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 1 handle 0x2 fw flowid 1:3'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 2 u32 match u8 0 0 flowid 1:3'
+        ... )))
+        >>> old.diff (old)
+        []
+        >>> new = TC_State.from_batch ('\\n'.join ((
+        ...   'qdisc add dev eth0 root handle 1: hfsc default 4'
+        ... , 'class add dev eth0 parent 1: classid 1:1 hfsc sc rate 100kbit'
+        ... , 'class add dev eth0 parent 1:1 classid 1:2 hfsc sc rate 50kbit'
+        ... , 'qdisc add dev eth0 parent 1:2 handle 2: sfq perturb 10'
+        ... , 'class add dev eth0 parent 1:1 classid 1:4 hfsc sc rate 50kbit'
+        ... , 'qdisc add dev eth0 parent 1:4 handle 4: red limit 1000'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 1 handle 0x1 fw flowid 1:2'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 1 handle 0x3 fw flowid 1:4'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 2 u32 match u8 0 0 flowid 1:4'
+        ... )))
+        >>> for cmd in old.diff (new) :
+        ...     print (cmd)
+        filter del dev eth0 parent 1: prio 2
+        filter del dev eth0 parent 1: protocol ip prio 1 handle 0x2 fw
+        qdisc change dev eth0 root handle 1: hfsc default 4
+        class del dev eth0 classid 1:3
+        class change dev eth0 parent 1:1 classid 1:2 hfsc sc rate 50kbit
+        class add dev eth0 parent 1:1 classid 1:4 hfsc sc rate 50kbit
+        qdisc replace dev eth0 parent 1:4 handle 4: red limit 1000
+        filter add dev eth0 parent 1: protocol ip prio 2 u32 match u8 0 0 flowid 1:4
+        filter replace dev eth0 parent 1: protocol ip prio 1 handle 0x3 fw flowid 1:4
+
+        Moving a class to another parent needs to re-create it with all
+        its descendants:
+        >>> new = TC_State.from_batch ('\\n'.join ((
+        ...   'qdisc add dev eth0 root handle 1: hfsc default 3'
+        ... , 'class add dev eth0 parent 1: classid 1:1 hfsc sc rate 100kbit'
+        ... , 'class add dev eth0 parent 1: classid 1:2 hfsc sc rate 60kbit'
+        ... , 'qdisc add dev eth0 parent 1:2 handle 2: sfq perturb 10'
+        ... , 'class add dev eth0 parent 1:2 classid 1:3 hfsc sc rate 40kbit'
+        ... , 'qdisc add dev eth0 parent 1:3 handle 3: sfq perturb 10'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 1 handle 0x1 fw flowid 1:2'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 1 handle 0x2 fw flowid 1:3'
+        ... , 'filter add dev eth0 parent 1: protocol ip prio 2 u32 match u8 0 0 flowid 1:3'
+        ... )))
+        >>> for cmd in old.diff (new) :
+        ...     print (cmd)
+        filter del dev eth0 parent 1: prio 2
+        filter del dev eth0 parent 1: protocol ip prio 1 handle 0x1 fw
+        filter del dev eth0 parent 1: protocol ip prio 1 handle 0x2 fw
+        class del dev eth0 classid 1:3
+        class del dev eth0 classid 1:2
+        class add dev eth0 parent 1: classid 1:2 hfsc sc rate 60kbit
+        qdisc replace dev eth0 parent 1:2 handle 2: sfq perturb 10
+        class add dev eth0 parent 1:2 classid 1:3 hfsc sc rate 40kbit
+        qdisc replace dev eth0 parent 1:3 handle 3: sfq perturb 10
+        filter add dev eth0 parent 1: protocol ip prio 2 u32 match u8 0 0 flowid 1:3
+        filter add dev eth0 parent 1: protocol ip prio 1 handle 0x1 fw flowid 1:2
+        filter add dev eth0 parent 1: protocol ip prio 1 handle 0x2 fw flowid 1:3
+
+        The running configuration as output by tc:
+        >>> live = TC_State ()
+        >>> live.parse_tc \\
+        ...     ( 'eth0'
+        ...     , [ 'class hfsc 1: root'
+        ...       , 'class hfsc 1:1 parent 1: sc m1 0bit d 0us m2 100Kbit'
+        ...       , 'class hfsc 1:3 parent 1:1 leaf 3: sc m1 0bit d 0us m2 40Kbit'
+        ...       , 'class hfsc 1:2 parent 1:1 leaf 2: sc m1 0bit d 0us m2 60Kbit'
+        ...       , ' Sent 0 bytes 0 pkt (dropped 0, overlimits 0 requeues 0)'
+        ...       ]
+        ...     , [ 'qdisc hfsc 1: root refcnt 2 default 3'
+        ...       , 'qdisc sfq 2: parent 1:2 limit 127p quantum 1514b'
+        ...       , 'qdisc sfq 3: parent 1:3 limit 127p quantum 1514b'
+        ...       ]
+        ...     , [ 'filter parent 1: protocol ip pref 1 fw chain 0'
+        ...       , 'filter parent 1: protocol ip pref 1 fw chain 0 handle 0x1 classid 1:2'
+        ...       , 'filter parent 1: protocol ip pref 1 fw chain 0 handle 0x2 classid 1:3'
+        ...       , 'filter parent 1: protocol ip pref 2 u32 chain 0'
+        ...       , 'filter parent 1: protocol ip pref 2 u32 chain 0 fh 800: ht divisor 1'
+        ...       ]
+        ...     )
+        >>> for cmd in live.diff (old) :
+        ...     print (cmd)
+        filter del dev eth0 parent 1: prio 2
+        qdisc change dev eth0 root handle 1: hfsc default 3
+        class change dev eth0 parent 1: classid 1:1 hfsc sc rate 100kbit
+        class change dev eth0 parent 1:1 classid 1:2 hfsc sc rate 60kbit
+        qdisc replace dev eth0 parent 1:2 handle 2: sfq perturb 10
+        class change dev eth0 parent 1:1 classid 1:3 hfsc sc rate 40kbit
+        qdisc replace dev eth0 parent 1:3 handle 3: sfq perturb 10
+        filter add dev eth0 parent 1: protocol ip prio 2 u32 match u8 0 0 flowid 1:3
+        filter replace dev eth0 parent 1: protocol ip prio 1 handle 0x1 fw flowid 1:2
+        filter replace dev eth0 parent 1: protocol ip prio 1 handle 0x2 fw flowid 1:3
+    """
+
+    def __init__ (self) :
+        self.qdiscs       = {} # (dev, parent) -> parameters
+        self.classes      = {} # (dev, classid) -> (parent, parameters)
+        self.class_order  = [] # top-down
+        self.filters      = {} # (dev, parent, prio) -> list of commands
+        self.filter_order = []
+        self.fw           = {} # (dev, parent, prio, handle) -> command
+        self.fw_order     = []
+        self.targets      = {} # filter key -> classids used
+        self.kinds        = {} # (dev, parent) -> kind of leaf qdisc
+    # end def __init__
+
+    @classmethod
+    def from_batch (cls, batch) :
+        """ Parse commands in tc -batch format
+        """
+        self = cls ()
+        for line in batch.split ('\n') :
+            self.parse_command (line)
+        return self
+    # end def from_batch
+
+    @classmethod
+    def from_tc (cls, devices, tc_cmd = '/sbin/tc') :
+        """ Get the running configuration of the given devices
+        """
+        self = cls ()
+        x    = Exec ()
+        for dev in devices :
+            tc = [tc_cmd]
+            self.parse_tc \
+                ( dev
+                , x.exec_pipe (tc + ['class', 'show', 'dev', dev])
+                , x.exec_pipe (tc + ['qdisc', 'show', 'dev', dev])
+                , x.exec_pipe (tc + ['filter', 'show', 'dev', dev])
+                + x.exec_pipe
+                    (tc + ['filter', 'show', 'dev', dev, 'parent', 'ffff:'])
+                )
+        return self
+    # end def from_tc
+
+    def add_class (self, dev, classid, parent, params) :
+        key = (dev, classid)
+        if key not in self.classes :
+            self.class_order.append (key)
+        self.classes [key] = (parent, params)
+    # end def add_class
+
+    def add_filter (self, dev, parent, prio, command, targets = ()) :
+        key = (dev, parent, prio)
+        if key not in self.filters :
+            self.filter_order.append (key)
+            self.filters [key] = []
+            self.targets [key] = set ()
+        self.targets [key].update (targets)
+        if command is None :
+            self.filters [key] = None
+        elif self.filters [key] is not None :
+            self.filters [key].append (command)
+    # end def add_filter
+
+    def add_fw (self, dev, parent, prio, handle, command, targets = ()) :
+        key = (dev, parent, prio, handle)
+        if key not in self.fw :
+            self.fw_order.append (key)
+        self.fw [key] = command
+        self.targets [key] = set (targets)
+    # end def add_fw
+
+    def diff (self, new) :
+        """ Commands (in tc -batch format) for changing self into new
+        """
+        cmds = []
+        # Devices without the root (or ingress) qdisc in new lose all
+        # their classes and filters when the qdisc is deleted.
+        dead = set ()
+        for key in sorted (self.qdiscs) :
+            dev, parent = key
+            if parent in ('root', 'ingress') and key not in new.qdiscs :
+                cmds.append ('qdisc del dev %s %s' % key)
+                dead.add (key)
+        def alive (dev, parent) :
+            if parent.startswith ('ffff:') :
+                return (dev, 'ingress') not in dead
+            return (dev, 'root') not in dead
+        # end def alive
+        # Classes that are removed or moved to a new parent, a class is
+        # also re-created if its parent is re-created.
+        recreate = set ()
+        for key in self.class_order :
+            parent = self.classes [key][0]
+            n      = new.classes.get (key)
+            if  (  n is None
+                or n [0] != parent
+                or (key [0], parent) in recreate
+                ) :
+                recreate.add (key)
+        # hfsc refuses to delete a class that is still used by a filter
+        def stale (key) :
+            return any \
+                ((key [0], c) in recreate for c in self.targets.get (key, ()))
+        # end def stale
+        for key in self.filter_order :
+            if not alive (key [0], key [1]) :
+                continue
+            old = self.filters [key]
+            if old is None or new.filters.get (key) != old or stale (key) :
+                cmds.append ('filter del dev %s parent %s prio %s' % key)
+        fw_del = set ()
+        for key in self.fw_order :
+            if alive (key [0], key [1]) and (key not in new.fw or stale (key)) :
+                cmds.append \
+                    ( 'filter del dev %s parent %s protocol ip prio %s'
+                      ' handle %s fw' % key
+                    )
+                fw_del.add (key)
+        for key in sorted (new.qdiscs) :
+            dev, parent = key
+            if parent not in ('root', 'ingress') :
+                continue
+            q = new.qdiscs [key]
+            if key not in self.qdiscs :
+                if parent == 'root' :
+                    # Might be some other root qdisc
+                    cmds.append ('qdisc del dev %s root' % dev)
+                cmds.append (' '.join (('qdisc add dev %s %s' % key, q)).strip ())
+            elif parent == 'root' and self.qdiscs [key] != q :
+                cmds.append ('qdisc change dev %s root %s' % (dev, q))
+        for key in reversed (self.class_order) :
+            if key in recreate and alive (key [0], 'root') :
+                cmds.append ('class del dev %s classid %s' % key)
+        for key in sorted (self.qdiscs) :
+            if key [1] in ('root', 'ingress') or key in recreate :
+                continue
+            if key in new.classes and key not in new.qdiscs :
+                cmds.append ('qdisc del dev %s parent %s' % key)
+        for key in new.class_order :
+            dev, classid   = key
+            parent, params = new.classes [key]
+            fresh = key not in self.classes or key in recreate
+            if fresh :
+                cmds.append \
+                    ( 'class add dev %s parent %s classid %s %s'
+                    % (dev, parent, classid, params)
+                    )
+            elif self.classes [key][1] != params or params is None :
+                cmds.append \
+                    ( 'class change dev %s parent %s classid %s %s'
+                    % (dev, parent, classid, params)
+                    )
+            q = new.qdiscs.get (key)
+            if q is not None and (fresh or self.qdiscs.get (key) != q) :
+                # A qdisc can't be replaced by one of another kind
+                k = self.kinds.get (key)
+                if not fresh and k and k != new.kinds [key] :
+                    cmds.append ('qdisc del dev %s parent %s' % key)
+                cmds.append \
+                    ('qdisc replace dev %s parent %s %s' % (dev, classid, q))
+        for key in new.filter_order :
+            old = self.filters.get (key)
+            if  (  old is None
+                or old != new.filters [key]
+                or stale (key)
+                or not alive (key [0], key [1])
+                ) :
+                cmds.extend (new.filters [key])
+        for key in new.fw_order :
+            line = new.fw [key]
+            old  = self.fw.get (key)
+            if key in fw_del or not alive (key [0], key [1]) :
+                cmds.append (line)
+            elif old is None or old != line :
+                cmds.append (line.replace ('filter add ', 'filter replace ', 1))
+        return cmds
+    # end def diff
+
+    def parse_command (self, line) :
+        """ Parse one command in tc -batch format, only additions are
+            recorded.
+        """
+        t = line.split ()
+        if len (t) < 4 or t [1] != 'add' or t [2] != 'dev' :
+            return
+        dev = t [3]
+        if t [0] == 'qdisc' :
+            if t [4] in ('root', 'ingress') :
+                self.qdiscs [(dev, t [4])] = ' '.join (t [5:])
+            elif t [4] == 'parent' and len (t) > 8 :
+                self.qdiscs [(dev, t [5])] = ' '.join (t [6:])
+                self.kinds  [(dev, t [5])] = t [8]
+        elif t [0] == 'class' :
+            self.add_class (dev, t [7], t [5], ' '.join (t [8:]))
+        elif t [0] == 'filter' :
+            parent = t [t.index ('parent') + 1]
+            prio   = t [t.index ('prio') + 1]
+            tgt    = self._targets (t)
+            if 'fw' in t and 'handle' in t :
+                handle = t [t.index ('handle') + 1]
+                self.add_fw (dev, parent, prio, handle, line, tgt)
+            else :
+                self.add_filter (dev, parent, prio, line, tgt)
+    # end def parse_command
+
+    def parse_tc (self, dev, classes, qdiscs, filters) :
+        """ Parse output (lists of lines) of tc class show, tc qdisc
+            show and tc filter show for the given device. Parameters
+            can't be compared, they are set to None.
+        """
+        parents = {}
+        for line in classes :
+            t = line.split ()
+            if len (t) < 5 or t [:2] != ['class', 'hfsc'] or t [3] != 'parent' :
+                continue
+            parents [t [2]] = t [4]
+        def depth (classid) :
+            d = 0
+            while classid in parents :
+                classid = parents [classid]
+                d += 1
+            return d
+        # end def depth
+        for classid in sorted (parents, key = depth) :
+            self.add_class (dev, classid, parents [classid], None)
+        for line in qdiscs :
+            t = line.split ()
+            if len (t) < 4 or t [0] != 'qdisc' :
+                continue
+            if t [3] == 'root' :
+                # Only our own root qdisc can be changed
+                if t [1] == 'hfsc' and t [2] == '1:' :
+                    self.qdiscs [(dev, 'root')] = None
+            elif t [1] == 'ingress' :
+                self.qdiscs [(dev, 'ingress')] = ''
+            elif t [3] == 'parent' and t [4] in parents :
+                self.qdiscs [(dev, t [4])] = None
+                self.kinds  [(dev, t [4])] = t [1]
+        for line in filters :
+            t = line.split ()
+            if len (t) < 6 or t [:2] != ['filter', 'parent'] or t [5] != 'pref' :
+                continue
+            parent, prio = t [2], t [6]
+            tgt          = self._targets (t)
+            if 'fw' in t :
+                if 'handle' in t :
+                    handle = t [t.index ('handle') + 1]
+                    self.add_fw (dev, parent, prio, handle, None, tgt)
+            else :
+                self.add_filter (dev, parent, prio, None, tgt)
+    # end def parse_tc
+
+    def _targets (self, tokens) :
+        """ Classids used by a filter
+        """
+        return set \
+            ( tokens [n + 1] for n, tok in enumerate (tokens [:-1])
+              if tok in ('flowid', 'classid')
+            )
+    # end def _targets
+
+# end class TC_State
+
+class Batch_Writer (autosuper) :
+    """ File-like object that converts a script written by
+        Shaper.generate_to to the input format of tc -batch (see
+        Shaper.as_batch) while writing it to stream. Only complete
+        lines are converted, call flush after the last write.
+    """
+
+    def __init__ (self, stream) :
+        self.stream = stream
+        self.buf    = ''
+        self.cont   = ''
+    # end def __init__
+
+    def flush (self) :
+        if self.buf or self.cont :
+            self.line (self.buf)
+            self.buf = ''
+    # end def flush
+
+    def line (self, line) :
+        line = line.strip ()
+        if line.startswith ('TC=') :
+            return
+        if line.endswith ('\\') :
+            self.cont += line [:-1]
+            return
+        line      = self.cont + line
+        self.cont = ''
+        if line.startswith ('$TC ') :
+            line = line [4:]
+        self.stream.write (line.replace (' 2>&1 > /dev/null', '') + '\n')
+    # end def line
+
+    def write (self, s) :
+        lines    = (self.buf + s).split ('\n')
+        self.buf = lines.pop ()
+        for line in lines :
+            self.line (line)
+    # end def write
+
+# end class Batch_Writer
+
 class Shaper (Weighted_Bandwidth) :
     """ Top-Level container of Traffic_Class(es), this gets a list of
         Traffic classes to install at top-level in an interface.
         The generator then generates the necessary statements to add the
         top-level qdisc (and delete it if it is already there).
+        With filter_layout 'hash' consecutive mangle rules that only
+        match on a source (or destination) address are translated to
+        u32 hashing filters (see U32_Hash_Filter) for the real device
+        of an ifb device. The default 'linear' creates one filter per
+        rule. Filters for the firewall marks are not changed: The fw
+        classifier already does a hash lookup on the mark.
+        The mangle rules are parsed into the Rule_Set of the Shaper
+        unless a rule_set is passed to generate. Class ids are
+        allocated by the ID_Allocator of the Shaper, a shared one can
+        be passed with the allocator option.
+        >>> from rsclib.pycompat import StringIO
+        >>> rules = StringIO ('\\n'.join ((
+        ...   '-A PREROUTING -s 10.1.2.0/24 -j MARK --set-xmark 0x1/0xf'
+        ... , '-A PREROUTING -s 10.1.0.0/16 -j MARK --set-xmark 0x2/0xf'
+        ... , '-A PREROUTING -s 10.1.3.0/24 -j MARK --set-xmark 0x1/0xf'
+        ... , '-A PREROUTING -i eth1 -s 10.9.0.0/16 -j MARK --set-xmark 0x1/0xf'
+        ... , '-A PREROUTING -p tcp --sport 22 -j MARK --set-xmark 0x1/0xf'
+        ... , '-A PREROUTING -d 10.2.0.1/32 -j MARK --set-xmark 0x2/0xf'
+        ... , '-A PREROUTING -d 10.2.0.2/32 -j MARK --set-xmark 0x1/0xf'
+        ... )))
+        >>> root  = Traffic_Class (100)
+        >>> one   = Traffic_Class (50, parent = root, fwmark = '1/0xf')
+        >>> two   = Traffic_Class (50, parent = root, fwmark = '2/0xf')
+        >>> sh    = Shaper ('/sbin/tc', root, filter_layout = 'hash')
+        >>> out   = sh.generate (1000, 'ifb0=eth0', rulefile = rules)
+        >>> for line in out.split ('\\n') :
+        ...     if 'dev eth0 parent ffff: protocol' in line :
+        ...         print (line)
+        $TC filter add dev eth0 parent ffff: protocol ip prio 5 handle 1: u32 divisor 256
+        $TC filter add dev eth0 parent ffff: protocol ip prio 5 u32 match ip src 10.1.0.0/16 hashkey mask 0x0000ff00 at 12 link 1:
+        $TC filter add dev eth0 parent ffff: protocol ip prio 5 u32 match ip src 10.1.0.0/16 action xt -j MARK --set-xmark 0x2/0xf action mirred egress redirect dev ifb0
+        $TC filter add dev eth0 parent ffff: protocol ip prio 5 u32 ht 1:3: match ip src 10.1.3.0/24 action xt -j MARK --set-xmark 0x1/0xf action mirred egress redirect dev ifb0
+        $TC filter add dev eth0 parent ffff: protocol ip prio 1 handle 2: u32 divisor 256
+        $TC filter add dev eth0 parent ffff: protocol ip prio 1 u32 match ip dst 10.2.0.0/16 hashkey mask 0x0000ff00 at 16 link 2:
+        $TC filter add dev eth0 parent ffff: protocol ip prio 1 u32 ht 2:0: match ip dst 10.2.0.1/32 action xt -j MARK --set-xmark 0x2/0xf action mirred egress redirect dev ifb0
+        $TC filter add dev eth0 parent ffff: protocol ip prio 1 u32 ht 2:0: match ip dst 10.2.0.2/32 action xt -j MARK --set-xmark 0x1/0xf action mirred egress redirect dev ifb0
+        >>> print ([l.strip () for l in out.split ('\\n') if 'basic match' in l])
+        ["$TC filter add dev eth0 protocol ip parent ffff: prio 3 basic match ' u32 (u8 0x6 0xff at 0x9) and (u32(u16 0x16 0xffff at 0x14)) ' action xt -j MARK --set-xmark 0x1/0xf action mirred egress redirect dev ifb0"]
+        >>> len (sh.rule_set), len (IPTables_Mangle_Rule.rules)
+        (7, 0)
     """
     def __init__ (self, tc_cmd = '/sbin/tc', *classes, **kw) :
         self.tc_cmd = tc_cmd
@@ -776,12 +2101,132 @@ class Shaper (Weighted_Bandwidth) :
         self.use_ipt = False
         if 'use_ipt' in kw :
             self.use_ipt = kw ['use_ipt']
+        self.filter_layout = 'linear'
+        if 'filter_layout' in kw :
+            self.filter_layout = kw ['filter_layout']
+        if self.filter_layout not in ('linear', 'hash') :
+            raise ValueError ("Invalid filter_layout: %s" % self.filter_layout)
+        self.allocator = kw.get ('allocator') or ID_Allocator ()
+        self.rule_set  = Rule_Set (use_ipt = self.use_ipt)
         for c in classes :
             assert (not c.parent)
             self.register (c)
     # end def __init__
 
-    def generate (self, kbit_per_second, dev, rulefile = None) :
+    def apply \
+        ( self
+        , kbit_per_second
+        , dev
+        , rulefile = None
+        , previous = None
+        , rule_set = None
+        ) :
+        """ Generate the configuration and apply it with a single
+            tc -batch process. Errors when deleting a qdisc that doesn't
+            exist are ignored, other errors raise Exec_Error.
+            With previous only the changes are applied, see generate.
+        """
+        batch = self.generate \
+            ( kbit_per_second, dev, rulefile
+            , batch    = True
+            , previous = previous
+            , rule_set = rule_set
+            )
+        x = Exec ()
+        x.exec_pipe \
+            ( [self.tc_cmd, '-force', '-batch', '-']
+            , stdin      = batch
+            , ignore_err = True
+            )
+        failed = self.batch_errors (batch, x.stderr)
+        if failed :
+            raise Exec_Error \
+                ( "tc -batch failed in line %s: %s"
+                % (', '.join (str (n) for n, c in failed), x.stderr)
+                )
+    # end def apply
+
+    @staticmethod
+    def batch_errors (batch, stderr) :
+        """ Failed commands (line number, command) from the error
+            output of tc -batch, failures of deleting a qdisc are
+            ignored.
+            >>> Shaper.batch_errors \\
+            ...     ( 'qdisc del dev eth0 root\\nclass add dev eth0 x'
+            ...     , 'RTNETLINK answers: No such file or directory\\n'
+            ...       'Command failed -:1\\nCommand failed -:2'
+            ...     )
+            [(2, 'class add dev eth0 x')]
+        """
+        lines  = batch.split ('\n')
+        result = []
+        for n in re.findall (r'Command failed -:(\d+)', stderr) :
+            line = lines [int (n) - 1]
+            if not line.startswith ('qdisc del ') :
+                result.append ((int (n), line))
+        return result
+    # end def batch_errors
+
+    def register (self, child) :
+        child._allocator = self.allocator
+        self.__super.register (child)
+    # end def register
+
+    def prepare (self, kbit_per_second, dev) :
+        """ Allocate the class ids and leaf qdisc handles and compute
+            the rates of the classes for dev (see Traffic_Class.rates)
+            exactly like generate does, without generating anything.
+            Used when the configuration is generated elsewhere (e.g. in
+            another process) but the names and rates are needed here.
+            >>> root = Traffic_Class (100)
+            >>> a    = Traffic_Class (50, parent = root)
+            >>> one  = Traffic_Class (50, parent = a, fwmark = '1')
+            >>> two  = Traffic_Class (50, parent = a, fwmark = '2')
+            >>> tri  = Traffic_Class (50, parent = root, fwmark = '3')
+            >>> sh   = Shaper ('/sbin/tc', root)
+            >>> sh.prepare (1000, 'ifb0=eth0')
+            >>> [(c.name, c.rates) for c in sh.leaf_classes ()]
+            [('1:3', {'ifb0': 500.0}), ('1:4', {'ifb0': 500.0}), ('1:5', {'ifb0': 500.0})]
+            >>> x = sh.generate (1000, 'ifb0', batch = True)
+            >>> [c.name for c in sh.classes ()]
+            ['1:1', '1:2', '1:3', '1:4', '1:5']
+        """
+        dev = dev.split ('=', 1) [0]
+        with self.allocator.lock :
+            for c in self.children :
+                c.prepare (kbit_per_second, self.weightsum, dev)
+    # end def prepare
+
+    def as_batch (self, script) :
+        """ Convert a script from generate to the input format of
+            tc -batch: no TC variable and shell redirections and
+            continuation lines are joined.
+            >>> print (Shaper ().as_batch ('\\n'.join ((
+            ...   'TC=/sbin/tc'
+            ... , '$TC qdisc del dev eth0 root 2>&1 > /dev/null'
+            ... , '$TC class add dev eth0 parent 1: classid 1:1 hfsc \\\\'
+            ... , '    sc rate 2000.0kbit \\\\'
+            ... , '    ul rate 2000kbit'
+            ... , "    $TC filter add dev eth0 basic match 'u32 (u8 6 0xff at 9)'"
+            ... ))))
+            qdisc del dev eth0 root
+            class add dev eth0 parent 1: classid 1:1 hfsc sc rate 2000.0kbit ul rate 2000kbit
+            filter add dev eth0 basic match 'u32 (u8 6 0xff at 9)'
+        """
+        s = StringIO ()
+        Batch_Writer (s).write (script + '\n')
+        return s.getvalue () [:-1]
+    # end def as_batch
+
+    def generate \
+        ( self
+        , kbit_per_second
+        , dev
+        , rulefile = None
+        , batch    = False
+        , previous = None
+        , rule_set = None
+        ) :
         """ Generate traffic shaping configuration.
             We need the bandwidth and the device. The device can be
             special: If we're using ifb for inbound shaping, we can
@@ -796,43 +2241,661 @@ class Shaper (Weighted_Bandwidth) :
             appropriate firewall marks into the correct buckets).
             Rules in PREROUTING of the real device that match packets
             which already carry a mark are instantiated as tc filters in
-            the ifb device.
+            the ifb device. The rules are read from rulefile (default
+            is the running iptables) into the Rule_Set of the Shaper,
+            replacing the rules of the last call, unless a rule_set is
+            given (then rulefile must not be given).
+            By default the result is a shell script, with batch=True
+            it is in the format of tc -batch, see also apply.
+            If previous is given (the output of an earlier generate or
+            a TC_State, e.g. from TC_State.from_tc) only the commands
+            for changing the previous configuration into the new one
+            are output. The classids are allocated in the order the
+            classes are created, so the same tree yields the same
+            names and unchanged classes are kept with their statistics.
+            >>> from rsclib.pycompat import StringIO
+            >>> rules = '-A PREROUTING -s 10.1.2.0/24 -j MARK --set-xmark 0x1/0xf'
+            >>> root  = Traffic_Class (100)
+            >>> one   = Traffic_Class (50, parent = root, fwmark = '1/0xf')
+            >>> two   = Traffic_Class (50, parent = root, fwmark = '2/0xf')
+            >>> sh    = Shaper ('/sbin/tc', root)
+            >>> old   = sh.generate (1000, 'ifb0=eth0', StringIO (rules))
+            >>> sh.generate (1000, 'ifb0=eth0', StringIO (rules), previous = old)
+            'TC=/sbin/tc'
+            >>> two.weight = 25
+            >>> new = sh.generate \\
+            ...     (1000, 'ifb0=eth0', StringIO (rules), previous = old)
+            >>> for line in new.split ('\\n') :
+            ...     print (line.split (' parent') [0])
+            TC=/sbin/tc
+            $TC class change dev ifb0
+            $TC class change dev ifb0
         """
+        s = StringIO ()
+        self.generate_to \
+            (s, kbit_per_second, dev, rulefile, batch, previous, rule_set)
+        return s.getvalue () [:-1]
+    # end def generate
+
+    def generate_to \
+        ( self
+        , stream
+        , kbit_per_second
+        , dev
+        , rulefile = None
+        , batch    = False
+        , previous = None
+        , rule_set = None
+        ) :
+        """ Write the configuration to stream (a file-like object),
+            every line is written once when it is generated. For the
+            parameters see generate.
+            >>> root = Traffic_Class (100)
+            >>> leaf = Traffic_Class \\
+            ...     (100, parent = root, fwmark = '1', is_default = True)
+            >>> sh   = Shaper ('/sbin/tc', root)
+            >>> s    = StringIO ()
+            >>> sh.generate_to (s, 1000, 'eth0', batch = True)
+            >>> s.getvalue () == sh.generate (1000, 'eth0', batch = True) + '\\n'
+            True
+            >>> for line in s.getvalue ().split ('\\n') :
+            ...     print (' '.join (line.split () [:2]))
+            qdisc del
+            qdisc add
+            class add
+            class add
+            qdisc add
+            filter add
+            filter add
+            <BLANKLINE>
+            >>> sh.generate_to \\
+            ...     (s, 1000, 'eth0', rulefile = s, rule_set = Rule_Set ())
+            Traceback (most recent call last):
+             ...
+            ValueError: Either rulefile or rule_set can be given
+        """
+        if rulefile is not None and rule_set is not None :
+            raise ValueError ("Either rulefile or rule_set can be given")
+        with self.allocator.lock :
+            self._generate_to \
+                ( stream, kbit_per_second, dev, rulefile, batch
+                , previous, rule_set
+                )
+    # end def generate_to
+
+    def _generate_to \
+        (self, stream, kbit_per_second, dev, rulefile, batch, previous, rule_set) :
+        if previous is not None :
+            # The diff needs the complete new configuration
+            s = StringIO ()
+            self.generate_to \
+                (s, kbit_per_second, dev, rulefile, True, None, rule_set)
+            if not isinstance (previous, TC_State) :
+                previous = TC_State.from_batch (self.as_batch (previous))
+            cmds = previous.diff (TC_State.from_batch (s.getvalue ()))
+            if not batch :
+                stream.write ('TC=%s\n' % self.tc_cmd)
+                cmds = ('$TC ' + c for c in cmds)
+            for c in cmds :
+                stream.write (c + '\n')
+            return
+        out = stream
+        if batch :
+            out = Batch_Writer (stream)
         rdev = None
         if '=' in dev :
             dev, rdev = dev.split ('=', 1)
-            IPTables_Mangle_Rule.parse_prerouting_rules \
-                (rulefile, use_ipt = self.use_ipt)
+            if rule_set is None :
+                rule_set = self.rule_set
+                rule_set.parse (rulefile)
         default = ''
         for c in self.children :
-            default = c.get_default_name ()
+            default = c.get_default_name () or ''
             if default :
                 default = ' default %s' % default
                 break
-        s = []
         l = locals ()
-        s.append ('TC=%s' % self.tc_cmd)
-        s.append ('$TC qdisc del dev %(dev)s root 2>&1 > /dev/null' % l)
-        s.append ('$TC qdisc add dev %(dev)s root handle 1: hfsc%(default)s' %l)
+        out.write ('TC=%s\n' % self.tc_cmd)
+        out.write ('$TC qdisc del dev %(dev)s root 2>&1 > /dev/null\n' % l)
+        out.write ('$TC qdisc add dev %(dev)s root handle 1: hfsc%(default)s\n' %l)
         if rdev :
             # remove top-level qdisc in rdev and re-add
-            s.append ('$TC qdisc del dev %(rdev)s ingress 2>&1 > /dev/null' % l)
-            s.append ('$TC qdisc add dev %(rdev)s ingress' % l)
+            out.write \
+                ('$TC qdisc del dev %(rdev)s ingress 2>&1 > /dev/null\n' % l)
+            out.write ('$TC qdisc add dev %(rdev)s ingress\n' % l)
         for c in self.children :
-            s.append (c.generate (kbit_per_second, self.weightsum, dev))
+            c.generate_to (out, kbit_per_second, self.weightsum, dev)
+        hashed  = ()
+        hfilter = ()
+        if rdev and self.filter_layout == 'hash' :
+            hashed, hfilter = self.gen_hash_filter (dev, rdev, rule_set)
         for c in self.children :
-            s.append (c.gen_filter (dev, rdev))
+            c.gen_filter_to (out, dev, rdev, hashed, rule_set)
+        for f in hfilter :
+            f.generate_to (out)
         # redirect everything else that wasn't marked:
         if rdev :
-            prio = IPTables_Mangle_Rule.maxprio () + 2
+            prio = rule_set.maxprio () + 2
             l = locals ()
-            s.append ('$TC filter add dev %(rdev)s parent ffff: \\' % l)
-            s.append ('    protocol ip prio %(prio)s u32 match u32 0 0 \\' % l)
-            s.append ('    action mirred egress redirect dev %(dev)s' % l)
-        return '\n'.join (s)
-    # end def generate
+            out.write ('$TC filter add dev %(rdev)s parent ffff: \\\n' % l)
+            out.write \
+                ('    protocol ip prio %(prio)s u32 match u32 0 0 \\\n' % l)
+            out.write ('    action mirred egress redirect dev %(dev)s\n' % l)
+        if batch :
+            out.flush ()
+    # end def _generate_to
+
+    def gen_hash_filter (self, dev, rdev, rule_set) :
+        """ Translate runs of consecutive mangle rules matching only on
+            the source (or only on the destination) address to u32
+            hashing filters for rdev, each run uses the prio of its
+            last rule. Returns the set of translated rules and the
+            U32_Hash_Filter objects.
+        """
+        used = set ()
+        for c in self.leaf_classes () :
+            used.update (rule_set.for_mark (c.fwmark, rdev))
+        runs = []
+        run  = []
+        key  = None
+        for r in rule_set :
+            if r not in used or r.mark :
+                continue
+            k = r.address_only ()
+            if k is None or k != key :
+                if len (run) > 1 :
+                    runs.append ((key, run))
+                run = []
+            key = k
+            if k :
+                run.append (r)
+        if len (run) > 1 :
+            runs.append ((key, run))
+        act    = 'action mirred egress redirect dev %s' % dev
+        handle = 1
+        hashed = set ()
+        result = []
+        for key, run in runs :
+            f = U32_Hash_Filter \
+                ( rdev, 'ffff:'
+                , prio   = min (r.prio for r in run)
+                , is_dst = key == 'destination'
+                , handle = handle
+                )
+            # The MARK target doesn't terminate, so the last matching
+            # rule wins: Drop rules covered by a later rule, then the
+            # longest prefix match yields the same result.
+            seen = Prefix_Table ()
+            for r in reversed (run) :
+                a = r.address (key)
+                if seen.longest_match (a) is None :
+                    seen [a] = True
+                    f.add (a, ' '.join ((r.tc_action (), act)))
+            f.layout ()
+            result.append (f)
+            handle += f.ntables
+            hashed.update (run)
+        return hashed, result
+    # end def gen_hash_filter
+
+    def classes (self, classes = None) :
+        """ Iterate over all Traffic_Class objects depth first, parents
+            before their children: the order in which generate
+            allocates the class ids.
+        """
+        if classes is None :
+            classes = self.children
+        for c in classes :
+            if isinstance (c, Traffic_Class) :
+                yield c
+                for d in self.classes (c.children) :
+                    yield d
+    # end def classes
+
+    def leaf_classes (self, classes = None) :
+        """ Iterate over all Traffic_Class leafs, only valid after
+            generate has been called.
+        """
+        if classes is None :
+            classes = self.children
+        for c in classes :
+            if not isinstance (c, Traffic_Class) :
+                continue
+            if c.is_leaf :
+                yield c
+            else :
+                for l in self.leaf_classes (c.children) :
+                    yield l
+    # end def leaf_classes
 # end class Shaper
 
+class Device_Result (autosuper) :
+    """ Result of generating and applying the configuration of one
+        device with Multi_Shaper, times are in seconds. A nonzero
+        exit status of tc counts as failure even if no failed command
+        could be found in its output (e.g. tc could not be executed).
+        >>> r = Device_Result ('eth0')
+        >>> r.gen_status = 0
+        >>> r, r.failed
+        (eth0: generate 0.000s apply 0.000s ok, False)
+        >>> r.apply_status = 256
+        >>> r.stderr = 'No such file or directory\\n'
+        >>> r, r.failed
+        (eth0: generate 0.000s apply 0.000s apply failed with status 256: No such file or directory, True)
+    """
+
+    def __init__ (self, dev) :
+        self.dev          = dev
+        self.batch        = None
+        self.errors       = []
+        self.gen_status   = None
+        self.gen_time     = None
+        self.apply_status = None
+        self.apply_time   = None
+        self.stderr       = ''
+    # end def __init__
+
+    @property
+    def failed (self) :
+        return bool (self.gen_status or self.errors or self.apply_status)
+    # end def failed
+
+    def __repr__ (self) :
+        if self.gen_status :
+            state = 'generate failed: %s' % self.stderr.strip ()
+        elif self.errors :
+            state = '%s commands failed, first in line %s: %s' \
+                % ((len (self.errors),) + self.errors [0])
+        elif self.apply_status :
+            state = 'apply failed with status %s: %s' \
+                % (self.apply_status, self.stderr.strip ())
+        else :
+            state = 'ok'
+        return '%s: generate %.3fs apply %.3fs %s' % \
+            (self.dev, self.gen_time or 0, self.apply_time or 0, state)
+    # end def __repr__
+    __str__ = __repr__
+
+# end class Device_Result
+
+class Multi_Shaper (autosuper) :
+    """ Generate and apply the configuration of many devices in
+        parallel. The devices map the device name (e.g. 'ifb0=eth0') to
+        the bandwidth in kbit/s or to a tuple (bandwidth, shaper), the
+        default shaper is used for the plain bandwidths. The mangle
+        rules are read once for all devices.
+        Since generating is CPU bound, each configuration is generated
+        in its own process (a Method_Process), then one tc -batch
+        process (an Exec_Process) per device applies it, at most
+        `parallel` processes run at the same time. The results are
+        Device_Result objects with timing and the failed commands.
+        With previous (a dict of device to the batch applied last time,
+        see Device_Result.batch) only the changes are applied, see
+        Shaper.generate.
+        The class ids, leaf qdiscs and rates are computed in this
+        process before forking (see Shaper.prepare), so the shapers
+        can be used afterwards, e.g. with a Stats_Collector.
+        >>> import os
+        >>> def apply (ms) :
+        ...     # the forked processes need the real stdout
+        ...     stdout, sys.stdout = sys.stdout, sys.__stdout__
+        ...     try :
+        ...         return ms.apply ()
+        ...     except SystemExit as cause :
+        ...         # don't return to the doctest in a forked child
+        ...         sys.stdout.flush ()
+        ...         os._exit (cause.code or 0)
+        ...     finally :
+        ...         sys.stdout = stdout
+        >>> root = Traffic_Class (100)
+        >>> a    = Traffic_Class (50, parent = root)
+        >>> one  = Traffic_Class (50, parent = a, fwmark = '1')
+        >>> two  = Traffic_Class (50, parent = a, fwmark = '2')
+        >>> tri  = Traffic_Class (50, parent = root, fwmark = '3')
+        >>> sh   = Shaper ('/bin/true', root)
+        >>> ms   = Multi_Shaper (dict (eth0 = 1000, eth1 = 2000), sh)
+        >>> r    = apply (ms)
+        >>> ms.failed, sorted (r)
+        ([], ['eth0', 'eth1'])
+        >>> [(c.name, c.fwmark, sorted (c.rates.items ())) for c in sh.leaf_classes ()]
+        [('1:3', '0x1', [('eth0', 500.0), ('eth1', 1000.0)]), ('1:4', '0x2', [('eth0', 500.0), ('eth1', 1000.0)]), ('1:5', '0x3', [('eth0', 500.0), ('eth1', 1000.0)])]
+        >>> 'classid 1:5 hfsc sc rate 1000.0kbit' in r ['eth1'].batch
+        True
+        >>> r ['eth1'].batch == sh.generate (2000, 'eth1', batch = True) + '\\n'
+        True
+        >>> sc = Stats_Collector (sh, ['eth0', 'eth1'])
+        >>> sc.classes [tri.name] is tri
+        True
+        >>> sc.update ('eth1', json.dumps ([dict
+        ...     (handle = '1:5', stats = dict (bytes = 0, packets = 0))]), 0)
+        >>> sc.update ('eth1', json.dumps ([dict
+        ...     (handle = '1:5', stats = dict (bytes = 12e5, packets = 800))]), 10)
+        >>> [(dev, c.fwmark) for dev, c, s in sc.saturated ()]
+        [('eth1', '0x3')]
+    """
+
+    def __init__ \
+        ( self
+        , devices
+        , shaper   = None
+        , rulefile = None
+        , parallel = 16
+        , tc_cmd   = None
+        ) :
+        self.devices  = {}
+        self.parallel = parallel
+        self.rulefile = rulefile
+        self.results  = {}
+        for dev, v in devices.items () :
+            if not isinstance (v, tuple) :
+                v = (v, shaper)
+            if v [1] is None :
+                raise ValueError ("No shaper for %s" % dev)
+            self.devices [dev] = v
+        self.tc_cmd = tc_cmd
+        if tc_cmd is None and self.devices :
+            self.tc_cmd = self.devices [min (self.devices)][1].tc_cmd
+    # end def __init__
+
+    @property
+    def failed (self) :
+        return [r for r in self.results.values () if r.failed]
+    # end def failed
+
+    def apply (self, previous = None) :
+        """ Generate and apply all configurations, returns the results
+            by device.
+        """
+        previous = previous or {}
+        rule_set = None
+        if [d for d in self.devices if '=' in d] :
+            shaper   = self.devices [min (self.devices)][1]
+            rule_set = Rule_Set (use_ipt = shaper.use_ipt)
+            rule_set.parse (self.rulefile)
+        self.results = {}
+        devs  = sorted (self.devices)
+        # Names and rates are needed here, not only in the children
+        for dev in devs :
+            kbit, shaper = self.devices [dev]
+            shaper.prepare (kbit, dev)
+        # Buffered output would be written again by forked processes
+        sys.stdout.flush ()
+        sys.stderr.flush ()
+        procs = {}
+        for dev in devs :
+            kbit, shaper = self.devices [dev]
+            r = self.results [dev] = Device_Result (dev)
+            r.out = tempfile.TemporaryFile ('w+')
+            r.err = tempfile.TemporaryFile ('w+')
+            def generate \
+                (shaper = shaper, kbit = kbit, dev = dev, p = previous.get (dev)) :
+                shaper.generate_to \
+                    ( sys.stdout, kbit, dev
+                    , batch    = True
+                    , previous = p
+                    , rule_set = rule_set
+                    )
+            # end def generate
+            procs [dev] = Method_Process \
+                ( name   = 'generate-%s' % dev
+                , method = generate
+                , stdout = r.out
+                , stderr = r.err
+                )
+        self._run (procs)
+        for dev in devs :
+            r = self.results [dev]
+            r.gen_status = procs [dev].status
+            r.gen_time   = procs [dev].elapsed
+            r.out.seek (0)
+            r.batch = r.out.read ()
+        procs = {}
+        for dev in devs :
+            r = self.results [dev]
+            if r.gen_status :
+                continue
+            r.out.seek (0)
+            procs [dev] = Exec_Process \
+                ( self.tc_cmd, [self.tc_cmd, '-force', '-batch', '-']
+                , name   = 'tc-%s' % dev
+                , stdin  = r.out
+                , stdout = r.err
+                , stderr = r.err
+                )
+        self._run (procs)
+        for dev in devs :
+            r = self.results [dev]
+            r.err.seek (0)
+            r.stderr = r.err.read ()
+            r.out.close ()
+            r.err.close ()
+            del r.out, r.err
+            if dev in procs :
+                r.apply_status = procs [dev].status
+                r.apply_time   = procs [dev].elapsed
+                r.errors       = Shaper.batch_errors (r.batch, r.stderr)
+        return self.results
+    # end def apply
+
+    def _run (self, procs) :
+        """ Run processes, at most self.parallel at a time
+        """
+        running = set ()
+        for p in procs.values () :
+            p.run ()
+            running.add (p)
+            while len (running) >= self.parallel :
+                running.discard (Process.wait_one (running))
+        while running :
+            running.discard (Process.wait_one (running))
+    # end def _run
+
+# end class Multi_Shaper
+
+Class_Sample = namedtuple \
+    ( 'Class_Sample'
+    , 'time bytes packets drops backlog rate pps drop_rate'
+    )
+
+class Stats_Collector (autosuper) :
+    """ Collect the statistics of the classes of a Shaper from the
+        kernel: One tc -s -j class show per device (not per class)
+        every `interval` seconds. The counters are mapped to the
+        Traffic_Class objects by name and kept with the rates computed
+        from the previous sample (bit/s, packets/s and drops/s) as a
+        time series of the last `history` Class_Sample tuples per
+        device and class. The rates of the first sample and after a
+        counter reset (e.g. the class was re-created) are None.
+        A device that can't be queried (e.g. it is down) is skipped.
+        The configured rate of a class is generated per device (see
+        Traffic_Class.rates), a Shaper may serve several devices with
+        different bandwidth. The devices may be given as a dict of
+        device to bandwidth in kbit/s (as for Multi_Shaper), then the
+        names and rates are computed with Shaper.prepare, e.g. when the
+        configuration was applied by another process. Otherwise the
+        Shaper must have been generated for the devices.
+        >>> root = Traffic_Class (100)
+        >>> one  = Traffic_Class (60, parent = root, fwmark = '1', is_default = True)
+        >>> two  = Traffic_Class (40, parent = root, fwmark = '2')
+        >>> sh   = Shaper ('/sbin/tc', root)
+        >>> x    = sh.generate (1000, 'eth0')
+        >>> def show (*counters) :
+        ...     return json.dumps \\
+        ...         ([ dict (handle = c.name, stats = dict (zip
+        ...             (('bytes', 'packets', 'drops', 'backlog'), counters [i])))
+        ...            for i, c in enumerate ((root, one, two))
+        ...         ])
+        >>> sc = Stats_Collector (sh, ['eth0'], interval = 10, history = 2)
+        >>> sc.update ('eth0', show ((0, 0, 0, 0), (0, 0, 0, 0), (0, 0, 0, 0)), 100)
+        >>> sc.latest ('eth0', one)
+        Class_Sample(time=100, bytes=0, packets=0, drops=0, backlog=0, rate=None, pps=None, drop_rate=None)
+        >>> sc.update \\
+        ...     ( 'eth0'
+        ...     , show ((1e6, 1e3, 0, 0), (7e5, 700, 5, 9000), (3e5, 300, 0, 0))
+        ...     , 110
+        ...     )
+        >>> s = sc.latest ('eth0', one)
+        >>> s.rate, s.pps, s.drop_rate, one.rates ['eth0']
+        (560000.0, 70.0, 0.5, 600.0)
+        >>> [(dev, c.name) for dev, c, s in sc.saturated ()]
+        [('eth0', '1:2')]
+        >>> x = sh.generate (2000, 'eth1')
+        >>> sorted (one.rates.items ())
+        [('eth0', 600.0), ('eth1', 1200.0)]
+        >>> [(dev, c.name) for dev, c, s in sc.saturated ()]
+        [('eth0', '1:2')]
+        >>> sc.update ('eth0', show ((0, 0, 0, 0), (0, 0, 0, 0), (10, 1, 0, 0)), 120)
+        >>> sc.latest ('eth0', two).rate, len (sc.series [('eth0', two.name)])
+        (None, 2)
+        >>> Stats_Collector (sh, ['eth0', 'eth1'], tc_cmd = '/bin/false').run (1)
+
+        A Shaper that was never generated in this process:
+        >>> root = Traffic_Class (100)
+        >>> a    = Traffic_Class (50, parent = root)
+        >>> one  = Traffic_Class (50, parent = a, fwmark = '1')
+        >>> two  = Traffic_Class (50, parent = a, fwmark = '2')
+        >>> tri  = Traffic_Class (50, parent = root, fwmark = '3')
+        >>> sh   = Shaper ('/sbin/tc', root)
+        >>> sc   = Stats_Collector (sh, {'ifb0=eth0' : 1000})
+        >>> sc.devices
+        ['ifb0']
+        >>> sorted ((n, c.fwmark) for n, c in sc.classes.items ())
+        [('1:1', None), ('1:2', None), ('1:3', '0x1'), ('1:4', '0x2'), ('1:5', '0x3')]
+        >>> tri.rates
+        {'ifb0': 500.0}
+        >>> sc.update ('ifb0', json.dumps ([dict
+        ...     (handle = '1:5', stats = dict (bytes = 0, packets = 0))]), 0)
+        >>> sc.update ('ifb0', json.dumps ([dict
+        ...     (handle = '1:5', stats = dict (bytes = 6e5, packets = 400))]), 10)
+        >>> [(dev, c.fwmark) for dev, c, s in sc.saturated ()]
+        [('ifb0', '0x3')]
+        >>> Stats_Collector (Shaper ('/sbin/tc', Traffic_Class (100)), ['eth0'])
+        Traceback (most recent call last):
+         ...
+        ValueError: Shaper not generated, pass the bandwidth of the devices
+    """
+
+    def __init__ \
+        ( self
+        , shaper
+        , devices
+        , interval = 10
+        , history  = 360
+        , tc_cmd   = None
+        ) :
+        self.shaper    = shaper
+        self.bandwidth = {}
+        if isinstance (devices, dict) :
+            self.bandwidth = devices
+        self.devices   = [d.split ('=', 1) [0] for d in devices]
+        self.interval  = interval
+        self.history   = history
+        self.tc_cmd    = tc_cmd or shaper.tc_cmd
+        self.series    = {}
+        self.classes   = {}
+        self.refresh ()
+    # end def __init__
+
+    def refresh (self) :
+        """ Map names to the classes of the shaper, needed after
+            classes are added. The names are allocated by generate or
+            by Shaper.prepare (with the bandwidth of the devices), a
+            Shaper without names raises ValueError.
+        """
+        for dev in sorted (self.bandwidth) :
+            self.shaper.prepare (self.bandwidth [dev], dev)
+        classes = list (self.shaper.classes ())
+        if [c for c in classes if c._number is None] :
+            raise ValueError \
+                ("Shaper not generated, pass the bandwidth of the devices")
+        self.classes = dict ((c.name, c) for c in classes)
+    # end def refresh
+
+    def latest (self, dev, cls) :
+        """ Last sample of the class (or name) on dev or None
+        """
+        s = self.series.get ((dev, getattr (cls, 'name', cls)))
+        return s [-1] if s else None
+    # end def latest
+
+    def poll (self) :
+        """ Get the statistics of all devices once
+        """
+        x = Exec ()
+        for dev in self.devices :
+            try :
+                out = x.exec_pipe \
+                    ( [self.tc_cmd, '-s', '-j', 'class', 'show', 'dev', dev]
+                    , do_split = False
+                    )
+            except Exec_Error :
+                # e.g. the interface is down, exec_pipe logged the
+                # error, continue with the other devices
+                continue
+            self.update (dev, out)
+    # end def poll
+
+    def run (self, count = None) :
+        """ Poll every interval seconds, count times or forever
+        """
+        next = time ()
+        while count is None or count > 0 :
+            self.poll ()
+            if count is not None :
+                count -= 1
+                if not count :
+                    break
+            next += self.interval
+            sleep (max (0, next - time ()))
+    # end def run
+
+    def saturated (self, threshold = 0.9) :
+        """ Classes that dropped packets or that used at least
+            threshold of their rate in the last interval as tuples
+            (device, class, sample).
+        """
+        result = []
+        for (dev, name), s in sorted (self.series.items ()) :
+            c = self.classes.get (name)
+            l = s [-1]
+            if c is None or l.rate is None :
+                continue
+            rate = c.rates.get (dev)
+            if l.drop_rate or rate and l.rate >= threshold * rate * 1000 :
+                result.append ((dev, c, l))
+        return result
+    # end def saturated
+
+    def update (self, dev, output, now = None) :
+        """ Add samples from the output of tc -s -j class show for dev
+        """
+        if now is None :
+            now = time ()
+        for c in json.loads (output or '[]') :
+            name = c.get ('handle')
+            st   = c.get ('stats', {})
+            if name not in self.classes or 'bytes' not in st :
+                continue
+            key = (dev, name)
+            if key not in self.series :
+                self.series [key] = deque (maxlen = self.history)
+            series = self.series [key]
+            cur    = \
+                [st ['bytes'], st.get ('packets', 0), st.get ('drops', 0)]
+            rates  = [None, None, None]
+            if series :
+                last = series [-1]
+                dt   = now - last.time
+                prev = (last.bytes, last.packets, last.drops)
+                if dt > 0 and all (a >= b for a, b in zip (cur, prev)) :
+                    rates = [float (a - b) / dt for a, b in zip (cur, prev)]
+                    rates [0] *= 8
+            series.append \
+                (Class_Sample (now, * (cur + [st.get ('backlog', 0)] + rates)))
+    # end def update
+
+# end class Stats_Collector
+
 if __name__ == '__main__' :
     import sys
 